@@ -0,0 +1,61 @@
+"""
+A corpus of generated blog posts that resemble the Markdown written on a
+typical technical blog: metadata, headings, paragraphs with inline markup,
+lists, links, images, code and MathJax.
+"""
+import random
+
+_WORDS = ("flask blog markdown storage render cache post index page feed "
+          "sitemap engine template view tag author request response query "
+          "database python extension plugin signal user editor").split()
+
+_PARAGRAPH_TEMPLATES = [
+    "{words} *{word}* {words} **{word}** {words}.",
+    "{words} `{word}()` {words} [{word}](https://example.com/{word}) "
+    "{words}.",
+    "{words} $x^2 + {n}$ {words} $$\\sum_{{i=0}}^{{{n}}} i$$ {words}.",
+]
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(_WORDS) for _ in range(count))
+
+
+def _paragraph(rng):
+    template = rng.choice(_PARAGRAPH_TEMPLATES)
+    return template.format(words=_words(rng, rng.randint(8, 30)),
+                           word=rng.choice(_WORDS), n=rng.randint(1, 99))
+
+
+def sample_post(rng, sections=4):
+    """
+    Build the Markdown text of a single post.
+
+    :param rng: The random number generator to use
+    :type rng: random.Random
+    :param sections: The number of sections in the post
+    :type sections: int
+    :return: The Markdown text
+    """
+    blocks = ["Summary: %s" % _words(rng, 12),
+              "Keywords: %s, %s" % (rng.choice(_WORDS), rng.choice(_WORDS))]
+    blocks = ["\n".join(blocks)]
+    for section in range(sections):
+        blocks.append("## %s" % _words(rng, 4).title())
+        blocks.extend(_paragraph(rng) for _ in range(rng.randint(2, 4)))
+        blocks.append("\n".join("- %s" % _words(rng, 6)
+                                for _ in range(rng.randint(2, 5))))
+        blocks.append("![%s](/static/img/%d.png)" % (rng.choice(_WORDS),
+                                                     section))
+        blocks.append("\n".join("    %s = %d" % (rng.choice(_WORDS), i)
+                                for i in range(rng.randint(2, 6))))
+    return "\n\n".join(blocks)
+
+
+def sample_posts(count, seed=0, sections=4):
+    """
+    Build the Markdown text of ``count`` posts. The corpus is deterministic
+    for a given ``seed``.
+    """
+    rng = random.Random(seed)
+    return [sample_post(rng, sections) for _ in range(count)]
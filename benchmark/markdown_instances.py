@@ -0,0 +1,48 @@
+"""
+Measures the cost of building a ``markdown.Markdown`` instance for every
+post, against reusing the pooled instances of ``PostProcessor``.
+
+Run it from the repository root with::
+
+    python -m benchmark.markdown_instances
+"""
+import copy
+import timeit
+import markdown
+from flask_blogging import PostProcessor
+from .corpus import sample_posts
+
+
+def _per_post_us(func, posts, repeat):
+    timer = timeit.Timer(lambda: [func(text) for text in posts])
+    best = min(timer.repeat(repeat=repeat, number=1))
+    return best * 1e6 / len(posts)
+
+
+def run(count=10, repeat=20):
+    posts = sample_posts(count)
+    PostProcessor.set_render_cache(None)
+
+    # the same extensions as the pooled instances, which collect the
+    # images and cache the code blocks too
+    def construct(text):
+        return markdown.Markdown(extensions=[
+            copy.copy(e) for e in PostProcessor.markdown_extensions()])
+
+    def new_instance(text):
+        md = construct(text)
+        return md.convert(text), md.Meta
+
+    results = [
+        ("construction only", _per_post_us(construct, posts, repeat)),
+        ("new instance per post", _per_post_us(new_instance, posts, repeat)),
+        ("pooled instance", _per_post_us(PostProcessor.convert, posts,
+                                         repeat)),
+    ]
+    print("%d posts, best of %d runs" % (count, repeat))
+    for name, us in results:
+        print("%-24s %10.1f us/post" % (name, us))
+
+
+if __name__ == "__main__":
+    run()
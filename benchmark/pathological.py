@@ -0,0 +1,65 @@
+"""
+Times the rendering of worst-case Markdown inputs, which make the regular
+expressions of Python-Markdown backtrack, with the default renderer and
+with the ``SandboxedRenderer`` used when ``BLOGGING_RENDER_TIMEOUT`` is set.
+The render cache is disabled.
+
+Run it from the repository root with::
+
+    python -m benchmark.pathological
+"""
+import time
+from flask_blogging import PostProcessor
+from flask_blogging.renderers import PythonMarkdownRenderer, \
+    SandboxedRenderer
+
+
+def pathological_posts(size=3000):
+    """
+    The fuzz corpus of worst-case inputs, by name.
+
+    :param size: The number of repetitions of the pattern of each input
+    :type size: int
+    :return: A list of the names and texts of the inputs
+    """
+    return [
+        ("nested brackets", "[" * size + "a" + "]" * size),
+        ("unclosed links", "[a](" * size),
+        ("backticks", "`a``" * size),
+        ("emphasis", "*a **b " * size),
+        ("mathjax", "$" + "a$" * size),
+        ("underscores", "_" * (size * 5) + "a"),
+        ("block quotes", ">" * size + " a"),
+        ("nested lists", "\n".join(" " * (2 * i) + "- a"
+                                   for i in range(size // 20))),
+        ("html", "<div>" * size),
+        ("autolinks", "<" * (size * 5)),
+    ]
+
+
+def _time(renderer, text):
+    start = time.time()
+    rendered_text, meta = renderer.convert(PostProcessor, text)
+    return time.time() - start, meta.get("render_timeout", False)
+
+
+def run(size=3000, timeout=0.5):
+    PostProcessor.set_render_cache(None)
+    direct = PythonMarkdownRenderer()
+    sandboxed = SandboxedRenderer(direct, timeout)
+    print("%-16s %12s %12s" % ("input", "direct ms", "sandboxed ms"))
+    try:
+        for name, text in pathological_posts(size):
+            direct_time, _ = _time(direct, text)
+            sandboxed_time, timed_out = _time(sandboxed, text)
+            print("%-16s %12.1f %12.1f%s" % (
+                name, direct_time * 1e3, sandboxed_time * 1e3,
+                " (timed out)" if timed_out else ""))
+    finally:
+        sandboxed.close()
+    print("%d timeouts with a timeout of %s s" % (sandboxed.timeouts,
+                                                  timeout))
+
+
+if __name__ == "__main__":
+    run()
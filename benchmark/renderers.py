@@ -0,0 +1,46 @@
+"""
+Compares the throughput of the Markdown renderers over a corpus of posts,
+with the render cache disabled. The ``CommonMarkRenderer`` is skipped if
+markdown-it-py is not installed.
+
+Run it from the repository root with::
+
+    python -m benchmark.renderers
+"""
+import timeit
+from flask_blogging import PostProcessor
+from flask_blogging.renderers import PythonMarkdownRenderer, \
+    CommonMarkRenderer
+from .corpus import sample_posts
+
+
+def _renderers():
+    renderers = [("python-markdown", PythonMarkdownRenderer())]
+    try:
+        renderers.append(("commonmark", CommonMarkRenderer()))
+    except ImportError as e:
+        print("Skipping commonmark: %s" % e)
+    return renderers
+
+
+def run(count=50, sections=6, repeat=10):
+    posts = sample_posts(count, sections=sections)
+    size = sum(len(text) for text in posts)
+    PostProcessor.set_render_cache(None)
+    print("%d posts, %d KiB of Markdown, best of %d runs" %
+          (count, size // 1024, repeat))
+    try:
+        for name, renderer in _renderers():
+            PostProcessor.set_renderer(renderer)
+            timer = timeit.Timer(
+                lambda: [PostProcessor.convert_markdown(text)
+                         for text in posts])
+            best = min(timer.repeat(repeat=repeat, number=1))
+            print("%-16s %10.1f us/post %10.1f posts/s" %
+                  (name, best * 1e6 / count, count / best))
+    finally:
+        PostProcessor.set_renderer(None)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,105 @@
+"""
+The authentication state of the current user, computed once per request and
+shared by the views, the templates, the post processor and the cache.
+"""
+try:
+    from builtins import object, str
+except ImportError:
+    pass
+from flask import g, has_app_context
+from flask_login import current_user, user_logged_in, user_logged_out
+from flask_principal import identity_changed
+
+
+class AuthContext(object):
+    """
+    The authentication state of the current user. Each value is computed on
+    first access, and then kept for the rest of the request.
+    """
+
+    def __init__(self, blogger_permission=None):
+        """
+
+        :param blogger_permission: (Optional) The permission a blogger has.
+         It can also be set later, before ``is_blogger`` is first accessed.
+        :type blogger_permission: flask_principal.Permission
+        """
+        self.blogger_permission = blogger_permission
+        self._values = {}
+
+    def _get(self, key, func):
+        if key not in self._values:
+            self._values[key] = func()
+        return self._values[key]
+
+    @property
+    def user(self):
+        """
+        The current user, instead of the ``current_user`` proxy.
+        """
+        return self._get("user", current_user._get_current_object)
+
+    @property
+    def is_authenticated(self):
+        def _is_authenticated():
+            authenticated = self.user.is_authenticated
+            return authenticated() if callable(authenticated) \
+                else authenticated
+        return self._get("is_authenticated", _is_authenticated)
+
+    @property
+    def user_id(self):
+        """
+        The unicode id of the current user, or ``None`` if the user is not
+        authenticated.
+        """
+        return self._get("user_id", lambda: self.user.get_id()
+                         if self.is_authenticated else None)
+
+    @property
+    def is_blogger(self):
+        """
+        ``True`` if the current user is authenticated and has the
+        ``blogger_permission``.
+        """
+        return self._get("is_blogger", lambda: bool(
+            self.is_authenticated and
+            self.blogger_permission.require().can()))
+
+    def is_author(self, post):
+        """
+        ``True`` if the current user is the author of the ``post``.
+        """
+        return self.user_id is not None and \
+            self.user_id == u'' + str(post["user_id"])
+
+
+def get_auth_context(blogger_permission=None):
+    """
+    Get the ``AuthContext`` of the current request, which is kept on
+    ``flask.g``. It is cleared when a user logs in or out, or when the
+    identity changes.
+
+    :param blogger_permission: (Optional) The permission a blogger has, if
+     it is not known by the context yet.
+    :type blogger_permission: flask_principal.Permission
+    :return: The ``AuthContext``
+    """
+    context = g.get("blogging_auth") if has_app_context() else None
+    if context is None:
+        context = AuthContext(blogger_permission)
+        if has_app_context():
+            g.blogging_auth = context
+    elif context.blogger_permission is None:
+        context.blogger_permission = blogger_permission
+    return context
+
+
+def _clear_auth_context(*args, **kwargs):
+    if has_app_context():
+        g.pop("blogging_auth", None)
+
+
+user_logged_in.connect(_clear_auth_context)
+user_logged_out.connect(_clear_auth_context)
+identity_changed.connect(_clear_auth_context)
@@ -1,5 +1,6 @@
 import logging
 from .storage import Storage
+from .post import Post
 import boto3
 from boto3.dynamodb.conditions import Key
 import datetime
@@ -25,7 +26,8 @@ class DynamoDBStorage(Storage):
 
     def save_post(self, title, text, user_id, tags, draft=False,
                   post_date=None, last_modified_date=None, meta_data=None,
-                  post_id=None):
+                  post_id=None, rendered_text=None, renderer=None,
+                  slug=None):
         try:
             current_datetime = datetime.datetime.utcnow()
             post_date = post_date or current_datetime
@@ -33,14 +35,18 @@ class DynamoDBStorage(Storage):
             last_modified_date = last_modified_date or current_datetime
             tags = self.normalize_tags(tags)
             draft = 1 if draft else 0
+            meta_data = self.derived_meta_data(text, meta_data)
             r = {'title': title,
+                 'slug': slug,
                  'text': text,
                  'user_id': user_id,
                  'tags': tags,
                  'draft': draft,
                  'post_date': post_date,
                  'last_modified_date': self._to_timestamp(last_modified_date),
-                 'meta_data': meta_data
+                 'meta_data': meta_data,
+                 'rendered_text': rendered_text,
+                 'renderer': renderer
                  }
             if post_id is not None:
                 response = self._blog_posts_table.get_item(
@@ -54,23 +60,29 @@ class DynamoDBStorage(Storage):
                 self._blog_posts_table.put_item(Item=r)
                 self._insert_tags(tags, post_id, post_date, draft)
             else:
-                expr = 'SET title = :title, #t = :text, user_id = :user_id, '\
+                expr = 'SET title = :title, slug = :slug, #t = :text, '\
+                       'user_id = :user_id, '\
                        'tags = :tags, draft = :draft, '\
                        'post_date = :post_date, '\
                        'last_modified_date = :last_modified_date, '\
-                       'meta_data = :meta_data'
+                       'meta_data = :meta_data, '\
+                       'rendered_text = :rendered_text, '\
+                       'renderer = :renderer'
                 self._blog_posts_table.update_item(
                     Key={'post_id': post_id},
                     UpdateExpression=expr,
                     ExpressionAttributeValues={
                         ':title': r['title'],
+                        ':slug': r['slug'],
                         ':text': r['text'],
                         ':user_id': r['user_id'],
                         ':tags': r['tags'],
                         ':draft': r['draft'],
                         ':post_date': r['post_date'],
                         ':last_modified_date': r["last_modified_date"],
-                        ':meta_data': r['meta_data']
+                        ':meta_data': r['meta_data'],
+                        ':rendered_text': r['rendered_text'],
+                        ':renderer': r['renderer']
                     },
                     ExpressionAttributeNames={'#t': 'text'},
                     ReturnValues="ALL_NEW"
@@ -97,20 +109,48 @@ class DynamoDBStorage(Storage):
             post_ids = []
         return [self.get_post_by_id(p) for p in post_ids]
 
+    def get_posts_by_cursor(self, count=10, cursor=None, before=False,
+                            tag=None, user_id=None, include_draft=False,
+                            fields=None):
+        """
+        Get the posts next to a cursor, most recent first, for keyset
+        pagination. The query of the index starts at the post of the
+        cursor, so no items are read to skip the previous pages.
+        """
+        key = self.decode_cursor(cursor) if cursor else None
+        before = before and key is not None
+        try:
+            post_ids = self._get_post_ids(count=count, recent=not before,
+                                          tag=tag, user_id=user_id,
+                                          include_draft=include_draft,
+                                          key=key)
+        except Exception as e:
+            self._logger.exception(str(e))
+            post_ids = []
+        if before:
+            post_ids.reverse()
+        return [self.get_post_by_id(p) for p in post_ids]
+
     def _get_post_ids(self, count=10, offset=0, recent=True, tag=None,
-                      user_id=None, include_draft=False):
-        # include_draft is not supported yet
+                      user_id=None, include_draft=False, key=None):
+        # include_draft is only supported as None, for all the posts
         kwargs = dict(ProjectionExpression='post_id',
                       ScanIndexForward=not recent)
         if count:
             kwargs['Limit'] = count
         table = self._blog_posts_table
+        if key is not None:
+            # the key of the post of the cursor in the queried index
+            post_date, post_id = key
+            start_key = {'post_date': self._to_timestamp(post_date),
+                         'post_id': post_id}
         if user_id:
             kwargs.update(
                 dict(IndexName='user_id_index',
                      KeyConditionExpression=Key('user_id').eq(user_id))
             )
-
+            if key is not None:
+                start_key['user_id'] = user_id
         elif tag:
             table = self._tag_posts_table
             norm_tag = self.normalize_tag(tag)
@@ -118,11 +158,45 @@ class DynamoDBStorage(Storage):
                 dict(IndexName='tag_index',
                      KeyConditionExpression=Key('tag').eq(norm_tag))
             )
+            if key is not None:
+                start_key = {'tag': norm_tag,
+                             'post_date': start_key['post_date'],
+                             'tag_id': "%s_%s" % (norm_tag, post_id)}
+        elif include_draft is None:
+            # the published posts and the drafts are two partitions of the
+            # post index, whose posts are merged by date
+            kwargs['ProjectionExpression'] = 'post_id, post_date, draft'
+            if count:
+                # the post of the cursor is read again
+                kwargs['Limit'] = count + (offset or 0) + 1
+            items = []
+            for draft in (0, 1):
+                condition = Key('draft').eq(draft)
+                if key is not None:
+                    post_date = start_key['post_date']
+                    condition &= Key('post_date').lte(post_date) if recent \
+                        else Key('post_date').gte(post_date)
+                items.extend(table.query(IndexName='post_index',
+                                         KeyConditionExpression=condition,
+                                         **kwargs)['Items'])
+            items = sorted(((item['post_date'], item['post_id'])
+                            for item in items), reverse=recent)
+            if key is not None:
+                start = start_key['post_date'], start_key['post_id']
+                items = [item for item in items
+                         if (item < start if recent else item > start)]
+            items = items[offset or 0:]
+            return [p[1] for p in (items[:count] if count else items)]
         else:
             kwargs.update(
                 dict(IndexName='post_index',
                      KeyConditionExpression=Key('draft').eq(0))
             )
+            if key is not None:
+                start_key['draft'] = 0
+        if key is not None:
+            kwargs["ExclusiveStartKey"] = start_key
+            offset = 0
         if offset and offset > 0:
             kwargs2 = copy.deepcopy(kwargs)
             kwargs2['Limit'] = offset
@@ -147,6 +221,72 @@ class DynamoDBStorage(Storage):
             result = 0
         return result
 
+    def get_validator(self, post_id=None, tag=None, user_id=None,
+                      include_draft=False):
+        """
+        Get the latest ``last_modified_date`` and the number of the posts
+        given by filter criteria, or of the post defined by ``post_id``.
+        Only the ``last_modified_date`` of the posts is read, from the
+        indexes of the posts table, or by a batch read of the posts of a
+        tag. A draft has no validator unless ``include_draft`` is set.
+        """
+        try:
+            if post_id is not None:
+                item = self._blog_posts_table.get_item(
+                    Key={'post_id': post_id},
+                    ProjectionExpression='last_modified_date, draft'
+                ).get('Item')
+                items = [item] if item and \
+                    (include_draft or not item['draft']) else []
+            elif tag:
+                post_ids = self._get_post_ids(count=None, tag=tag,
+                                              include_draft=include_draft)
+                items = self._get_items(post_ids, 'last_modified_date')
+            else:
+                if user_id:
+                    kwargs = dict(IndexName='user_id_index',
+                                  KeyConditionExpression=Key(
+                                      'user_id').eq(user_id))
+                else:
+                    kwargs = dict(IndexName='post_index',
+                                  KeyConditionExpression=Key('draft').eq(0))
+                items = self._query_items(
+                    self._blog_posts_table,
+                    ProjectionExpression='last_modified_date', **kwargs)
+            dates = [self._from_timestamp(item['last_modified_date'])
+                     for item in items]
+            result = (max(dates) if dates else None), len(dates)
+        except Exception as e:
+            self._logger.exception(str(e))
+            result = None, 0
+        return result
+
+    @staticmethod
+    def _query_items(table, **kwargs):
+        items = []
+        while True:
+            response = table.query(**kwargs)
+            items.extend(response['Items'])
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return items
+            kwargs['ExclusiveStartKey'] = last_key
+
+    def _get_items(self, post_ids, projection):
+        # batch reads are limited to 100 keys
+        items = []
+        table_name = self._blog_posts_table.name
+        for start in range(0, len(post_ids), 100):
+            request = {table_name: {
+                'Keys': [{'post_id': post_id}
+                         for post_id in post_ids[start:start + 100]],
+                'ProjectionExpression': projection}}
+            while request:
+                response = self._db.batch_get_item(RequestItems=request)
+                items.extend(response['Responses'].get(table_name, []))
+                request = response.get('UnprocessedKeys')
+        return items
+
     def get_post_by_id(self, post_id):
         try:
             response = self._blog_posts_table.get_item(
@@ -154,7 +294,7 @@ class DynamoDBStorage(Storage):
             )
             item = response.get('Item')
             if item:
-                r = item
+                r = Post(item)
                 r['post_date'] = self._from_timestamp(r['post_date'])
                 r['last_modified_date'] = \
                     self._from_timestamp(r['last_modified_date'])
@@ -166,6 +306,26 @@ class DynamoDBStorage(Storage):
             r = None
         return r
 
+    def update_rendered(self, post_id, rendered_text, renderer,
+                        meta_data=None):
+        try:
+            self._blog_posts_table.update_item(
+                Key={'post_id': post_id},
+                UpdateExpression='SET rendered_text = :rendered_text, '
+                                 'renderer = :renderer, '
+                                 'meta_data = :meta_data',
+                ConditionExpression='attribute_exists(post_id)',
+                ExpressionAttributeValues={
+                    ':rendered_text': rendered_text,
+                    ':renderer': renderer,
+                    ':meta_data': meta_data
+                }
+            )
+            return True
+        except Exception as e:
+            self._logger.exception(str(e))
+            return False
+
     def delete_post(self, post_id):
         try:
             r = self.get_post_by_id(post_id)
@@ -5,7 +5,14 @@ try:
     from builtins import object
 except ImportError:
     pass
-from .processor import PostProcessor
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import g, has_app_context
+from .processor import PostProcessor, init_render_worker
+from .post import Post
+from .auth import get_auth_context
+from .rendercache import LRURenderCache, FlaskRenderCache
+from .renderers import Renderer, SandboxedRenderer, get_renderer
 from flask_principal import Principal, Permission, RoleNeed
 from .signals import engine_initialised, post_processed, blueprint_created
 from flask_fileupload import FlaskFileUpload
@@ -62,6 +69,8 @@ class BloggingEngine(object):
         if extensions:
             self.post_processor.set_custom_extensions(extensions)
         self.user_callback = None
+        self.users_callback = None
+        self._render_executor = None
         self.file_upload = file_upload
         if app is not None and storage is not None:
             self.init_app(app, storage)
@@ -94,6 +103,12 @@ class BloggingEngine(object):
         self.file_upload = file_upload or self.file_upload
         self.cache = cache or self.cache
         self._register_plugins(self.app, self.config)
+        self.post_processor.set_renderer(self._create_renderer())
+        self.post_processor.set_render_cache(self._create_render_cache())
+        self.post_processor.set_excerpt_blocks(
+            self.config.get("BLOGGING_EXCERPT_BLOCKS", 3))
+        self.post_processor.set_block_cache(
+            self.config.get("BLOGGING_RENDER_BLOCK_CACHE", False))
 
         from .views import create_blueprint
         blog_app = create_blueprint(__name__, self)
@@ -110,6 +125,25 @@ class BloggingEngine(object):
         if self.config.get("BLOGGING_ALLOW_FILEUPLOAD", True):
             self.ffu = self.file_upload or FlaskFileUpload(app)
 
+    def _create_renderer(self):
+        renderer = self.config.get("BLOGGING_RENDERER", "markdown")
+        if not isinstance(renderer, Renderer):
+            renderer = get_renderer(renderer)
+        timeout = self.config.get("BLOGGING_RENDER_TIMEOUT")
+        if timeout:
+            renderer = SandboxedRenderer(renderer, timeout)
+        return renderer
+
+    def _create_render_cache(self):
+        render_cache = self.config.get("BLOGGING_RENDER_CACHE", "memory")
+        if not render_cache:
+            return None
+        if render_cache == "cache" and self.cache is not None:
+            timeout = self.config.get("BLOGGING_RENDER_CACHE_TIMEOUT")
+            return FlaskRenderCache(self.cache, timeout=timeout)
+        maxsize = self.config.get("BLOGGING_RENDER_CACHE_SIZE", 256)
+        return LRURenderCache(maxsize=maxsize)
+
     @property
     def blogger_permission(self):
         if self._blogger_permission is None:
@@ -131,15 +165,76 @@ class BloggingEngine(object):
         self.user_callback = callback
         return callback
 
+    def users_loader(self, callback):
+        """
+        The decorator for loading several users at once. When it is given,
+        the users of the posts processed together are loaded with one call
+        to the callback, instead of one call to the ``user_loader`` callback
+        for each post.
+
+        :param callback: The callback function that can load the users given
+         a ``set`` of unicode ``user_id``, and returns a ``dict`` of the users
+         by ``user_id``. Users that are not found can be left out.
+        :return: The callback function
+        """
+        self.users_callback = callback
+        return callback
+
+    def load_users(self, user_ids):
+        """
+        Load the users given by ``user_ids``, with one call to the
+        ``users_loader`` callback if there is one, or else with the
+        ``user_loader`` callback for each user. The users are kept in an
+        identity map on ``flask.g``, so each user is loaded at most once per
+        request.
+
+        :param user_ids: The identifiers of the users
+        :type user_ids: iterable
+        :return: A ``dict`` of the users by ``user_id``, with ``None`` for
+         the users that are not found.
+        """
+        users = g.setdefault("blogging_users", {}) if has_app_context() \
+            else {}
+        missing = set(user_ids).difference(users)
+        if missing:
+            if self.users_callback is not None:
+                loaded = self.users_callback(missing) or {}
+                for user_id in missing:
+                    users[user_id] = loaded.get(user_id)
+            else:
+                for user_id in missing:
+                    users[user_id] = self.user_callback(user_id)
+        return dict((user_id, users[user_id]) for user_id in user_ids)
+
+    @property
+    def render_executor(self):
+        """
+        The executor used to render posts in batches, as configured by
+        ``BLOGGING_RENDER_WORKERS`` and ``BLOGGING_RENDER_EXECUTOR``. This is
+        ``None`` if posts are rendered serially.
+        """
+        if self._render_executor is None:
+            workers = self.config.get("BLOGGING_RENDER_WORKERS")
+            if workers:
+                kind = self.config.get("BLOGGING_RENDER_EXECUTOR", "process")
+                if kind == "thread":
+                    self._render_executor = ThreadPoolExecutor(
+                        max_workers=workers)
+                else:
+                    self._render_executor = ProcessPoolExecutor(
+                        max_workers=workers, initializer=init_render_worker,
+                        initargs=self.post_processor.worker_initargs())
+        return self._render_executor
+
     def is_user_blogger(self):
-        return self.blogger_permission.require().can()
+        return get_auth_context(self.blogger_permission).is_blogger
 
     def get_posts(self, count=10, offset=0, recent=True, tag=None,
                   user_id=None, include_draft=False, render=False):
-        posts = self.storage(count, offset, recent, tag, user_id,
-                             include_draft)
-        for post in posts:
-            self.process_post(post, render=False)
+        posts = self.storage.get_posts(count, offset, recent, tag, user_id,
+                                       include_draft)
+        self.process_posts(posts, render=render)
+        return posts
 
     def process_post(self, post, render=True):
         """
@@ -152,15 +247,123 @@ class BloggingEngine(object):
         """
         post_processor = self.post_processor
         post_processor.process(post, render)
-        try:
-            author = self.user_callback(post["user_id"])
-        except Exception:
+        user_ids = (post["user_id"],) if "user_id" in post else ()
+        self._post_processed(post, render, user_ids)
+
+    def process_posts(self, posts, render=True):
+        """
+        Process a list of posts. The Markdown text of the posts is rendered
+        in one batch, which is spread over the ``render_executor`` when it is
+        configured.
+
+        :param posts: The list of posts
+        :type posts: list
+        :param render: Choice if the markdown text has to be converted or
+         not, or ``"excerpt"`` to convert only the excerpt of the text
+        :type render: bool
+        :return:
+        """
+        post_processor = self.post_processor
+        if render:
+            min_batch_size = self.config.get("BLOGGING_RENDER_MIN_BATCH", 4)
+            post_processor.render_many(posts, executor=self.render_executor,
+                                       min_batch_size=min_batch_size,
+                                       excerpt=render == "excerpt")
+        # the users of all the posts are loaded together
+        user_ids = frozenset(post["user_id"] for post in posts
+                             if "user_id" in post)
+        for post in posts:
+            post_processor.process(post, render=False)
+            self._post_processed(post, render, user_ids)
+
+    def rerender_posts(self, batch_size=100, cursor=None, progress=None,
+                       force=False):
+        """
+        Render the text of the stored posts again, for instance after the
+        Markdown extensions changed. The published posts and the drafts are
+        fetched from the storage together, most recent first, in batches of
+        ``batch_size`` given by a cursor, and rendered with the
+        ``render_executor``. Posts saved while the job runs are not visited,
+        as they are rendered by the current renderer. The HTML is stored
+        with the post if it was rendered at save time, or if
+        ``BLOGGING_RENDER_ON_SAVE`` is set, and the render cache is filled
+        along the way. The cached views are cleared when the job is done.
+        This needs an app context.
+
+        :param batch_size: The number of posts fetched and rendered at a
+         time (default 100)
+        :type batch_size: int
+        :param cursor: (Optional) The cursor of the last post done, to
+         resume a previous run from the last cursor passed to ``progress``
+        :type cursor: str
+        :param progress: (Optional) A function called after every batch with
+         the number of posts done in this run, the total number of posts and
+         the cursor of the last post done
+        :type progress: callable
+        :param force: If ``True``, posts rendered by the current renderer
+         version are rendered again too
+        :type force: bool
+        :return: The number of posts rendered
+        """
+        storage = self.storage
+        post_processor = self.post_processor
+        renderer = post_processor.renderer_version()
+        store = self.config.get("BLOGGING_RENDER_ON_SAVE", False)
+        min_batch_size = self.config.get("BLOGGING_RENDER_MIN_BATCH", 4)
+        # include_draft=None selects the published posts and the drafts
+        total = storage.count_posts(include_draft=None)
+        done = rendered = 0
+        while True:
+            posts = storage.get_posts_by_cursor(count=batch_size,
+                                                cursor=cursor,
+                                                include_draft=None)
+            if not posts:
+                break
+            cursor = storage.encode_cursor(posts[-1])
+            done += len(posts)
+            stale = [post for post in posts if force or
+                     not post_processor.is_prerendered(post)]
+            stored = [store or post.get("rendered_text") is not None
+                      for post in stale]
+            for post in stale:
+                post["renderer"] = None
+            post_processor.render_many(stale, executor=self.render_executor,
+                                       min_batch_size=min_batch_size)
+            for post, store_post in zip(stale, stored):
+                if store_post and not post["meta"].get("render_timeout"):
+                    meta_data = storage.derived_meta_data(
+                        post["text"], post.get("meta_data"))
+                    meta_data["meta"] = post["meta"]
+                    storage.update_rendered(post["post_id"],
+                                            post["rendered_text"],
+                                            renderer, meta_data)
+            rendered += len(stale)
+            if progress is not None:
+                progress(done, total, cursor)
+            if len(posts) < batch_size:
+                break
+        if rendered and self.cache is not None:
+            from .views import _clear_cache
+            _clear_cache(self.cache)
+        return rendered
+
+    def _post_processed(self, post, render, user_ids):
+        if self.user_callback is None and self.users_callback is None:
             raise Exception("No user_loader has been installed for this "
                             "BloggingEngine. Add one with the "
                             "'BloggingEngine.user_loader' decorator.")
+        set_user_name = functools.partial(self._set_user_name,
+                                          user_ids=user_ids)
+        if isinstance(post, Post):
+            post.defer("user_name", set_user_name)
+        else:
+            set_user_name(post)
+        post_processed.send(self.app, engine=self, post=post, render=render)
+
+    def _set_user_name(self, post, user_ids):
+        author = self.load_users(user_ids)[post["user_id"]]
         if author is not None:
             post["user_name"] = self.get_user_name(author)
-        post_processed.send(self.app, engine=self, post=post, render=render)
 
     @classmethod
     def get_user_name(cls, user):
@@ -1,5 +1,6 @@
 import logging
 from .storage import Storage
+from .post import Post
 from google.cloud import datastore
 import datetime
 from shortuuid import ShortUUID
@@ -41,7 +42,8 @@ class GoogleCloudDatastore(Storage):
 
     def save_post(self, title, text, user_id, tags, draft=False,
                   post_date=None, last_modified_date=None, meta_data=None,
-                  post_id=None):
+                  post_id=None, rendered_text=None, renderer=None,
+                  slug=None):
         if post_id is not None:
             update_op = True
         else:
@@ -53,12 +55,15 @@ class GoogleCloudDatastore(Storage):
         last_modified_date = last_modified_date or current_datetime
         tags = self.normalize_tags(tags)
         draft = True if draft else False
+        meta_data = self.derived_meta_data(text, meta_data)
 
         if not update_op:
             key = self._client.key('Post', int(post_id))
-            post = datastore.Entity(key=key, exclude_from_indexes=['text'])
+            post = datastore.Entity(
+                key=key, exclude_from_indexes=['text', 'rendered_text'])
             post.update({
                     'title': title,
+                    'slug': slug,
                     'text': text,
                     'user_id': user_id,
                     'tags': tags or [],
@@ -66,6 +71,8 @@ class GoogleCloudDatastore(Storage):
                     'post_date': post_date,
                     'last_modified_date': last_modified_date,
                     'meta_data': meta_data,
+                    'rendered_text': rendered_text,
+                    'renderer': renderer,
                     'post_id': int(post_id)
             })
             self._client.put(post)
@@ -76,9 +83,14 @@ class GoogleCloudDatastore(Storage):
             if not post:
                 post_id = self._get_new_post_id()
                 key = self._client.key('Post', int(post_id))
-                post = datastore.Entity(key=key, exclude_from_indexes=['text'])
+                post = datastore.Entity(
+                    key=key, exclude_from_indexes=['text', 'rendered_text'])
+            else:
+                # entities saved by older versions only exclude ``text``
+                post.exclude_from_indexes.add('rendered_text')
             post.update({
                     'title': title,
+                    'slug': slug,
                     'text': text,
                     'user_id': user_id,
                     'tags': tags or [],
@@ -86,6 +98,8 @@ class GoogleCloudDatastore(Storage):
                     'post_date': post_date,
                     'last_modified_date': last_modified_date,
                     'meta_data': meta_data,
+                    'rendered_text': rendered_text,
+                    'renderer': renderer,
                     'post_id': int(post_id)
             })
             self._client.put(post)
@@ -139,7 +153,7 @@ class GoogleCloudDatastore(Storage):
 
         res = []
         for post in posts:
-            p = dict(post)
+            p = Post(post)
             res.append(p)
 
         if tag and recent:
@@ -168,6 +182,55 @@ class GoogleCloudDatastore(Storage):
 
         return result
 
+    def get_validator(self, post_id=None, tag=None, user_id=None,
+                      include_draft=False):
+        """
+        Get the latest ``last_modified_date`` and the number of the posts
+        given by filter criteria, or of the post defined by ``post_id``.
+        The latest date comes from a projection query, and the number from
+        a count aggregation run by the server, so the posts are not read.
+        The projection queries need the composite indexes listed in the
+        docs. A draft has no validator unless ``include_draft`` is set.
+        """
+        try:
+            if post_id is not None:
+                post = self._client.get(
+                    self._client.key('Post', int(post_id)))
+                if not post or (post['draft'] and not include_draft):
+                    return None, 0
+                return post['last_modified_date'], 1
+            query = self._get_validator_query(tag, user_id, include_draft)
+            query.projection = ['last_modified_date']
+            query.order = ['-last_modified_date']
+            latest = list(query.fetch(limit=1))
+            if not latest:
+                return None, 0
+            count = self._count(
+                self._get_validator_query(tag, user_id, include_draft))
+            return latest[0]['last_modified_date'], count
+        except Exception as e:
+            # such as a missing composite index
+            self._logger.exception(str(e))
+            return None, 0
+
+    def _get_validator_query(self, tag, user_id, include_draft):
+        query = self._client.query(kind='Post')
+        query.add_filter('draft', '=', bool(include_draft))
+        if tag:
+            query.add_filter('tags', '=', self.normalize_tag(tag))
+        if user_id:
+            query.add_filter('user_id', '=', user_id)
+        return query
+
+    def _count(self, query):
+        if hasattr(self._client, 'aggregation_query'):
+            aggregation = self._client.aggregation_query(query).count()
+            return sum(result.value for results in aggregation.fetch()
+                       for result in results)
+        # older clients have no aggregation queries, and read every key
+        query.keys_only()
+        return len(list(query.fetch()))
+
     def get_post_by_id(self, post_id):
         if post_id:
             query = self._client.query(kind='Post')
@@ -175,11 +238,26 @@ class GoogleCloudDatastore(Storage):
             post = list(query.fetch())
 
             if post:
-                res = dict(post[0])
+                res = Post(post[0])
                 return res
 
         return None
 
+    def update_rendered(self, post_id, rendered_text, renderer,
+                        meta_data=None):
+        key = self._client.key('Post', int(post_id))
+        post = self._client.get(key)
+        if not post:
+            return False
+        post.exclude_from_indexes.add('rendered_text')
+        post.update({
+                'rendered_text': rendered_text,
+                'renderer': renderer,
+                'meta_data': meta_data
+        })
+        self._client.put(post)
+        return True
+
     def delete_post(self, post_id):
         if post_id:
             key = self._client.key('Post', int(post_id))
@@ -0,0 +1,170 @@
+"""
+The ``Post`` record returned by the storages, whose derived fields can be
+computed lazily on first access.
+"""
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+class Post(MutableMapping):
+    """
+    A blog post. The post is a compact record that holds the common fields
+    of a post in slots, and supports the ``dict`` interface, so templates and
+    plugins access it as before. Keys other than the ``FIELDS`` are kept in
+    a ``dict`` that is only created when such a key is set.
+
+    The values of some keys can be deferred with ``defer``. A deferred value
+    is computed when the key is first accessed, for instance from a template
+    or a signal receiver, so values that are never used are never computed.
+    Iterating over the post computes all the deferred values.
+
+    Unlike a ``dict``, the post is not serialisable by ``json.dumps``. Use
+    ``dict(post)`` to get a plain ``dict`` of the post.
+    """
+
+    FIELDS = ("post_id", "title", "text", "post_date", "last_modified_date",
+              "draft", "user_id", "tags", "slug", "rendered_text", "renderer",
+              "meta_data", "meta", "url", "editable", "priority", "user_name",
+              "word_count", "reading_time", "headings", "first_image")
+
+    # the values are held in private slots, so that attribute lookups, such
+    # as ``post.url`` in templates, fall back to the mapping and resolve
+    # deferred values
+    _slot_names = dict((key, "_v_" + key) for key in FIELDS)
+
+    __slots__ = tuple("_v_" + key for key in FIELDS) + ("_extra", "_deferred")
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self._deferred = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def defer(self, keys, func):
+        """
+        Defer setting the ``keys`` of the post until one of them is first
+        accessed. The ``func`` is then called once with the post, and is
+        expected to set the ``keys``. While ``func`` runs, the values the
+        post held before the call to ``defer``, if any, are visible.
+
+        :param keys: The key, or a tuple of keys, set by ``func``
+        :type keys: str or tuple
+        :param func: A function taking the post as argument
+        :type func: callable
+        """
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        if self._deferred is None:
+            self._deferred = {}
+        entry = (keys, func)
+        for key in keys:
+            self._deferred[key] = entry
+
+    def is_deferred(self, key):
+        return bool(self._deferred) and key in self._deferred
+
+    def resolve(self, keys=None):
+        """
+        Compute the deferred values of the ``keys``, or of all the deferred
+        keys if ``keys`` is ``None``.
+
+        :return: The post
+        """
+        if self._deferred:
+            keys = list(self._deferred) if keys is None else keys
+            for key in keys:
+                if key in self._deferred:
+                    self._resolve(key)
+        return self
+
+    def _resolve(self, key):
+        entry = self._deferred[key]
+        keys, func = entry
+        # values set explicitly after the call to ``defer`` are kept
+        explicit = {}
+        for k in keys:
+            if self._deferred.get(k) is entry:
+                del self._deferred[k]
+            elif self._has(k):
+                explicit[k] = self._get(k)
+        func(self)
+        for k, value in explicit.items():
+            self._set(k, value)
+
+    def _has(self, key):
+        slot = self._slot_names.get(key)
+        if slot is not None:
+            return hasattr(self, slot)
+        return self._extra is not None and key in self._extra
+
+    def _get(self, key):
+        slot = self._slot_names.get(key)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def _set(self, key, value):
+        slot = self._slot_names.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __getitem__(self, key):
+        if self._deferred and key in self._deferred:
+            self._resolve(key)
+        return self._get(key)
+
+    def __setitem__(self, key, value):
+        if self._deferred:
+            self._deferred.pop(key, None)
+        self._set(key, value)
+
+    def __delitem__(self, key):
+        deferred = self._deferred.pop(key, None) if self._deferred else None
+        if not self._has(key):
+            if deferred is not None:
+                return
+            raise KeyError(key)
+        slot = self._slot_names.get(key)
+        if slot is not None:
+            delattr(self, slot)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        return self.is_deferred(key) or self._has(key)
+
+    def __iter__(self):
+        self.resolve()
+        for key in self.FIELDS:
+            if hasattr(self, self._slot_names[key]):
+                yield key
+        if self._extra:
+            for key in list(self._extra):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        # deferred functions are often closures, so pickle the values
+        return self.__class__, (dict(self),)
+
+    def __repr__(self):
+        values = dict((key, self._get(key)) for key in self.FIELDS
+                      if self._has(key))
+        values.update(self._extra or {})
+        return "%s(%r, deferred=%r)" % (self.__class__.__name__, values,
+                                        sorted(self._deferred or ()))
@@ -1,13 +1,24 @@
 import re
+import copy
+import hashlib
+import threading
+from functools import lru_cache
 try:
     from builtins import object
 except ImportError:
     pass
 import markdown
-from markdown.extensions.meta import MetaExtension
+from markdown.extensions.meta import MetaExtension, META_RE, BEGIN_RE
+from markdown.extensions.codehilite import CodeHilite, \
+    CodeHiliteExtension, HiliteTreeprocessor
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
 from flask import url_for
-from flask_login import current_user
+from .auth import get_auth_context
 from slugify import slugify
+from .post import Post
+from .utils import text_metadata
+from .renderers import PythonMarkdownRenderer, image_details, \
+    html_image_details
 
 
 class MathJaxPattern(markdown.inlinepatterns.Pattern):
@@ -34,30 +45,674 @@ def makeExtension(configs=[]):
     return MathJaxExtension(configs)
 
 
+_IMG_SRC_RE = re.compile(r'<\s*img [^>]*src="([^"]+)')
+_PLACEHOLDER_RE = re.compile(markdown.util.HTML_PLACEHOLDER % r'(\d+)')
+
+
+class ImageTreeprocessor(markdown.treeprocessors.Treeprocessor):
+    """
+    Collects the images of the document in ``md.images``, in document order,
+    as dicts with the ``src`` and, when given, the ``alt``, ``width`` and
+    ``height`` of each image. Images in raw HTML are found in the HTML stash.
+    """
+
+    def run(self, root):
+        self.md.images = []
+        self._walk(root)
+
+    def _walk(self, element):
+        if element.tag == "img":
+            self._add_image(image_details(element.attrib))
+        self._scan_text(element.text)
+        for child in element:
+            self._walk(child)
+            self._scan_text(child.tail)
+
+    def _scan_text(self, text):
+        if not text or markdown.util.STX not in text:
+            return
+        raw_blocks = self.md.htmlStash.rawHtmlBlocks
+        for match in _PLACEHOLDER_RE.finditer(text):
+            index = int(match.group(1))
+            if index >= len(raw_blocks):
+                continue
+            self.md.images.extend(
+                html_image_details(str(raw_blocks[index])))
+
+    def _add_image(self, details):
+        if details is not None:
+            self.md.images.append(details)
+
+
+class ImageExtension(markdown.Extension):
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        self.md = md
+        md.images = []
+        # run after the inline patterns have created the img elements
+        md.treeprocessors.register(ImageTreeprocessor(md), "images", 5)
+
+    def reset(self):
+        self.md.images = []
+
+
+def _code_cache_key(*parts):
+    key = hashlib.sha1(repr(parts).encode("utf-8"))
+    return "code:" + key.hexdigest()
+
+
+def _pygments_version():
+    try:
+        import pygments
+    except ImportError:
+        return None
+    return pygments.__version__
+
+
+class CachedHiliteTreeprocessor(HiliteTreeprocessor):
+    """
+    Highlights the indented code blocks like the ``codehilite`` extension,
+    using the highlighted HTML cached for the same code and options.
+    """
+
+    def __init__(self, md, post_processor):
+        HiliteTreeprocessor.__init__(self, md)
+        self.post_processor = post_processor
+
+    def run(self, root):
+        cache = self.post_processor._render_cache
+        if cache is None:
+            return HiliteTreeprocessor.run(self, root)
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                src = self.code_unescape(block[0].text)
+                key = _code_cache_key(
+                    "hilite", sorted(self.config.items()), self.md.tab_length,
+                    _pygments_version(), src)
+                html = cache.get(key)
+                if html is None:
+                    local_config = self.config.copy()
+                    code = CodeHilite(
+                        src, tab_length=self.md.tab_length,
+                        style=local_config.pop('pygments_style', 'default'),
+                        **local_config)
+                    html = code.hilite()
+                    cache.set(key, html)
+                block.clear()
+                block.tag = 'p'
+                block.text = self.md.htmlStash.store(html)
+
+
+class CachedFencedBlockPreprocessor(FencedBlockPreprocessor):
+    """
+    Converts the fenced code blocks like the ``fenced_code`` extension,
+    using the HTML cached for the same fence, code and options. The fences
+    are converted one at a time by the ``FencedBlockPreprocessor``, so
+    that its handling of the language and attributes is kept.
+    """
+
+    def __init__(self, md, config, post_processor):
+        FencedBlockPreprocessor.__init__(self, md, config)
+        self.post_processor = post_processor
+
+    def run(self, lines):
+        cache = self.post_processor._render_cache
+        if cache is None:
+            return FencedBlockPreprocessor.run(self, lines)
+        text = "\n".join(lines)
+        hilite_config = [sorted(ext.getConfigs().items())
+                         for ext in self.md.registeredExtensions
+                         if isinstance(ext, CodeHiliteExtension)]
+        parts = []
+        start = 0
+        for match in self.FENCED_BLOCK_RE.finditer(text):
+            header = text[match.start():match.start('code')]
+            key = _code_cache_key(
+                "fenced", header, sorted(self.config.items()), hilite_config,
+                _pygments_version(), match.group('code'))
+            html = cache.get(key)
+            if html is None:
+                lines = FencedBlockPreprocessor.run(
+                    self, match.group(0).split("\n"))
+                cache.set(key, self.md.htmlStash.rawHtmlBlocks[-1])
+            else:
+                lines = ["", self.md.htmlStash.store(html), ""]
+            parts.append(text[start:match.start()])
+            parts.append("\n".join(lines))
+            start = match.end()
+        parts.append(text[start:])
+        return "".join(parts).split("\n")
+
+
+class CodeCacheExtension(markdown.Extension):
+    """
+    Caches the HTML of the code blocks in the render cache of the
+    ``PostProcessor``, so that the code shared by posts, or left unchanged
+    by an edit, is not highlighted again. It replaces the processors of the
+    ``codehilite`` and ``fenced_code`` extensions, when these are used.
+    """
+
+    def __init__(self, post_processor, **kwargs):
+        self.post_processor = post_processor
+        markdown.Extension.__init__(self, **kwargs)
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        # same names and priorities as the processors they replace
+        if "hilite" in md.treeprocessors:
+            hiliter = CachedHiliteTreeprocessor(md, self.post_processor)
+            hiliter.config = md.treeprocessors["hilite"].config
+            md.treeprocessors.register(hiliter, "hilite", 30)
+        if "fenced_code_block" in md.preprocessors:
+            fenced = CachedFencedBlockPreprocessor(
+                md, md.preprocessors["fenced_code_block"].config,
+                self.post_processor)
+            md.preprocessors.register(fenced, "fenced_code_block", 25)
+
+
+_FENCE_RE = re.compile(r'^[ ]{0,3}(`{3,}|~{3,})')
+_LIST_ITEM_RE = re.compile(r'^[ ]{0,3}([*+-]|\d+\.)[ \t]')
+_BLOCKQUOTE_RE = re.compile(r'^[ ]{0,3}>')
+_REFERENCE_RE = markdown.blockprocessors.ReferenceProcessor.RE
+
+
+def split_blocks(text):
+    """
+    Split Markdown text into its top level blocks. Blocks are separated by
+    blank lines, except inside fenced code. Lists, block quotes and indented
+    code blocks that span blank lines are kept in one block.
+
+    :param text: The Markdown text
+    :type text: str
+    :return: A list of the blocks
+    """
+    blocks = []
+    lines = []
+    fence = None
+    for line in text.splitlines():
+        match = _FENCE_RE.match(line)
+        if fence is not None:
+            if match and match.group(1)[0] == fence[0] and \
+                    len(match.group(1)) >= len(fence):
+                fence = None
+        elif match:
+            fence = match.group(1)
+        if fence is None and not line.strip():
+            if lines:
+                blocks.append(lines)
+                lines = []
+            continue
+        if not lines and blocks and _continues_block(line, blocks[-1][0]):
+            lines = blocks.pop()
+            lines.append("")
+        lines.append(line)
+    if lines:
+        blocks.append(lines)
+    return ["\n".join(block) for block in blocks]
+
+
+def _continues_block(line, previous_first_line):
+    # indented lines continue a list or an indented code block, list items
+    # continue a list and quoted lines continue a block quote across blank
+    # lines
+    previous_is_list = bool(_LIST_ITEM_RE.match(previous_first_line))
+    if _BLOCKQUOTE_RE.match(line) and \
+            _BLOCKQUOTE_RE.match(previous_first_line):
+        return True
+    if line[:1] in (" ", "\t"):
+        return previous_is_list or previous_first_line[:1] in (" ", "\t")
+    return previous_is_list and bool(_LIST_ITEM_RE.match(line))
+
+
+def _is_code_block(block):
+    return block[:1] in (" ", "\t") or bool(_FENCE_RE.match(block))
+
+
+def _is_meta_block(block):
+    first_line = block.split("\n", 1)[0]
+    return bool(META_RE.match(first_line) or BEGIN_RE.match(first_line))
+
+
+def _convert_markdown(post_processor, text):
+    # module level, so that it can be sent to a process pool
+    return post_processor.convert_uncached(text)
+
+
+def init_render_worker(post_processor, extensions, renderer):
+    """
+    Set up the Markdown extensions and the renderer of the
+    ``post_processor`` class in a worker process of a process pool, as
+    returned by ``PostProcessor.worker_initargs``. Workers that were not
+    forked, as on platforms that spawn them, otherwise only have the
+    default extensions.
+    """
+    post_processor._markdown_extensions = extensions
+    post_processor.set_renderer(renderer)
+
+
+_python_markdown = PythonMarkdownRenderer()
+
+
 class PostProcessor(object):
 
     _markdown_extensions = [MathJaxExtension(), MetaExtension()]
+    _render_cache = None
+    _markdown_local = threading.local()
+    _excerpt_blocks = 3
+    _block_cache = False
+    _renderer = _python_markdown
+    # the extensions and fingerprints, by class, computed once for the
+    # current extensions and renderer
+    _derived_config = {}
+    # extensions whose output for a block does not depend on the rest of the
+    # text, see ``convert_blocks``
+    block_safe_extensions = set([
+        "flask_blogging.processor.MathJaxExtension",
+        "flask_blogging.processor.ImageExtension",
+        "flask_blogging.processor.CodeCacheExtension",
+        "markdown.extensions.meta.MetaExtension",
+        "markdown.extensions.attr_list.AttrListExtension",
+        "markdown.extensions.codehilite.CodeHiliteExtension",
+        "markdown.extensions.fenced_code.FencedCodeExtension",
+        "markdown.extensions.nl2br.Nl2BrExtension",
+        "markdown.extensions.sane_lists.SaneListExtension",
+        "markdown.extensions.smarty.SmartyExtension",
+        "markdown.extensions.tables.TableExtension",
+        "markdown.extensions.wikilinks.WikiLinkExtension",
+    ])
+    excerpt_marker = "<!--more-->"
 
     @staticmethod
+    @lru_cache(maxsize=1024)
     def create_slug(title):
         return slugify(title)
 
+    @classmethod
+    def get_slug(cls, post):
+        """
+        Get the slug stored with the post, or create one from the title for
+        posts saved without a slug.
+        """
+        return post.get("slug") or cls.create_slug(post["title"])
+
     @staticmethod
     def extract_images(post):
-        regex = re.compile(r'<\s*img [^>]*src="([^"]+)')
-        return regex.findall(post["rendered_text"])
+        return _IMG_SRC_RE.findall(post["rendered_text"])
 
     @classmethod
     def construct_url(cls, post):
         url = url_for("blogging.page_by_id", post_id=post["post_id"],
-                      slug=cls.create_slug(post["title"]))
+                      slug=cls.get_slug(post))
         return url
 
     @classmethod
     def render_text(cls, post):
-        md = markdown.Markdown(extensions=cls.all_extensions())
-        post["rendered_text"] = md.convert(post["text"])
-        post["meta"] = md.Meta
+        post["rendered_text"], post["meta"] = cls.convert(post["text"])
+
+    @classmethod
+    def convert(cls, text):
+        """
+        Convert the Markdown ``text`` to HTML. If a render cache is set, the
+        result is looked up by the hash of the text and the active extensions
+        before running the Markdown pipeline.
+
+        :param text: The Markdown text
+        :type text: str
+        :return: A tuple of the rendered HTML and the Markdown metadata
+        """
+        key, cached = cls._get_cached(text)
+        if cached is not None:
+            return cached
+        rendered_text, meta = cls.convert_uncached(text)
+        cls._set_cached(key, rendered_text, meta)
+        return rendered_text, meta
+
+    @classmethod
+    def convert_uncached(cls, text):
+        """
+        Convert the Markdown ``text`` to HTML without looking up the whole
+        text in the render cache. This uses ``convert_blocks`` if the block
+        cache is enabled, and ``convert_markdown`` otherwise.
+        """
+        if cls._block_cache and cls._render_cache is not None:
+            return cls.convert_blocks(text)
+        return cls.convert_markdown(text)
+
+    @classmethod
+    def convert_markdown(cls, text):
+        """
+        Convert the Markdown ``text`` to HTML with the renderer, bypassing the
+        render cache. The images of the text are collected while the document
+        is built, and added to the metadata as ``images``, the list of the
+        image sources, and ``image_details``, the list of dicts with the
+        ``src``, ``alt``, ``width`` and ``height`` of the images.
+
+        :param text: The Markdown text
+        :type text: str
+        :return: A tuple of the rendered HTML and the Markdown metadata
+        """
+        return cls._renderer.convert(cls, text)
+
+    @classmethod
+    def convert_blocks(cls, text):
+        """
+        Convert the Markdown ``text`` to HTML one top level block at a time,
+        reusing the HTML of the blocks found in the render cache. When a post
+        is edited, only the changed blocks are converted again. Every block
+        is converted along with the reference definitions of the whole text,
+        and only the first block is parsed for metadata, so the result is the
+        same as for ``convert_markdown``.
+
+        The whole text is converted with ``convert_markdown`` if it has raw
+        HTML blocks, whose extent is not known until they are parsed, or if
+        any of the active extensions is not in ``block_safe_extensions``.
+
+        :param text: The Markdown text
+        :type text: str
+        :return: A tuple of the rendered HTML and the Markdown metadata
+        """
+        blocks = split_blocks(text)
+        if cls._render_cache is None or not cls._blocks_safe(blocks):
+            return cls.convert_markdown(text)
+        references = "\n\n".join(
+            match.group(0) for block in blocks if not _is_code_block(block)
+            for match in _REFERENCE_RE.finditer(block))
+        parts = []
+        meta = {}
+        images = []
+        timed_out = False
+        for index, block in enumerate(blocks):
+            # a blank first line stops the parsing of metadata
+            source = block if index == 0 else "\n" + block
+            if references:
+                source += "\n\n" + references
+            # blocks are keyed by their full source, so that a cached
+            # document with the same source is reused as well
+            key = cls.cache_key(source)
+            rendered = cls._render_cache.get(key)
+            if rendered is None:
+                rendered = cls.convert_markdown(source)
+                if not rendered[1].get("render_timeout"):
+                    cls._render_cache.set(key, rendered)
+            block_html, block_meta = rendered
+            if block_html:
+                parts.append(block_html)
+            if index == 0:
+                meta = dict((k, v) for k, v in block_meta.items()
+                            if k not in ("images", "image_details"))
+            images.extend(block_meta.get("image_details", []))
+            timed_out = timed_out or block_meta.get("render_timeout", False)
+        meta = copy.deepcopy(meta)
+        if timed_out:
+            meta["render_timeout"] = True
+        meta["images"] = [image["src"] for image in images]
+        meta["image_details"] = copy.deepcopy(images)
+        return "\n".join(parts), meta
+
+    @classmethod
+    def _blocks_safe(cls, blocks):
+        for block in blocks:
+            if block.lstrip()[:1] == "<":
+                return False
+        return cls._renderer.block_safe(cls)
+
+    @classmethod
+    def set_renderer(cls, renderer):
+        """
+        Set the renderer that converts Markdown to HTML, such as one of the
+        renderers in ``flask_blogging.renderers``. Pass ``None`` to use the
+        default ``PythonMarkdownRenderer``.
+
+        :param renderer: The renderer object
+        :type renderer: flask_blogging.renderers.Renderer
+        """
+        cls._renderer = renderer if renderer is not None \
+            else _python_markdown
+        cls._derived_config.clear()
+
+    @classmethod
+    def _get_derived_config(cls, name, func):
+        config = cls._derived_config.setdefault(cls, {})
+        if name not in config:
+            config[name] = func()
+        return config[name]
+
+    @classmethod
+    def worker_initargs(cls):
+        """
+        The arguments of ``init_render_worker`` for this class, to use as the
+        ``initargs`` of a ``ProcessPoolExecutor`` that renders posts with
+        ``render_many``.
+        """
+        return cls, list(cls._markdown_extensions), cls._renderer
+
+    @classmethod
+    def set_block_cache(cls, enabled):
+        """
+        Enable or disable the rendering of posts block by block with
+        ``convert_blocks``. The HTML of the blocks is kept in the render
+        cache, so this has no effect without a render cache.
+
+        :param enabled: ``True`` to enable the block cache
+        :type enabled: bool
+        """
+        cls._block_cache = enabled
+
+    @classmethod
+    def _get_cached(cls, text):
+        cache = cls._render_cache
+        if cache is None:
+            return None, None
+        key = cls.cache_key(text)
+        cached = cache.get(key)
+        if cached is not None:
+            rendered_text, meta = cached
+            cached = rendered_text, copy.deepcopy(meta)
+        return key, cached
+
+    @classmethod
+    def _set_cached(cls, key, rendered_text, meta):
+        # the plain text shown for a timed out render is not kept, so that
+        # the text is rendered again on the next request
+        if key is not None and not meta.get("render_timeout"):
+            cls._render_cache.set(key, (rendered_text, copy.deepcopy(meta)))
+
+    @classmethod
+    def excerpt_text(cls, text):
+        """
+        Get the Markdown of the excerpt of the ``text``. This is the text
+        before the ``excerpt_marker`` if the text has one, or else the first
+        few top level blocks of the text. Markdown metadata at the start of
+        the text is kept, and does not count as a block.
+
+        :param text: The Markdown text
+        :type text: str
+        :return: A tuple of the excerpt and a flag that is ``True`` if the
+         text was truncated.
+        """
+        if cls.excerpt_marker in text:
+            return text.split(cls.excerpt_marker, 1)[0], True
+        blocks = split_blocks(text)
+        count = cls._excerpt_blocks
+        if blocks and _is_meta_block(blocks[0]):
+            count += 1
+        if len(blocks) <= count:
+            return text, False
+        return "\n\n".join(blocks[:count]), True
+
+    @classmethod
+    def render_excerpt(cls, post):
+        """
+        Render the excerpt of the post. The HTML is set as both ``excerpt``
+        and ``rendered_text``, and ``more`` tells if the text was truncated.
+        """
+        text, post["more"] = cls.excerpt_text(post["text"])
+        post["rendered_text"], post["meta"] = cls.convert(text)
+        post["excerpt"] = post["rendered_text"]
+
+    @classmethod
+    def set_excerpt_blocks(cls, blocks):
+        """
+        Set the number of top level blocks in the excerpt of posts without
+        an ``excerpt_marker``.
+
+        :param blocks: The number of blocks
+        :type blocks: int
+        """
+        cls._excerpt_blocks = blocks
+
+    @classmethod
+    def render_many(cls, posts, executor=None, min_batch_size=4,
+                    excerpt=False):
+        """
+        Render the text of several posts. Posts that were rendered at save
+        time or are found in the render cache are not converted again. The
+        remaining conversions are fanned out to the ``executor`` if there are
+        at least ``min_batch_size`` of them, and run serially otherwise.
+
+        :param posts: The list of posts to render
+        :type posts: list
+        :param executor: (Optional) A ``concurrent.futures.Executor`` to run
+         the conversions. A ``ProcessPoolExecutor`` needs the
+         ``init_render_worker`` initializer with the ``worker_initargs``, so
+         that the workers use the same extensions and renderer.
+        :type executor: object
+        :param min_batch_size: The smallest number of conversions for which
+         the ``executor`` is used (default 4)
+        :type min_batch_size: int
+        :param excerpt: If ``True``, only the excerpts of the posts are
+         rendered, as in ``render_excerpt``.
+        :type excerpt: bool
+        """
+        pending = []
+        texts = []
+        for post in posts:
+            if excerpt:
+                text, post["more"] = cls.excerpt_text(post["text"])
+            elif cls.is_prerendered(post):
+                cls.render_post(post)
+                continue
+            else:
+                text = post["text"]
+            key, cached = cls._get_cached(text)
+            if cached is not None:
+                cls._set_rendered(post, cached, excerpt)
+            else:
+                pending.append((key, post))
+                texts.append(text)
+        if executor is not None and len(pending) >= min_batch_size:
+            results = executor.map(_convert_markdown,
+                                   [cls] * len(texts), texts)
+        else:
+            results = (cls.convert_uncached(text) for text in texts)
+        for (key, post), (rendered_text, meta) in zip(pending, results):
+            cls._set_cached(key, rendered_text, meta)
+            cls._set_rendered(post, (rendered_text, meta), excerpt)
+
+    @classmethod
+    def _set_rendered(cls, post, rendered, excerpt):
+        post["rendered_text"], post["meta"] = rendered
+        if excerpt:
+            post["excerpt"] = post["rendered_text"]
+
+    @classmethod
+    def get_markdown(cls):
+        """
+        Get a ``markdown.Markdown`` instance for the active extensions, ready
+        to convert a new text. Instances are built once per thread and
+        extension set, and are reused after a ``reset()``.
+        """
+        instances = getattr(cls._markdown_local, "instances", None)
+        if instances is None:
+            instances = cls._markdown_local.instances = {}
+        key = (cls, cls._get_derived_config(
+            "markdown_fingerprint",
+            lambda: _python_markdown.fingerprint(cls)))
+        md = instances.get(key)
+        if md is None:
+            # drop the instances built for a previous set of extensions
+            for stale_key in [k for k in instances if k[0] is cls]:
+                del instances[stale_key]
+            # extensions such as MetaExtension keep a reference to the
+            # Markdown instance they were added to, so each instance gets its
+            # own shallow copy of the extension objects.
+            extensions = [copy.copy(e) for e in cls.markdown_extensions()]
+            md = instances[key] = markdown.Markdown(extensions=extensions)
+        else:
+            md.reset()
+        return md
+
+    @classmethod
+    def cache_key(cls, text):
+        key = hashlib.sha1(cls.fingerprint().encode("utf-8"))
+        key.update(text.encode("utf-8"))
+        return key.hexdigest()
+
+    @classmethod
+    def fingerprint(cls):
+        """
+        A string that identifies the renderer and its configuration. For the
+        default renderer, this is the Markdown version, the active set of
+        Markdown extensions, their configuration and the versions of the
+        packages that provide them. Rendered output is only reusable for the
+        same fingerprint. It is computed once, until the extensions or the
+        renderer change.
+        """
+        return cls._get_derived_config(
+            "fingerprint", lambda: cls._renderer.fingerprint(cls))
+
+    @classmethod
+    def renderer_version(cls):
+        """
+        A short version string derived from the ``fingerprint``, which is
+        stored along with HTML rendered at save time.
+        """
+        return cls._get_derived_config(
+            "renderer_version", lambda: hashlib.sha1(
+                cls.fingerprint().encode("utf-8")).hexdigest())
+
+    @classmethod
+    def set_render_cache(cls, cache):
+        """
+        Set the cache used to memoize rendered Markdown. The cache object
+        must implement ``get(key)`` and ``set(key, value)``, like the
+        backends in ``flask_blogging.rendercache``. Pass ``None`` to disable
+        the render cache.
+
+        :param cache: The render cache object
+        :type cache: object
+        """
+        cls._render_cache = cache
+
+    @classmethod
+    def get_fragment(cls, key):
+        """
+        Get a fragment of markup kept in the render cache with
+        ``set_fragment``, such as the XML of a feed entry.
+
+        :param key: The key of the fragment
+        :type key: str
+        :return: The fragment, or ``None`` if it is not cached or there is
+         no render cache.
+        """
+        if cls._render_cache is None:
+            return None
+        return cls._render_cache.get("fragment:" + key)
+
+    @classmethod
+    def set_fragment(cls, key, fragment):
+        """
+        Keep a fragment of markup in the render cache. The ``key`` should
+        change with anything the fragment was generated from, as the
+        fragments are not cleared.
+
+        :param key: The key of the fragment
+        :type key: str
+        :param fragment: The fragment
+        :type fragment: object
+        """
+        if cls._render_cache is not None:
+            cls._render_cache.set("fragment:" + key, fragment)
 
     @classmethod
     def is_author(cls, post, user):
@@ -66,24 +721,117 @@ class PostProcessor(object):
     @classmethod
     def process(cls, post, render=True):
         """
-        This method takes the post data and renders it
+        This method takes the post data and renders it. For a ``Post``, the
+        derived fields are deferred until they are first accessed.
         :param post:
-        :param render:
+        :param render: ``True`` to render the text, ``"excerpt"`` to render
+         only the excerpt of the text, or ``False`` to skip rendering.
         :return:
         """
-        post["slug"] = cls.create_slug(post["title"])
-        post["editable"] = cls.is_author(post, current_user)
-        post["url"] = cls.construct_url(post)
         post["priority"] = 0.8
-        if render:
+        setters = [("slug", cls._set_slug), ("editable", cls._set_editable),
+                   ("url", cls._set_url),
+                   (cls.derived_keys, cls._set_derived)]
+        if render == "excerpt":
+            setters.append((("rendered_text", "meta", "excerpt", "more"),
+                            cls.render_excerpt))
+        elif render:
+            setters.append((("rendered_text", "meta"), cls.render_post))
+        for keys, setter in setters:
+            if isinstance(post, Post):
+                post.defer(keys, setter)
+            else:
+                setter(post)
+
+    @classmethod
+    def _set_slug(cls, post):
+        post["slug"] = cls.get_slug(post)
+
+    @classmethod
+    def _set_editable(cls, post):
+        post["editable"] = cls.is_author(post, get_auth_context().user)
+
+    @classmethod
+    def _set_url(cls, post):
+        post["url"] = cls.construct_url(post)
+
+    derived_keys = ("word_count", "reading_time", "headings", "first_image")
+
+    @classmethod
+    def _set_derived(cls, post):
+        # posts saved before the derived metadata was stored compute it here
+        meta_data = post.get("meta_data") or {}
+        derived = meta_data.get("derived") or \
+            text_metadata(post.get("text") or "")
+        for key in cls.derived_keys:
+            post[key] = copy.deepcopy(derived.get(key))
+
+    @classmethod
+    def render_post(cls, post):
+        """
+        Set the ``rendered_text`` and ``meta`` of the post, using the HTML
+        stored with the post if it was rendered at save time.
+        """
+        if cls.is_prerendered(post):
+            post["meta"] = copy.deepcopy(post["meta_data"]["meta"])
+        else:
             cls.render_text(post)
-            post["meta"]["images"] = cls.extract_images(post)
+
+    @classmethod
+    def prerender(cls, text):
+        """
+        Render the Markdown ``text`` ahead of time, so that it can be stored
+        along with the post by the ``Storage``.
+
+        :param text: The Markdown text
+        :type text: str
+        :return: A dict with the ``rendered_text``, the ``meta_data`` holding
+         the Markdown metadata under the ``"meta"`` key and the ``renderer``
+         version, to be passed on to ``Storage.save_post``.
+        """
+        post = dict(text=text)
+        cls.render_text(post)
+        if post["meta"].get("render_timeout"):
+            # the plain text fallback is not stored, see ``SandboxedRenderer``
+            return {}
+        return dict(rendered_text=post["rendered_text"],
+                    meta_data=dict(meta=post["meta"]),
+                    renderer=cls.renderer_version())
+
+    @classmethod
+    def is_prerendered(cls, post):
+        """
+        Check if the post holds HTML rendered at save time by the current
+        renderer.
+        """
+        meta_data = post.get("meta_data") or {}
+        return post.get("rendered_text") is not None and \
+            "meta" in meta_data and \
+            post.get("renderer") == cls.renderer_version()
 
     @classmethod
     def all_extensions(cls):
         return cls._markdown_extensions
 
+    @classmethod
+    def markdown_extensions(cls):
+        """
+        The extensions the Markdown instances are built with. These are the
+        ``all_extensions`` followed by the extensions the ``PostProcessor``
+        relies on internally, the ``ImageExtension`` and the
+        ``CodeCacheExtension``.
+        """
+        internal = cls._get_derived_config(
+            "internal_extensions",
+            lambda: [ImageExtension(), CodeCacheExtension(cls)])
+        return cls.all_extensions() + internal
+
     @classmethod
     def set_custom_extensions(cls, extensions):
+        """
+        Add Markdown extensions. This changes the ``renderer_version``, so
+        HTML rendered earlier is stale. See ``BloggingEngine.rerender_posts``.
+        """
         if type(extensions) == list:
             cls._markdown_extensions.extend(extensions)
+            cls._derived_config.clear()
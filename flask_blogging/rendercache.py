@@ -0,0 +1,85 @@
+"""
+Backends for the content addressed cache used by ``PostProcessor`` to
+memoize rendered Markdown.
+"""
+try:
+    from builtins import object
+except ImportError:
+    pass
+from collections import OrderedDict
+import threading
+
+
+class LRURenderCache(object):
+    """
+    A bounded, in-process render cache. When the cache is full, the least
+    recently used entry is evicted.
+    """
+
+    def __init__(self, maxsize=256):
+        """
+
+        :param maxsize: The maximum number of entries held in the cache
+         (default 256)
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FlaskRenderCache(object):
+    """
+    A render cache that stores entries in a Flask-Caching ``Cache`` object,
+    such as the one passed to the ``BloggingEngine``. Eviction is left to the
+    configured cache backend.
+    """
+
+    def __init__(self, cache, timeout=None, key_prefix="blogging_render_"):
+        """
+
+        :param cache: The Flask-Caching ``Cache`` object
+        :type cache: object
+        :param timeout: (Optional) The timeout in seconds for the cached
+         entries. If ``None`` the default timeout of the cache is used.
+        :type timeout: int
+        :param key_prefix: (Optional) The prefix for the cache keys
+        :type key_prefix: str
+        """
+        self.cache = cache
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    def set(self, key, value):
+        self.cache.set(self.key_prefix + key, value, timeout=self.timeout)
+
+    def clear(self):
+        # keys are content addressed, so stale entries are never read back
+        # and simply expire with the cache timeout.
+        pass
@@ -0,0 +1,448 @@
+"""
+The Markdown renderers used by the ``PostProcessor`` to convert the text of
+the posts to HTML.
+"""
+try:
+    from builtins import object
+except ImportError:
+    pass
+import os
+import re
+import sys
+import logging
+import threading
+import multiprocessing
+import markdown
+from markdown.extensions.meta import META_RE, META_MORE_RE, BEGIN_RE, END_RE
+try:
+    import markdown_it
+    from markdown_it import MarkdownIt
+except ImportError:
+    markdown_it = None
+    MarkdownIt = None
+from .signals import render_timed_out
+
+
+_logger = logging.getLogger("flask-blogging")
+_IMG_TAG_RE = re.compile(r'<\s*img\s[^>]*>', re.IGNORECASE)
+_ATTRIBUTE_RE = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_IMAGE_ATTRIBUTES = ("src", "alt", "width", "height")
+_MATHJAX_RE = re.compile(r'(\$\$?)(.+?)\1', re.DOTALL)
+
+
+def image_details(attributes):
+    """
+    Get the details of an image from the attributes of its ``img`` tag.
+
+    :param attributes: The attributes of the ``img`` tag
+    :type attributes: dict
+    :return: A dict with the ``src`` and, when given, the ``alt``, ``width``
+     and ``height`` of the image, or ``None`` if the image has no ``src``.
+    """
+    if not attributes.get("src"):
+        return None
+    return dict((name, attributes[name]) for name in _IMAGE_ATTRIBUTES
+                if attributes.get(name))
+
+
+def html_image_details(html):
+    """
+    Get the details of the images in a fragment of raw HTML, in order.
+    """
+    images = []
+    for tag in _IMG_TAG_RE.findall(html):
+        details = image_details(dict(
+            (name.lower(), double if double else single)
+            for name, double, single in _ATTRIBUTE_RE.findall(tag)))
+        if details is not None:
+            images.append(details)
+    return images
+
+
+def parse_meta(text):
+    """
+    Parse the metadata at the start of the Markdown ``text``, with the syntax
+    of the Python-Markdown ``MetaExtension``.
+
+    :param text: The Markdown text
+    :type text: str
+    :return: A tuple of the metadata and the remaining text
+    """
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    meta = {}
+    key = None
+    if lines and BEGIN_RE.match(lines[0]):
+        lines.pop(0)
+    while lines:
+        line = lines.pop(0)
+        match = META_RE.match(line)
+        if line.strip() == '' or END_RE.match(line):
+            break
+        if match:
+            key = match.group('key').lower().strip()
+            meta.setdefault(key, []).append(match.group('value').strip())
+        else:
+            more = META_MORE_RE.match(line)
+            if more and key:
+                meta[key].append(more.group('value').strip())
+            else:
+                lines.insert(0, line)
+                break
+    return meta, "\n".join(lines)
+
+
+def stable_repr(value):
+    """
+    A representation of a configuration ``value`` that is the same in every
+    process, for the fingerprints of the renderers. Functions and classes
+    are given by their qualified name, and other objects by their class,
+    instead of a ``repr`` that holds their memory address.
+    """
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(stable_repr(item) for item in value)
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(
+            "%s: %s" % (stable_repr(key), stable_repr(value[key]))
+            for key in sorted(value, key=str))
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return repr(value)
+    if hasattr(value, "__qualname__"):
+        return "%s.%s" % (getattr(value, "__module__", None),
+                          value.__qualname__)
+    value_class = value.__class__
+    return "<%s.%s>" % (value_class.__module__, value_class.__qualname__)
+
+
+class Renderer(object):
+    """
+    The interface of the Markdown renderers. A renderer converts the text of
+    a post to HTML, and extracts the metadata and the images of the post.
+    """
+
+    def convert(self, post_processor, text):
+        """
+        Convert the Markdown ``text`` to HTML.
+
+        :param post_processor: The ``PostProcessor`` class converting the
+         text
+        :param text: The Markdown text
+        :type text: str
+        :return: A tuple of the rendered HTML and the metadata. Along with
+         the Markdown metadata, the metadata has the ``images``, the list of
+         the image sources, and the ``image_details``, the list of dicts with
+         the ``src``, ``alt``, ``width`` and ``height`` of the images.
+        """
+        raise NotImplementedError("This method needs to be implemented by "
+                                  "the inheriting class")
+
+    def fingerprint(self, post_processor):
+        """
+        A string that identifies the renderer and its configuration. Rendered
+        output is only reusable for the same fingerprint.
+        """
+        raise NotImplementedError("This method needs to be implemented by "
+                                  "the inheriting class")
+
+    def block_safe(self, post_processor):
+        """
+        Whether a text can be converted one top level block at a time, as
+        split by ``flask_blogging.processor.split_blocks``, with the same
+        result.
+        """
+        return False
+
+
+class PythonMarkdownRenderer(Renderer):
+    """
+    The default renderer, based on Python-Markdown. It uses the Markdown
+    extensions of the ``PostProcessor``.
+    """
+
+    def convert(self, post_processor, text):
+        md = post_processor.get_markdown()
+        rendered_text = md.convert(text)
+        meta = md.Meta
+        meta["images"] = [image["src"] for image in md.images]
+        meta["image_details"] = md.images
+        return rendered_text, meta
+
+    def fingerprint(self, post_processor):
+        parts = ["markdown==%s" % _package_version(markdown)]
+        for extension in post_processor.markdown_extensions():
+            extension_class = extension.__class__
+            module = extension_class.__module__
+            parts.append("%s.%s==%s%s" % (
+                module, extension_class.__name__, _module_version(module),
+                stable_repr(extension.getConfigs())))
+        return ";".join(parts)
+
+    def block_safe(self, post_processor):
+        for extension in post_processor.markdown_extensions():
+            extension_class = extension.__class__
+            name = "%s.%s" % (extension_class.__module__,
+                              extension_class.__name__)
+            if name not in post_processor.block_safe_extensions:
+                return False
+        return True
+
+
+class CommonMarkRenderer(Renderer):
+    """
+    A renderer based on ``markdown-it-py``, a fast CommonMark parser, which
+    needs to be installed separately. The Markdown metadata and the MathJax
+    syntax are handled as with the default renderer. The Markdown extensions
+    of the ``PostProcessor`` are not used.
+    """
+
+    def __init__(self, preset="commonmark", options=None):
+        """
+
+        :param preset: (Optional) The name of the ``markdown-it-py`` preset
+         (default ``"commonmark"``)
+        :type preset: str
+        :param options: (Optional) Options updating the preset
+        :type options: dict
+        """
+        if MarkdownIt is None:
+            raise ImportError("The CommonMarkRenderer needs markdown-it-py. "
+                              "Install it with 'pip install markdown-it-py'.")
+        self.preset = preset
+        self.options = options or {}
+        self.md = MarkdownIt(preset, self.options)
+        self.md.inline.ruler.before("escape", "mathjax", _mathjax_rule)
+        self.md.add_render_rule("mathjax", _render_mathjax)
+
+    def convert(self, post_processor, text):
+        meta, text = parse_meta(text)
+        env = {}
+        tokens = self.md.parse(text, env)
+        rendered_text = self.md.renderer.render(tokens, self.md.options, env)
+        images = _token_images(tokens)
+        meta["images"] = [image["src"] for image in images]
+        meta["image_details"] = images
+        return rendered_text.rstrip("\n"), meta
+
+    def fingerprint(self, post_processor):
+        return "%s.%s;markdown-it-py==%s;%s%s" % (
+            self.__class__.__module__, self.__class__.__name__,
+            _package_version(markdown_it), self.preset,
+            stable_repr(self.options))
+
+    def __getstate__(self):
+        # the parser is built again when unpickled in a worker process
+        return dict(preset=self.preset, options=self.options)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class SandboxedRenderer(Renderer):
+    """
+    Runs another renderer in worker processes, with a deadline. A text whose
+    conversion takes longer than the ``timeout`` is shown as escaped plain
+    text instead, and the worker converting it is killed, so that a
+    pathological post cannot hold up the request for long. The timeouts are
+    counted in ``timeouts``, logged, and sent with the ``render_timed_out``
+    signal.
+
+    The workers are forked when first needed, and reused. Each thread
+    converting a text uses a worker of its own.
+    """
+
+    def __init__(self, renderer, timeout):
+        """
+
+        :param renderer: The renderer run in the worker processes
+        :type renderer: Renderer
+        :param timeout: The maximum time in seconds to convert a text
+        :type timeout: float
+        """
+        self.renderer = renderer
+        self.timeout = timeout
+        self.timeouts = 0
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def convert(self, post_processor, text):
+        worker = self._acquire()
+        try:
+            worker.conn.send((post_processor, text))
+            finished = worker.conn.poll(self.timeout)
+            if finished:
+                success, result = worker.conn.recv()
+        except (EOFError, OSError):
+            # the worker died, from a crash or a lack of memory
+            worker.kill()
+            raise
+        if not finished:
+            worker.kill()
+            return self._timed_out(post_processor, text)
+        self._release(worker)
+        if not success:
+            raise result
+        return result
+
+    def fingerprint(self, post_processor):
+        return self.renderer.fingerprint(post_processor)
+
+    def block_safe(self, post_processor):
+        return self.renderer.block_safe(post_processor)
+
+    def close(self):
+        """
+        Stop the idle worker processes.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.kill()
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked along with a process pool worker
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        return _SandboxWorker(self.renderer)
+
+    def _release(self, worker):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._idle.append(worker)
+
+    def _timed_out(self, post_processor, text):
+        with self._lock:
+            self.timeouts += 1
+        _logger.warning("Rendering a text of %d characters took longer than "
+                        "%s seconds", len(text), self.timeout)
+        render_timed_out.send(post_processor, text=text, timeout=self.timeout)
+        return plain_text_fallback(text)
+
+    def __getstate__(self):
+        return dict(renderer=self.renderer, timeout=self.timeout)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class _SandboxWorker(object):
+
+    def __init__(self, renderer):
+        methods = multiprocessing.get_all_start_methods()
+        # forked workers share the extensions set up by the engine
+        context = multiprocessing.get_context(
+            "fork" if "fork" in methods else None)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_sandbox_main,
+                                       args=(renderer, child_conn))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def _sandbox_main(renderer, conn):
+    while True:
+        try:
+            post_processor, text = conn.recv()
+        except EOFError:
+            break
+        try:
+            result = (True, renderer.convert(post_processor, text))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # the exception could not be pickled
+            conn.send((False, RuntimeError(repr(e))))
+
+
+def plain_text_fallback(text):
+    """
+    Show the Markdown ``text`` as escaped plain text, for the texts that
+    could not be rendered. The metadata is parsed as usual, and has the
+    ``render_timeout`` key set, so the result is not stored with the post.
+
+    :param text: The Markdown text
+    :type text: str
+    :return: A tuple of the HTML and the metadata
+    """
+    meta, text = parse_meta(text)
+    meta["images"] = []
+    meta["image_details"] = []
+    meta["render_timeout"] = True
+    text = text.strip("\n").replace("&", "&amp;").replace("<", "&lt;") \
+        .replace(">", "&gt;")
+    return "<pre>%s</pre>" % text, meta
+
+
+def _mathjax_rule(state, silent):
+    # same syntax as the ``MathJaxExtension``, whose content is not parsed
+    if state.src[state.pos] != "$":
+        return False
+    match = _MATHJAX_RE.match(state.src, state.pos)
+    if match is None:
+        return False
+    if not silent:
+        token = state.push("mathjax", "mathjax", 0)
+        token.content = match.group(0)
+    state.pos = match.end()
+    return True
+
+
+def _render_mathjax(renderer, tokens, index, options, env):
+    content = tokens[index].content.replace("&", "&amp;") \
+        .replace("<", "&lt;").replace(">", "&gt;")
+    return "<mathjax>%s</mathjax>" % content
+
+
+def _token_images(tokens):
+    images = []
+    for token in tokens:
+        if token.type == "html_block":
+            images.extend(html_image_details(token.content))
+        for child in token.children or ():
+            if child.type == "image":
+                attributes = dict(child.attrs)
+                attributes["alt"] = child.content
+                details = image_details(attributes)
+                if details is not None:
+                    images.append(details)
+            elif child.type == "html_inline":
+                images.extend(html_image_details(child.content))
+    return images
+
+
+def _package_version(package):
+    return getattr(package, "__version__", "")
+
+
+def _module_version(module_name):
+    return _package_version(sys.modules.get(module_name.split(".", 1)[0]))
+
+
+def get_renderer(name):
+    """
+    Get a renderer by the name used in the ``BLOGGING_RENDERER`` setting.
+
+    :param name: ``"markdown"`` for the ``PythonMarkdownRenderer`` or
+     ``"commonmark"`` for the ``CommonMarkRenderer``
+    :type name: str
+    :return: The renderer
+    """
+    renderers = dict(markdown=PythonMarkdownRenderer,
+                     commonmark=CommonMarkRenderer)
+    try:
+        renderer_class = renderers[name]
+    except KeyError:
+        raise ValueError("Unknown renderer %r, use one of %s" %
+                         (name, ", ".join(sorted(renderers))))
+    return renderer_class()
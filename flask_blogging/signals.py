@@ -247,3 +247,16 @@ Signal sent after the SQLAStorage object is initialized
 :param bind: The bind value in the multiple db scenario.
 :type bind: object
 """)
+
+render_timed_out = signals.signal("render_timed_out", doc="""\
+Signal sent when the conversion of a text takes longer than the
+``BLOGGING_RENDER_TIMEOUT``, and the text is shown as escaped plain text
+instead.
+
+:param post_processor: The ``PostProcessor`` class which is the sender
+:type post_processor: object
+:param text: The Markdown text that could not be rendered in time
+:type text: str
+:param timeout: The timeout in seconds
+:type timeout: float
+""")
@@ -2,13 +2,17 @@ try:
     from builtins import str
 except ImportError:
     pass
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 import sys
+import json
 import logging
+import functools
 import sqlalchemy as sqla
 from sqlalchemy.ext.automap import automap_base
 import datetime
 from .storage import Storage
+# the automapped ``Post`` model is exposed in this module under that name
+from .post import Post as BlogPost
 from .signals import sqla_initialized
 
 this = sys.modules[__name__]
@@ -129,7 +133,8 @@ class SQLAStorage(Storage):
 
     def save_post(self, title, text, user_id, tags, draft=False,
                   post_date=None, last_modified_date=None, meta_data=None,
-                  post_id=None):
+                  post_id=None, rendered_text=None, renderer=None,
+                  slug=None):
         """
         Persist the blog post data. If ``post_id`` is ``None`` or ``post_id``
         is invalid, the post must be inserted into the storage. If ``post_id``
@@ -152,16 +157,27 @@ class SQLAStorage(Storage):
         :param last_modified_date: (Optional) The date when blog was last
          modified  (default datetime.datetime.utcnow() )
         :type last_modified_date: datetime.datetime
+        :param meta_data: (Optional) The meta data for the blog post
+        :type meta_data: dict
         :param post_id: (Optional) The post identifier. This should be ``None``
          for an insert call,
          and a valid value for update. (default ``None``)
         :type post_id: str
+        :param rendered_text: (Optional) The HTML rendered from ``text`` at
+         save time (default ``None``)
+        :type rendered_text: str
+        :param renderer: (Optional) The version of the renderer that produced
+         ``rendered_text`` (default ``None``)
+        :type renderer: str
+        :param slug: (Optional) The slug of the ``title`` (default ``None``)
+        :type slug: str
 
         :return: The post_id value, in case of a successful insert or update.
          Return ``None`` if there were errors.
         """
         new_post = post_id is None
         post_id = _as_int(post_id)
+        meta_data = self.derived_meta_data(text, meta_data)
         current_datetime = datetime.datetime.utcnow()
         draft = 1 if draft is True else 0
         post_date = post_date if post_date is not None else current_datetime
@@ -182,7 +198,10 @@ class SQLAStorage(Storage):
                         self._post_table.c.id == post_id)
                 post_statement = post_statement.values(
                     title=title, text=text, post_date=post_date,
-                    last_modified_date=last_modified_date, draft=draft
+                    last_modified_date=last_modified_date, draft=draft,
+                    **self._optional_values(
+                        rendered_text=rendered_text, renderer=renderer,
+                        meta_data=self._dump_json(meta_data), slug=slug)
                 )
 
                 post_result = conn.execute(post_statement)
@@ -201,26 +220,24 @@ class SQLAStorage(Storage):
         """
         Translates multiple rows of joined post and tag information
         into the dictionary format expected by flask-blogging.
-        There will be one row per post/tag pairing.
+        There will be one row per post/tag pairing, and one post is built
+        for the first row of each post.
         """
         posts_by_id = OrderedDict()
-        tags_by_post_id = defaultdict(list)
         for joined_row in joined_rows:
             post_id = joined_row.post_id
-            post = cls._serialise_post_from_joined_row(joined_row)
-            posts_by_id[post_id] = post
-            tags_by_post_id[post_id].append(joined_row.tag_text)
+            post = posts_by_id.get(post_id)
+            if post is None:
+                post = cls._serialise_post_from_joined_row(joined_row)
+                post["tags"] = []
+                posts_by_id[post_id] = post
+            post["tags"].append(joined_row.tag_text)
 
-        for id, post in posts_by_id.items():
-            tags = tags_by_post_id.get(id)
-            if tags:
-                post["tags"] = tags
+        return list(posts_by_id.values())
 
-        return [post for post in posts_by_id.values()]
-
-    @staticmethod
-    def _serialise_post_from_joined_row(joined_row):
-        return dict(
+    @classmethod
+    def _serialise_post_from_joined_row(cls, joined_row):
+        post = BlogPost(
             post_id=joined_row.post_id,
             title=joined_row.post_title,
             text=joined_row.post_text,
@@ -229,6 +246,35 @@ class SQLAStorage(Storage):
             draft=joined_row.post_draft,
             user_id=joined_row.user_posts_user_id
         )
+        # columns added in later versions may be missing in older databases
+        rendered_text = getattr(joined_row, "post_rendered_text", None)
+        if rendered_text is not None:
+            post["rendered_text"] = rendered_text
+            post["renderer"] = joined_row.post_renderer
+        slug = getattr(joined_row, "post_slug", None)
+        if slug is not None:
+            post["slug"] = slug
+        meta_data = getattr(joined_row, "post_meta_data", None)
+        if meta_data is not None:
+            post["meta_data"] = cls._load_json(meta_data)
+        return post
+
+    def _optional_values(self, **values):
+        """
+        Filter the ``values`` to the columns present in the post table, so
+        that databases created by older versions keep working until they are
+        migrated.
+        """
+        columns = self._post_table.c
+        return dict((k, v) for k, v in values.items() if k in columns)
+
+    @staticmethod
+    def _dump_json(value):
+        return json.dumps(value) if value is not None else None
+
+    @staticmethod
+    def _load_json(value):
+        return json.loads(value) if value else None
 
     def get_post_by_id(self, post_id):
         """
@@ -288,51 +334,339 @@ class SQLAStorage(Storage):
          last_modified_date). If count is ``None``, then all the posts are
          returned.
         """
-        user_id = str(user_id) if user_id else user_id
-
         with self._engine.begin() as conn:
             try:
-                # post_statement ensures the correct posts are selected
-                # in the correct order
-                post_statement = sqla.select([self._post_table])
-                post_filter = self._get_filter(
-                    tag, user_id, include_draft, conn
-                )
+                joined_statement = self._get_posts_statement(
+                    count, offset, recent, tag, user_id, include_draft)
+                # the rows are consumed as they are fetched
+                rows = conn.execute(joined_statement)
+                result = \
+                    self._serialise_posts_and_tags_from_joined_rows(rows)
+            except Exception as e:
+                self._logger.exception(str(e))
+                result = []
 
-                if post_filter is not None:
-                    post_statement = post_statement.where(post_filter)
-                if count:
-                    post_statement = post_statement.limit(count)
-                if offset:
-                    post_statement = post_statement.offset(offset)
+        return result
 
-                post_ordering = \
-                    sqla.desc(self._post_table.c.post_date) if recent \
-                    else self._post_table.c.post_date
-                post_statement = post_statement.order_by(post_ordering)
-                post_statement = post_statement.alias('post')
+    def get_page(self, count=10, offset=0, recent=True, tag=None,
+                 user_id=None, include_draft=False):
+        """
+        Get a page of posts given by filter criteria, along with the total
+        number of posts for the filter, in one query. The total is counted
+        with a ``COUNT(*) OVER()`` window where the database supports it.
 
-                # joined_statement ensures other data is retrieved
-                joined_statement = post_statement.join(self._tag_posts_table) \
-                    .join(self._tag_table) \
-                    .join(self._user_posts_table) \
-                    .alias('join')
+        :param count: The number of posts to retrieve (default 10)
+        :type count: int
+        :param offset: The number of posts to offset (default 0)
+        :type offset: int
+        :param recent: Order by recent posts or not
+        :type recent: bool
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :return: A tuple of the list of posts, as returned by ``get_posts``,
+         and the total number of posts for the filter.
+        """
+        if not self._supports_window_functions():
+            return super(SQLAStorage, self).get_page(
+                count=count, offset=offset, recent=recent, tag=tag,
+                user_id=user_id, include_draft=include_draft)
+        with self._engine.begin() as conn:
+            try:
+                joined_statement = self._get_posts_statement(
+                    count, offset, recent, tag, user_id, include_draft,
+                    with_total=True)
+                rows = conn.execute(joined_statement).fetchall()
+                result = \
+                    self._serialise_posts_and_tags_from_joined_rows(rows)
+                total = rows[0].post_total_count if rows else None
+            except Exception as e:
+                self._logger.exception(str(e))
+                return [], 0
+        if total is None:
+            # there is no row to carry the total past the last page
+            total = 0 if not offset else self.count_posts(
+                tag=tag, user_id=user_id, include_draft=include_draft)
+        return result, total
+
+    def get_posts_by_cursor(self, count=10, cursor=None, before=False,
+                            tag=None, user_id=None, include_draft=False,
+                            fields=None):
+        """
+        Get the posts next to a cursor, most recent first, for keyset
+        pagination. The posts are selected by their ``post_date`` and
+        ``post_id`` instead of an offset, so that the query for a deep page
+        costs as much as the query for the first page.
 
-                joined_ordering = \
-                    sqla.desc(joined_statement.c.post_post_date) if recent \
-                    else joined_statement.c.post_post_date
+        :param count: The number of posts to retrieve (default 10)
+        :type count: int
+        :param cursor: The cursor of the post to start from, given by
+         ``encode_cursor``. If ``None``, the most recent posts are returned.
+        :type cursor: str
+        :param before: If ``True``, get the posts more recent than the
+         cursor, else the posts older than the cursor
+        :type before: bool
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :param fields: (Optional) The keys of the posts that are needed. If
+         these are all stored in the post table, or are the ``tags`` or the
+         ``user_id``, only these are fetched.
+        :type fields: tuple
+        :return: A list of posts, as returned by ``get_posts``
+        """
+        key = self.decode_cursor(cursor) if cursor else None
+        before = before and key is not None
+        columns = self._get_field_columns(fields)
+        get_posts = self._get_posts_by_key if columns is None \
+            else functools.partial(self._get_post_fields, columns, fields)
+        result = get_posts(count, 0, not before, key, tag, user_id,
+                           include_draft)
+        if before:
+            result.reverse()
+        return result
 
-                joined_statement = sqla.select([joined_statement]) \
-                    .order_by(joined_ordering)
-                all_rows = conn.execute(joined_statement).fetchall()
+    def _get_posts_by_key(self, count, offset, recent, key, tag, user_id,
+                          include_draft):
+        with self._engine.begin() as conn:
+            try:
+                joined_statement = self._get_posts_statement(
+                    count, offset, recent, tag, user_id, include_draft,
+                    key=key)
+                rows = conn.execute(joined_statement)
                 result = \
-                    self._serialise_posts_and_tags_from_joined_rows(all_rows)
+                    self._serialise_posts_and_tags_from_joined_rows(rows)
             except Exception as e:
                 self._logger.exception(str(e))
                 result = []
-
         return result
 
+    def iter_post_batches(self, batch_size=1000, tag=None, user_id=None,
+                          include_draft=False, fields=None, recent=True,
+                          offset=0, count=None):
+        """
+        Iterate over the posts given by filter criteria, in lists of at most
+        ``batch_size`` posts. Only the first list is fetched with the
+        ``offset``, the others with a keyset query that starts after the
+        last post of the previous list. If all the ``fields`` are columns of
+        the post table, or are the ``tags`` or the ``user_id``, only these
+        are fetched.
+
+        :param batch_size: The number of posts in each list (default 1000)
+        :type batch_size: int
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :param fields: (Optional) The keys of the posts that are needed
+        :type fields: tuple
+        :param recent: Order by recent posts or not (default ``True``)
+        :type recent: bool
+        :param offset: The number of posts to skip (default 0)
+        :type offset: int
+        :param count: (Optional) The total number of posts to iterate over.
+         If ``None``, all the posts are iterated over.
+        :type count: int
+        :return: An iterator over lists of posts
+        """
+        columns = self._get_field_columns(fields)
+        get_posts = self._get_posts_by_key if columns is None \
+            else functools.partial(self._get_post_fields, columns, fields)
+        key = None
+        remaining = count
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None \
+                else min(batch_size, remaining)
+            posts = get_posts(size, offset if key is None else 0, recent,
+                              key, tag, user_id, include_draft)
+            if posts:
+                yield posts
+            if len(posts) < size:
+                break
+            if remaining is not None:
+                remaining -= size
+            key = posts[-1]["post_date"], posts[-1]["post_id"]
+
+    def _get_field_columns(self, fields):
+        if fields is None:
+            return None
+        # the fields stored as is in the post table
+        names = dict(post_id="id", title="title", slug="slug", text="text",
+                     post_date="post_date", draft="draft",
+                     last_modified_date="last_modified_date",
+                     rendered_text="rendered_text", renderer="renderer",
+                     meta_data="meta_data")
+        columns = self._post_table.c
+        # the tags and the user are fetched for the posts afterwards
+        needed = set(fields) - set(["tags", "user_id"])
+        needed.update(["post_id", "post_date"])
+        if "rendered_text" in needed:
+            needed.add("renderer")
+        if not all(f in names and names[f] in columns for f in needed):
+            return None
+        return [columns[names[f]].label(f) for f in sorted(needed)]
+
+    def _get_post_fields(self, columns, fields, count, offset, recent, key,
+                         tag, user_id, include_draft):
+        statement = sqla.select(columns).where(
+            self._get_filter(tag, user_id, include_draft))
+        if key is not None:
+            statement = statement.where(self._get_key_filter(key, recent))
+        ordering = [self._post_table.c.post_date, self._post_table.c.id]
+        if recent:
+            ordering = [sqla.desc(column) for column in ordering]
+        statement = statement.order_by(*ordering).limit(count)
+        if offset:
+            statement = statement.offset(offset)
+        with self._engine.begin() as conn:
+            try:
+                rows = conn.execute(statement).fetchall()
+                posts = [BlogPost(dict(row.items())) for row in rows]
+                if posts and "tags" in fields:
+                    self._add_post_tags(conn, posts)
+                if posts and "user_id" in fields:
+                    self._add_post_users(conn, posts)
+            except Exception as e:
+                self._logger.exception(str(e))
+                posts = []
+        for post in posts:
+            # as in the posts of ``get_posts``
+            for field in ("slug", "rendered_text", "meta_data"):
+                if post.get(field, "") is None:
+                    del post[field]
+            if "rendered_text" not in post:
+                post.pop("renderer", None)
+            if "meta_data" in post:
+                post["meta_data"] = self._load_json(post["meta_data"])
+        return posts
+
+    def _add_post_tags(self, conn, posts):
+        posts_by_id = dict((post["post_id"], post) for post in posts)
+        for post in posts:
+            post["tags"] = []
+        statement = sqla.select([self._tag_posts_table.c.post_id,
+                                 self._tag_table.c.text]).select_from(
+            self._tag_posts_table.join(self._tag_table)).where(
+            self._tag_posts_table.c.post_id.in_(list(posts_by_id)))
+        for post_id, tag in conn.execute(statement):
+            posts_by_id[post_id]["tags"].append(tag)
+
+    def _add_post_users(self, conn, posts):
+        posts_by_id = dict((post["post_id"], post) for post in posts)
+        statement = sqla.select([self._user_posts_table.c.post_id,
+                                 self._user_posts_table.c.user_id]).where(
+            self._user_posts_table.c.post_id.in_(list(posts_by_id)))
+        for post_id, user_id in conn.execute(statement):
+            posts_by_id[post_id]["user_id"] = user_id
+
+    def _supports_window_functions(self):
+        dialect = self._engine.dialect
+        if dialect.name == "sqlite":
+            return dialect.dbapi.sqlite_version_info >= (3, 25)
+        if dialect.name == "mysql":
+            version = dialect.server_version_info or ()
+            return version >= ((10, 2) if getattr(dialect, "_is_mariadb",
+                                                  False) else (8,))
+        return dialect.name in ("postgresql", "mssql", "oracle")
+
+    def _get_posts_statement(self, count, offset, recent, tag, user_id,
+                             include_draft, with_total=False, key=None):
+        user_id = str(user_id) if user_id else user_id
+        # post_statement ensures the correct posts are selected
+        # in the correct order
+        columns = [self._post_table]
+        if with_total:
+            # counted over all the posts of the filter, before the limit
+            columns.append(sqla.func.count().over().label("total_count"))
+        post_statement = sqla.select(columns)
+        post_filter = self._get_filter(tag, user_id, include_draft)
+
+        if post_filter is not None:
+            post_statement = post_statement.where(post_filter)
+        if key is not None:
+            post_statement = post_statement.where(
+                self._get_key_filter(key, recent))
+        if count:
+            post_statement = post_statement.limit(count)
+        if offset:
+            post_statement = post_statement.offset(offset)
+
+        # the post id orders the posts of the same date, as for the cursors
+        post_ordering = [self._post_table.c.post_date, self._post_table.c.id]
+        if recent:
+            post_ordering = [sqla.desc(column) for column in post_ordering]
+        post_statement = post_statement.order_by(*post_ordering)
+        post_statement = post_statement.alias('post')
+
+        # joined_statement ensures other data is retrieved
+        joined_statement = post_statement.join(self._tag_posts_table) \
+            .join(self._tag_table) \
+            .join(self._user_posts_table) \
+            .alias('join')
+
+        joined_ordering = [joined_statement.c.post_post_date,
+                           joined_statement.c.post_id]
+        if recent:
+            joined_ordering = [sqla.desc(column) for column in joined_ordering]
+
+        return sqla.select([joined_statement]).order_by(*joined_ordering)
+
+    def _get_key_filter(self, key, recent):
+        # the posts past the (post_date, post_id) key in the given order
+        post_date, post_id = key
+        date_column = self._post_table.c.post_date
+        id_column = self._post_table.c.id
+        if recent:
+            return sqla.or_(date_column < post_date,
+                            sqla.and_(date_column == post_date,
+                                      id_column < post_id))
+        return sqla.or_(date_column > post_date,
+                        sqla.and_(date_column == post_date,
+                                  id_column > post_id))
+
+    def update_rendered(self, post_id, rendered_text, renderer,
+                        meta_data=None):
+        """
+        Store the HTML rendered from the text of the post defined by
+        ``post_id``, without changing the other fields of the post.
+
+        :param post_id: The identifier corresponding to a post
+        :type post_id: int
+        :param rendered_text: The HTML rendered from the text of the post
+        :type rendered_text: str
+        :param renderer: The version of the renderer that produced
+         ``rendered_text``
+        :type renderer: str
+        :param meta_data: (Optional) The meta data for the blog post
+        :type meta_data: dict
+        :return: Returns True if the post was successfully updated and False
+         otherwise.
+        """
+        values = self._optional_values(
+            rendered_text=rendered_text, renderer=renderer,
+            meta_data=self._dump_json(meta_data))
+        if not values:
+            return False
+        post_id = _as_int(post_id)
+        with self._engine.begin() as conn:
+            try:
+                statement = self._post_table.update().where(
+                    self._post_table.c.id == post_id).values(**values)
+                result = conn.execute(statement)
+                updated = result.rowcount == 1
+            except Exception as e:
+                self._logger.exception(str(e))
+                updated = False
+        return updated
+
     def count_posts(self, tag=None, user_id=None, include_draft=False):
         """
         Returns the total number of posts for the give filter
@@ -350,8 +684,7 @@ class SQLAStorage(Storage):
             try:
                 count_statement = sqla.select([sqla.func.count()]). \
                     select_from(self._post_table)
-                sql_filter = self._get_filter(tag, user_id, include_draft,
-                                              conn)
+                sql_filter = self._get_filter(tag, user_id, include_draft)
                 count_statement = count_statement.where(sql_filter)
                 result = conn.execute(count_statement).scalar()
             except Exception as e:
@@ -359,6 +692,77 @@ class SQLAStorage(Storage):
                 result = 0
         return result
 
+    def get_post_position(self, post, tag=None, user_id=None,
+                          include_draft=False):
+        """
+        Get the number of the posts given by filter criteria that are older
+        than ``post``, ordered by ``post_date`` and then ``post_id``, with a
+        count query.
+
+        :param post: The post, with at least its ``post_date`` and
+         ``post_id``
+        :type post: dict
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :return: The position of the post, from 0 for the oldest post
+        """
+        key = post["post_date"], _as_int(post["post_id"])
+        result = 0
+        with self._engine.begin() as conn:
+            try:
+                count_statement = sqla.select([sqla.func.count()]). \
+                    select_from(self._post_table).where(
+                        self._get_filter(tag, user_id, include_draft)).where(
+                        self._get_key_filter(key, True))
+                result = conn.execute(count_statement).scalar()
+            except Exception as e:
+                self._logger.exception(str(e))
+                result = 0
+        return result
+
+    def get_validator(self, post_id=None, tag=None, user_id=None,
+                      include_draft=False):
+        """
+        Get the latest ``last_modified_date`` and the number of the posts
+        given by filter criteria, or of the post defined by ``post_id``, in
+        one aggregate query. A draft has no validator unless
+        ``include_draft`` is set.
+
+        :param post_id: (Optional) The identifier corresponding to a post
+        :type post_id: int
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :return: A tuple of the latest ``last_modified_date``, or ``None`` if
+         there are no posts, and the number of posts.
+        """
+        result = None, 0
+        with self._engine.begin() as conn:
+            try:
+                statement = sqla.select([
+                    sqla.func.max(self._post_table.c.last_modified_date),
+                    sqla.func.count()]).select_from(self._post_table)
+                if post_id is not None:
+                    sql_filter = self._post_table.c.id == _as_int(post_id)
+                    if not include_draft:
+                        sql_filter = sqla.and_(
+                            sql_filter, self._post_table.c.draft == 0)
+                else:
+                    sql_filter = self._get_filter(tag, user_id,
+                                                  include_draft)
+                row = conn.execute(statement.where(sql_filter)).fetchone()
+                result = row[0], row[1]
+            except Exception as e:
+                self._logger.exception(str(e))
+        return result
+
     def delete_post(self, post_id):
         """
         Delete the post defined by ``post_id``
@@ -396,20 +800,18 @@ class SQLAStorage(Storage):
         status = success == 3
         return status
 
-    def _get_filter(self, tag, user_id, include_draft, conn):
+    def _get_filter(self, tag, user_id, include_draft):
         filters = []
         if tag:
             tag = tag.upper()
+            # the tag id is looked up in the same query as the posts
             tag_statement = sqla.select([self._tag_table.c.id]).where(
-                self._tag_table.c.text == tag)
-            tag_result = conn.execute(tag_statement).fetchone()
-            if tag_result is not None:
-                tag_id = tag_result[0]
-                tag_filter = sqla.and_(
-                    self._tag_posts_table.c.tag_id == tag_id,
-                    self._post_table.c.id == self._tag_posts_table.c.post_id
-                )
-                filters.append(tag_filter)
+                self._tag_table.c.text == tag).as_scalar()
+            tag_filter = sqla.and_(
+                self._tag_posts_table.c.tag_id == tag_statement,
+                self._post_table.c.id == self._tag_posts_table.c.post_id
+            )
+            filters.append(tag_filter)
 
         if user_id:
             user_filter = sqla.and_(
@@ -418,10 +820,12 @@ class SQLAStorage(Storage):
             )
             filters.append(user_filter)
 
-        draft_filter = self._post_table.c.draft == 1 if include_draft else \
-            self._post_table.c.draft == 0
-        filters.append(draft_filter)
-        sql_filter = sqla.and_(*filters)
+        # ``None`` selects both the published posts and the drafts
+        if include_draft is not None:
+            draft_filter = self._post_table.c.draft == 1 if include_draft \
+                else self._post_table.c.draft == 0
+            filters.append(draft_filter)
+        sql_filter = sqla.and_(*filters) if filters else sqla.true()
         return sql_filter
 
     def _save_tags(self, tags, post_id, conn):
@@ -536,11 +940,17 @@ class SQLAStorage(Storage):
                     post_table_name, self._metadata,
                     sqla.Column("id", sqla.Integer, primary_key=True),
                     sqla.Column("title", sqla.String(256)),
+                    sqla.Column("slug", sqla.String(256)),
                     sqla.Column("text", sqla.Text),
                     sqla.Column("post_date", sqla.DateTime),
                     sqla.Column("last_modified_date", sqla.DateTime),
                     # if 1 then make it a draft
                     sqla.Column("draft", sqla.SmallInteger, default=0),
+                    # html rendered at save time and the renderer version
+                    sqla.Column("rendered_text", sqla.Text),
+                    sqla.Column("renderer", sqla.String(64)),
+                    # json encoded meta data
+                    sqla.Column("meta_data", sqla.Text),
                     info=self._info
 
                 )
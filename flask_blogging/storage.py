@@ -2,13 +2,19 @@ try:
     from builtins import object
 except ImportError:
     pass
+import json
+import base64
+import binascii
+import datetime
+from .utils import text_metadata
 
 
 class Storage(object):
 
     def save_post(self, title, text, user_id, tags, draft=False,
                   post_date=None, last_modified_date=None, meta_data=None,
-                  post_id=None):
+                  post_id=None, rendered_text=None, renderer=None,
+                  slug=None):
         """
         Persist the blog post data. If ``post_id`` is ``None`` or ``post_id``
         is invalid, the post must be inserted into the storage. If ``post_id``
@@ -35,6 +41,16 @@ class Storage(object):
         :param post_id: The post identifier. This should be ``None`` for an
          insert call, and a valid value for update.
         :type post_id: int
+        :param rendered_text: (Optional) The HTML rendered from ``text`` at
+         save time. The Markdown metadata of the rendering is passed under the
+         ``"meta"`` key of ``meta_data``.
+        :type rendered_text: str
+        :param renderer: (Optional) The version of the renderer that produced
+         ``rendered_text``
+        :type renderer: str
+        :param slug: (Optional) The slug of the ``title``, stored so that it
+         need not be computed again when the post is read
+        :type slug: str
 
         :return: The post_id value, in case of a successful insert or update.
         Return ``None`` if there were errors.
@@ -70,7 +86,9 @@ class Storage(object):
         :type tag: str
         :param user_id: Filter by a specific user
         :type user_id: str
-        :param include_draft: Whether to include posts marked as draft or not
+        :param include_draft: Whether to include posts marked as draft or
+         not. If ``None``, both the published posts and the drafts are
+         returned.
         :type include_draft: bool
 
         :return: A list of posts, with each element a dict containing values
@@ -89,13 +107,248 @@ class Storage(object):
         :type tag: str
         :param user_id: Filter by a specific user
         :type user_id: str
-        :param include_draft: Whether to include posts marked as draft or not
+        :param include_draft: Whether to include posts marked as draft or
+         not. If ``None``, both the published posts and the drafts are
+         counted.
         :type include_draft: bool
         :return: The number of posts for the given filter.
         """
         raise NotImplementedError("This method needs to be implemented by the "
                                   "inheriting class")
 
+    def get_page(self, count=10, offset=0, recent=True, tag=None,
+                 user_id=None, include_draft=False):
+        """
+        Get a page of posts given by filter criteria, along with the total
+        number of posts for the filter. This takes the same arguments as
+        ``get_posts``. The default implementation only calls ``count_posts``
+        when the total cannot be told from the posts of the page, so storages
+        should override it to get both in one query.
+
+        :param count: The number of posts to retrieve (default 10)
+        :type count: int
+        :param offset: The number of posts to offset (default 0)
+        :type offset: int
+        :param recent: Order by recent posts or not
+        :type recent: bool
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :return: A tuple of the list of posts, as returned by ``get_posts``,
+         and the total number of posts for the filter.
+        """
+        posts = self.get_posts(count=count, offset=offset, recent=recent,
+                               tag=tag, user_id=user_id,
+                               include_draft=include_draft)
+        if posts and (not count or len(posts) < count):
+            # the page is the last one
+            return posts, offset + len(posts)
+        if not posts and not offset:
+            return posts, 0
+        total = self.count_posts(tag=tag, user_id=user_id,
+                                 include_draft=include_draft)
+        return posts, total
+
+    def get_posts_by_cursor(self, count=10, cursor=None, before=False,
+                            tag=None, user_id=None, include_draft=False,
+                            fields=None):
+        """
+        Get the posts next to a cursor, most recent first, for keyset
+        pagination. The cursor of a post is given by ``encode_cursor``, and
+        positions the post by its ``post_date`` and ``post_id``. The default
+        implementation scans the posts with ``get_posts`` up to the cursor,
+        so storages should override it with a query on these fields.
+
+        :param count: The number of posts to retrieve (default 10)
+        :type count: int
+        :param cursor: The cursor of the post to start from. If ``None``,
+         the most recent posts are returned.
+        :type cursor: str
+        :param before: If ``True``, get the posts more recent than the
+         cursor, else the posts older than the cursor
+        :type before: bool
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or
+         not. If ``None``, both the published posts and the drafts are
+         returned, as ``rerender_posts`` of the engine needs.
+        :type include_draft: bool
+        :param fields: (Optional) The keys of the posts that are needed, so
+         that storages can skip fetching the others. The posts may have more
+         keys than these.
+        :type fields: tuple
+        :return: A list of posts, as returned by ``get_posts``. The posts
+         before the cursor are the ``count`` posts closest to it.
+        """
+        key = self.decode_cursor(cursor) if cursor else None
+        if key is None:
+            return self.get_posts(count=count, offset=0, recent=True,
+                                  tag=tag, user_id=user_id,
+                                  include_draft=include_draft)
+        posts = []
+        offset = 0
+        batch_size = max(count, 100)
+        while len(posts) < count:
+            batch = self.get_posts(count=batch_size, offset=offset,
+                                   recent=not before, tag=tag,
+                                   user_id=user_id,
+                                   include_draft=include_draft)
+            for post in batch:
+                post_key = (post["post_date"], post["post_id"])
+                if (post_key > key if before else post_key < key) and \
+                        len(posts) < count:
+                    posts.append(post)
+            if len(batch) < batch_size:
+                break
+            offset += batch_size
+        if before:
+            posts.reverse()
+        return posts
+
+    def iter_post_batches(self, batch_size=1000, tag=None, user_id=None,
+                          include_draft=False, fields=None, recent=True,
+                          offset=0, count=None):
+        """
+        Iterate over the posts given by filter criteria, in lists of at most
+        ``batch_size`` posts, so that the posts are not all held in memory at
+        once. The default implementation gets the batches with
+        ``get_posts``.
+
+        :param batch_size: The number of posts in each list (default 1000)
+        :type batch_size: int
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :param fields: (Optional) The keys of the posts that are needed, so
+         that storages can skip fetching the others. The posts may have more
+         keys than these.
+        :type fields: tuple
+        :param recent: Order by recent posts or not (default ``True``)
+        :type recent: bool
+        :param offset: The number of posts to skip (default 0)
+        :type offset: int
+        :param count: (Optional) The total number of posts to iterate over.
+         If ``None``, all the posts are iterated over.
+        :type count: int
+        :return: An iterator over lists of posts
+        """
+        remaining = count
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None \
+                else min(batch_size, remaining)
+            posts = self.get_posts(count=size, offset=offset, recent=recent,
+                                   tag=tag, user_id=user_id,
+                                   include_draft=include_draft)
+            if posts:
+                yield posts
+            if len(posts) < size:
+                break
+            offset += size
+            if remaining is not None:
+                remaining -= size
+
+    def get_post_position(self, post, tag=None, user_id=None,
+                          include_draft=False):
+        """
+        Get the number of the posts given by filter criteria that are older
+        than ``post``, ordered by ``post_date`` and then ``post_id``. The
+        default implementation scans the posts, so storages should override
+        it with a count query.
+
+        :param post: The post, with at least its ``post_date`` and
+         ``post_id``
+        :type post: dict
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :return: The position of the post, from 0 for the oldest post
+        """
+        key = post["post_date"], post["post_id"]
+        position = 0
+        for posts in self.iter_post_batches(
+                tag=tag, user_id=user_id, include_draft=include_draft,
+                fields=("post_id", "post_date"), recent=False):
+            for other in posts:
+                if (other["post_date"], other["post_id"]) >= key:
+                    return position
+                position += 1
+        return position
+
+    def get_validator(self, post_id=None, tag=None, user_id=None,
+                      include_draft=False):
+        """
+        Get the latest ``last_modified_date`` and the number of the posts
+        given by filter criteria, or of the post defined by ``post_id``. The
+        views use these to answer conditional requests without fetching the
+        posts, so a draft has no validator unless ``include_draft`` is set.
+        The default implementation fetches the posts, so storages should
+        override it with a cheaper query.
+
+        :param post_id: (Optional) The identifier corresponding to a post
+        :type post_id: int
+        :param tag: Filter by a specific tag
+        :type tag: str
+        :param user_id: Filter by a specific user
+        :type user_id: str
+        :param include_draft: Whether to include posts marked as draft or not
+        :type include_draft: bool
+        :return: A tuple of the latest ``last_modified_date``, or ``None`` if
+         there are no posts, and the number of posts.
+        """
+        if post_id is not None:
+            post = self.get_post_by_id(post_id)
+            posts = [post] if post is not None and \
+                (include_draft or not post["draft"]) else []
+        else:
+            posts = self.get_posts(count=None, offset=0, recent=True, tag=tag,
+                                   user_id=user_id,
+                                   include_draft=include_draft)
+        dates = [post["last_modified_date"] for post in posts]
+        return (max(dates) if dates else None), len(posts)
+
+    @staticmethod
+    def encode_cursor(post):
+        """
+        Get the opaque cursor of a post, used by ``get_posts_by_cursor``.
+
+        :param post: The post
+        :type post: dict
+        :return: The cursor, safe to use in URLs
+        """
+        value = json.dumps([post["post_date"].isoformat(), post["post_id"]])
+        cursor = base64.urlsafe_b64encode(value.encode("utf-8"))
+        return cursor.decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Get the ``post_date`` and ``post_id`` of the post of a cursor given
+        by ``encode_cursor``.
+
+        :param cursor: The cursor
+        :type cursor: str
+        :return: A tuple of the ``post_date`` and the ``post_id``
+        :raises ValueError: If the cursor is not valid
+        """
+        try:
+            value = base64.urlsafe_b64decode(
+                cursor + "=" * (-len(cursor) % 4))
+            post_date, post_id = json.loads(value.decode("utf-8"))
+            return datetime.datetime.fromisoformat(post_date), post_id
+        except (TypeError, ValueError, binascii.Error) as e:
+            raise ValueError("Invalid cursor %r: %s" % (cursor, e))
+
     def delete_post(self, post_id):
         """
         Delete the post defined by ``post_id``
@@ -108,6 +361,57 @@ class Storage(object):
         raise NotImplementedError("This method needs to be implemented by the "
                                   "inheriting class")
 
+    def update_rendered(self, post_id, rendered_text, renderer,
+                        meta_data=None):
+        """
+        Store the HTML rendered from the text of the post defined by
+        ``post_id``, without changing the other fields of the post. The
+        default implementation saves the whole post again, so storages should
+        override it with a cheaper update.
+
+        :param post_id: The identifier corresponding to a post
+        :type post_id: int
+        :param rendered_text: The HTML rendered from the text of the post
+        :type rendered_text: str
+        :param renderer: The version of the renderer that produced
+         ``rendered_text``
+        :type renderer: str
+        :param meta_data: The meta data for the blog post, holding the
+         Markdown metadata of the rendering under the ``"meta"`` key
+        :type meta_data: dict
+        :return: Returns True if the post was successfully updated and False
+         otherwise.
+        """
+        post = self.get_post_by_id(post_id)
+        if post is None:
+            return False
+        pid = self.save_post(post["title"], post["text"], post["user_id"],
+                             post["tags"], draft=bool(post["draft"]),
+                             post_date=post["post_date"],
+                             last_modified_date=post["last_modified_date"],
+                             meta_data=meta_data, post_id=post_id,
+                             rendered_text=rendered_text, renderer=renderer,
+                             slug=post.get("slug"))
+        return pid is not None
+
+    @staticmethod
+    def derived_meta_data(text, meta_data=None):
+        """
+        Add the metadata derived from the ``text`` of a post, as computed by
+        ``flask_blogging.utils.text_metadata``, to the ``meta_data`` of the
+        post under the ``"derived"`` key. The storages call this on save, so
+        that the derived metadata is stored along with the post.
+
+        :param text: The text of the blog post
+        :type text: str
+        :param meta_data: The meta data for the blog post
+        :type meta_data: dict
+        :return: A copy of ``meta_data`` with the derived metadata
+        """
+        meta_data = dict(meta_data or {})
+        meta_data["derived"] = text_metadata(text)
+        return meta_data
+
     @classmethod
     def normalize_tags(cls, tags):
         return [cls.normalize_tag(tag) for tag in tags]
@@ -1,3 +1,10 @@
+import re
+import math
+from markdown.extensions.meta import META_RE, META_MORE_RE, BEGIN_RE, \
+    END_RE
+from markdown.extensions.toc import slugify, unique
+
+
 def ensureUtf(s, encoding='utf8'):
     """Converts input to unicode if necessary.
     If `s` is bytes, it will be decoded using the `encoding` parameters.
@@ -11,3 +18,93 @@ def ensureUtf(s, encoding='utf8'):
         return s.decode(encoding, 'ignore')
     else:
         return s
+
+
+WORDS_PER_MINUTE = 200
+
+_FENCE_RE = re.compile(r'^[ ]{0,3}(`{3,}|~{3,})')
+_ATX_HEADING_RE = re.compile(r'^[ ]{0,3}(#{1,6})[ \t]+(.*?)[ \t#]*$')
+_SETEXT_RE = re.compile(r'^[ ]{0,3}(=+|-+)[ \t]*$')
+_MARKDOWN_IMAGE_RE = re.compile(r'!\[[^\]]*\]\(\s*<?([^\s)>]+)')
+_HTML_IMAGE_RE = re.compile(r'<\s*img\s[^>]*src\s*=\s*["\']([^"\']+)',
+                            re.IGNORECASE)
+_LINK_RE = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_INLINE_MARKUP_RE = re.compile(r'[*_`~]|<[^>]+>')
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def text_metadata(text):
+    """
+    Compute the metadata derived from the Markdown text of a post: the
+    ``word_count``, the ``reading_time`` in minutes, the ``headings`` outline
+    and the ``first_image``. Code blocks count as text, while the Markdown
+    metadata at the start of the text does not.
+
+    :param text: The Markdown text
+    :type text: str
+    :return: A dict with the derived metadata. The ``headings`` are dicts
+     with the ``level``, the ``text`` and the ``id`` the ``toc`` Markdown
+     extension gives to the heading.
+    """
+    lines = _strip_meta(text.replace("\r\n", "\n").split("\n"))
+    words = 0
+    headings = []
+    ids = set()
+    fence = None
+    previous = ""
+    for line in lines:
+        match = _FENCE_RE.match(line)
+        if fence is not None:
+            if match and match.group(1)[0] == fence[0] and \
+                    len(match.group(1)) >= len(fence):
+                fence = None
+        elif match:
+            fence = match.group(1)
+        elif not line.startswith(("    ", "\t")):
+            heading = _ATX_HEADING_RE.match(line)
+            setext = _SETEXT_RE.match(line)
+            if heading:
+                headings.append((len(heading.group(1)), heading.group(2)))
+            elif setext and previous.strip():
+                level = 1 if setext.group(1)[0] == "=" else 2
+                headings.append((level, previous.strip()))
+                previous = ""
+                continue
+        words += len(_WORD_RE.findall(_plain_text(line)))
+        previous = line if fence is None else ""
+    text = "\n".join(lines)
+    return dict(word_count=words,
+                reading_time=int(math.ceil(float(words) / WORDS_PER_MINUTE)),
+                headings=[_heading(level, title, ids)
+                          for level, title in headings],
+                first_image=_first_image(text))
+
+
+def _strip_meta(lines):
+    if not lines or not (META_RE.match(lines[0]) or BEGIN_RE.match(lines[0])):
+        return lines
+    for index, line in enumerate(lines):
+        if index == 0 and BEGIN_RE.match(line):
+            continue
+        if not line.strip() or END_RE.match(line):
+            return lines[index + 1:]
+        if not (META_RE.match(line) or META_MORE_RE.match(line)):
+            return lines[index:]
+    return []
+
+
+def _plain_text(line):
+    return _INLINE_MARKUP_RE.sub("", _LINK_RE.sub(r"\1", line))
+
+
+def _heading(level, title, ids):
+    text = _plain_text(title).strip()
+    return dict(level=level, text=text, id=unique(slugify(text, "-"), ids))
+
+
+def _first_image(text):
+    matches = [match for match in (_MARKDOWN_IMAGE_RE.search(text),
+                                   _HTML_IMAGE_RE.search(text)) if match]
+    if not matches:
+        return None
+    return min(matches, key=lambda match: match.start()).group(1)
@@ -7,10 +7,19 @@ from markupsafe import escape
 from .processor import PostProcessor
 from flask_login import login_required, current_user
 from flask import Blueprint, current_app, render_template, request, redirect, \
-    url_for, flash, make_response
+    url_for, flash, make_response, session, stream_with_context, Response, \
+    abort, jsonify
 from flask_blogging.forms import BlogEditor
 import math
-from feedwerk.atom import AtomFeed
+from collections import OrderedDict
+import gzip
+import hashlib
+import functools
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from feedwerk.atom import AtomFeed, FeedEntry
 import datetime
 from flask_principal import PermissionDenied
 from .signals import page_by_id_fetched, page_by_id_processed, \
@@ -21,6 +30,7 @@ from .signals import page_by_id_fetched, page_by_id_processed, \
     sitemap_posts_fetched, sitemap_posts_processed, editor_post_saved, \
     post_deleted, editor_get_fetched
 from .utils import ensureUtf
+from .auth import get_auth_context
 
 
 def _get_blogging_engine(app):
@@ -37,11 +47,13 @@ def _clear_cache(cache):
     cache.delete_memoized(page_by_id)
     cache.delete_memoized(posts_by_author)
     cache.delete_memoized(posts_by_tag)
-    cache.delete_memoized(sitemap)
     cache.delete_memoized(feed)
+    cache.delete_memoized(feed_by_tag)
+    cache.delete_memoized(feed_by_author)
 
 
-def _store_form_data(blog_form, storage, user, post, escape_text=True):
+def _store_form_data(blog_form, storage, user, post, escape_text=True,
+                     post_processor=None, slug=None):
     title = blog_form.title.data
     text = escape(blog_form.text.data) if escape_text \
         else blog_form.text.data
@@ -52,61 +64,99 @@ def _store_form_data(blog_form, storage, user, post, escape_text=True):
     post_date = post.get("post_date", current_datetime)
     last_modified_date = datetime.datetime.utcnow()
     post_id = post.get("post_id")
+    # render ahead of time, so that the views can serve the stored html
+    rendered = post_processor.prerender(text) if post_processor else {}
     pid = storage.save_post(title, text, user_id, tags, draft=draft,
                             post_date=post_date,
                             last_modified_date=last_modified_date,
-                            post_id=post_id)
+                            post_id=post_id, slug=slug, **rendered)
     return pid
 
 
-def _get_meta(storage, count, page, tag=None, user_id=None):
-    max_posts = storage.count_posts(tag=tag, user_id=user_id)
+def _get_page(storage, count, page, tag=None, user_id=None):
+    offset = max(0, (page-1)*count)
+    posts, max_posts = storage.get_page(count=count, offset=offset, tag=tag,
+                                        user_id=user_id, include_draft=False,
+                                        recent=True)
     max_pages = math.ceil(float(max_posts)/float(count))
     max_offset = (max_pages-1)*count
-    offset = min(max(0, (page-1)*count), max_offset)
-    offset = offset if offset >= 0 else 0
-    if (tag is None) and (user_id is None):
-        prev_page = None if page <= 1 else url_for(
-            "blogging.index", count=count, page=page-1)
-        next_page = None if page >= max_pages else url_for(
-            "blogging.index", count=count, page=page+1)
-    elif tag:
-        prev_page = None if page <= 1 else url_for(
-            "blogging.posts_by_tag", tag=tag, count=count, page=page-1)
-        next_page = None if page >= max_pages else url_for(
-            "blogging.posts_by_tag", tag=tag, count=count, page=page+1)
-    elif user_id:
-        prev_page = None if page <= 1 else url_for(
-            "blogging.posts_by_author", user_id=user_id, count=count,
-            page=page-1)
-        next_page = None if page >= max_pages else url_for(
-            "blogging.posts_by_author", user_id=user_id, count=count,
-            page=page+1)
-    else:
-        prev_page = next_page = None
+    if max_posts and offset > max_offset:
+        # pages past the last one show the last page
+        offset = max_offset
+        posts = storage.get_posts(count=count, offset=offset, tag=tag,
+                                  user_id=user_id, include_draft=False,
+                                  recent=True)
+    # the next and previous pages are fetched by cursor, which does not
+    # scan the posts of the pages before them
+    prev_page = None if page <= 1 or not posts else _listing_url(
+        tag, user_id, count=count, before=storage.encode_cursor(posts[0]))
+    next_page = None if page >= max_pages or not posts else _listing_url(
+        tag, user_id, count=count, after=storage.encode_cursor(posts[-1]))
 
     pagination = dict(prev_page=prev_page, next_page=next_page)
     meta = dict(max_posts=max_posts, max_pages=max_pages, page=page,
                 max_offset=max_offset, offset=offset, count=count,
                 pagination=pagination)
-    return meta
+    return posts, meta
+
+
+def _get_cursor_page(storage, count, after=None, before=None, tag=None,
+                     user_id=None, fields=None, listing_url=None):
+    listing_url = listing_url or _listing_url
+    # one more post is fetched to tell if there is a page past this one
+    posts = storage.get_posts_by_cursor(count=count+1, cursor=before or after,
+                                        before=bool(before), tag=tag,
+                                        user_id=user_id, include_draft=False,
+                                        fields=fields)
+    more = len(posts) > count
+    if before:
+        posts = posts[1:] if more else posts
+        has_prev, has_next = more, True
+    else:
+        posts = posts[:count]
+        has_prev, has_next = bool(after), more
+    prev_page = listing_url(
+        tag, user_id, count=count,
+        before=storage.encode_cursor(posts[0])) if has_prev and posts \
+        else None
+    next_page = listing_url(
+        tag, user_id, count=count,
+        after=storage.encode_cursor(posts[-1])) if has_next and posts \
+        else None
+    pagination = dict(prev_page=prev_page, next_page=next_page)
+    meta = dict(count=count, page=None, after=after, before=before,
+                pagination=pagination)
+    return posts, meta
+
+
+def _listing_url(tag, user_id, **values):
+    if tag:
+        return url_for("blogging.posts_by_tag", tag=tag, **values)
+    if user_id:
+        return url_for("blogging.posts_by_author", user_id=user_id, **values)
+    return url_for("blogging.index", **values)
+
+
+def _get_listing(storage, count, page, after, before, tag=None,
+                 user_id=None):
+    if after or before:
+        return _get_cursor_page(storage, count, after=after, before=before,
+                                tag=tag, user_id=user_id)
+    return _get_page(storage, count, page, tag=tag, user_id=user_id)
 
 
 def _is_blogger(blogger_permission):
-    authenticated = current_user.is_authenticated() if \
-        callable(current_user.is_authenticated) \
-        else current_user.is_authenticated
-    is_blogger = authenticated and \
-        blogger_permission.require().can()
-    return is_blogger
+    return get_auth_context(blogger_permission).is_blogger
 
 
-def index(count, page):
+def index(count, page, after=None, before=None):
     """
     Serves the page with a list of blog posts
 
     :param count:
-    :param offset:
+    :param page: The page number, if the page is not given by a cursor
+    :param after: (Optional) The cursor of the post before the page
+    :param before: (Optional) The cursor of the post after the page
     :return:
     """
     blogging_engine = _get_blogging_engine(current_app)
@@ -114,19 +164,17 @@ def index(count, page):
     config = blogging_engine.config
     count = count or config.get("BLOGGING_POSTS_PER_PAGE", 10)
 
-    meta = _get_meta(storage, count, page)
-    offset = meta["offset"]
+    try:
+        posts, meta = _get_listing(storage, count, page, after, before)
+    except ValueError:
+        flash("The page you are trying to access is not valid!", "warning")
+        return redirect(url_for("blogging.index"))
     meta["is_user_blogger"] = _is_blogger(blogging_engine.blogger_permission)
-    meta["count"] = count
-    meta["page"] = page
 
     render = config.get("BLOGGING_RENDER_TEXT", True)
-    posts = storage.get_posts(count=count, offset=offset, include_draft=False,
-                              tag=None, user_id=None, recent=True)
     index_posts_fetched.send(blogging_engine.app, engine=blogging_engine,
                              posts=posts, meta=meta)
-    for post in posts:
-        blogging_engine.process_post(post, render=render)
+    blogging_engine.process_posts(posts, render=render)
     index_posts_processed.send(blogging_engine.app, engine=blogging_engine,
                                posts=posts, meta=meta)
     return render_template("blogging/index.html", posts=posts, meta=meta,
@@ -141,7 +189,8 @@ def page_by_id(post_id, slug):
     meta = {}
     meta["is_user_blogger"] = _is_blogger(blogging_engine.blogger_permission)
 
-    render = config.get("BLOGGING_RENDER_TEXT", True)
+    # the page shows the full text, also when listings show excerpts
+    render = bool(config.get("BLOGGING_RENDER_TEXT", True))
     meta["post_id"] = post_id
     meta["slug"] = slug
     page_by_id_fetched.send(blogging_engine.app, engine=blogging_engine,
@@ -157,25 +206,24 @@ def page_by_id(post_id, slug):
         return redirect(url_for("blogging.index"))
 
 
-def posts_by_tag(tag, count, page):
+def posts_by_tag(tag, count, page, after=None, before=None):
     blogging_engine = _get_blogging_engine(current_app)
     storage = blogging_engine.storage
     config = blogging_engine.config
     count = count or config.get("BLOGGING_POSTS_PER_PAGE", 10)
-    meta = _get_meta(storage, count, page, tag=tag)
-    offset = meta["offset"]
+    try:
+        posts, meta = _get_listing(storage, count, page, after, before,
+                                   tag=tag)
+    except ValueError:
+        flash("The page you are trying to access is not valid!", "warning")
+        return redirect(url_for("blogging.index"))
     meta["is_user_blogger"] = _is_blogger(blogging_engine.blogger_permission)
     meta["tag"] = tag
-    meta["count"] = count
-    meta["page"] = page
     render = config.get("BLOGGING_RENDER_TEXT", True)
-    posts = storage.get_posts(count=count, offset=offset, tag=tag,
-                              include_draft=False, user_id=None, recent=True)
     posts_by_tag_fetched.send(blogging_engine.app, engine=blogging_engine,
                               posts=posts, meta=meta)
     if len(posts):
-        for post in posts:
-            blogging_engine.process_post(post, render=render)
+        blogging_engine.process_posts(posts, render=render)
         posts_by_tag_processed.send(blogging_engine.app,
                                     engine=blogging_engine,
                                     posts=posts, meta=meta)
@@ -186,26 +234,24 @@ def posts_by_tag(tag, count, page):
         return redirect(url_for("blogging.index", post_id=None))
 
 
-def posts_by_author(user_id, count, page):
+def posts_by_author(user_id, count, page, after=None, before=None):
     blogging_engine = _get_blogging_engine(current_app)
     storage = blogging_engine.storage
     config = blogging_engine.config
     count = count or config.get("BLOGGING_POSTS_PER_PAGE", 10)
-    meta = _get_meta(storage, count, page, user_id=user_id)
-    offset = meta["offset"]
+    try:
+        posts, meta = _get_listing(storage, count, page, after, before,
+                                   user_id=user_id)
+    except ValueError:
+        flash("The page you are trying to access is not valid!", "warning")
+        return redirect(url_for("blogging.index"))
     meta["is_user_blogger"] = _is_blogger(blogging_engine.blogger_permission)
     meta["user_id"] = user_id
-    meta["count"] = count
-    meta["page"] = page
-
-    posts = storage.get_posts(count=count, offset=offset, user_id=user_id,
-                              include_draft=False, tag=None, recent=True)
     render = config.get("BLOGGING_RENDER_TEXT", True)
     posts_by_author_fetched.send(blogging_engine.app, engine=blogging_engine,
                                  posts=posts, meta=meta)
     if len(posts):
-        for post in posts:
-            blogging_engine.process_post(post, render=render)
+        blogging_engine.process_posts(posts, render=render)
         posts_by_author_processed.send(blogging_engine.app,
                                        engine=blogging_engine, posts=posts,
                                        meta=meta)
@@ -238,15 +284,23 @@ def editor(post_id):
                     else:
                         post = {}
                     escape_text = config.get("BLOGGING_ESCAPE_MARKDOWN", False)
-                    pid = _store_form_data(form, storage, current_user, post,
-                                           escape_text)
+                    render_on_save = config.get("BLOGGING_RENDER_ON_SAVE",
+                                                False)
+                    slug = post_processor.create_slug(form.title.data)
+                    pid = _store_form_data(
+                        form, storage, current_user, post, escape_text,
+                        post_processor if render_on_save else None, slug)
+                    was_listed = bool(post) and not post["draft"]
+                    if cache and (was_listed or not form.draft.data):
+                        _clear_sitemap_cache(
+                            blogging_engine, storage.get_post_by_id(pid),
+                            shift=was_listed == form.draft.data)
                     editor_post_saved.send(blogging_engine.app,
                                            engine=blogging_engine,
                                            post_id=pid,
                                            user=current_user,
                                            post=post)
                     flash("Blog posted successfully!", "info")
-                    slug = post_processor.create_slug(form.title.data)
                     return redirect(url_for("blogging.page_by_id", post_id=pid,
                                             slug=slug))
                 else:
@@ -295,6 +349,8 @@ def delete(post_id):
             post = storage.get_post_by_id(post_id)
             if (post is not None) and \
                     (post_processor.is_author(post, current_user)):
+                if cache and not post["draft"]:
+                    _clear_sitemap_cache(blogging_engine, post, shift=True)
                 success = storage.delete_post(post_id)
                 if success:
                     flash("Your post was successfully deleted", "info")
@@ -314,51 +370,221 @@ def delete(post_id):
         return redirect(url_for("blogging.index", post_id=None))
 
 
-def sitemap():
-    blogging_engine = _get_blogging_engine(current_app)
-    storage = blogging_engine.storage
-    config = blogging_engine.config
-    posts = storage.get_posts(count=None, offset=None, recent=True,
-                              user_id=None, tag=None, include_draft=False)
+# the fields of the posts used by the sitemap, with the ``user_id`` that the
+# processing of the posts needs for the ``user_name`` and ``editable`` keys
+_SITEMAP_FIELDS = ("post_id", "title", "slug", "last_modified_date",
+                   "user_id")
+
+
+def _process_sitemap_posts(blogging_engine, posts):
     sitemap_posts_fetched.send(blogging_engine.app, engine=blogging_engine,
                                posts=posts)
-
     if len(posts):
-        for post in posts:
-            blogging_engine.process_post(post, render=False)
+        blogging_engine.process_posts(posts, render=False)
         sitemap_posts_processed.send(blogging_engine.app,
                                      engine=blogging_engine, posts=posts)
-    sitemap_xml = render_template("blogging/sitemap.xml", posts=posts,
-                                  config=config)
-    response = make_response(sitemap_xml)
+    return posts
+
+
+def _iter_sitemap_posts(blogging_engine, first_batch, batches):
+    for post in first_batch:
+        yield post
+    for posts in batches:
+        for post in _process_sitemap_posts(blogging_engine, posts):
+            yield post
+
+
+def _get_shard_size(config):
+    # the sitemaps protocol allows at most 50,000 urls in a sitemap
+    return min(config.get("BLOGGING_SITEMAP_SHARD_SIZE", 50000), 50000)
+
+
+def _clear_sitemap_cache(blogging_engine, post, shift=False):
+    """
+    Clear the cached sitemap shard that lists ``post``. If ``shift``, the
+    post was added to or removed from the sitemap, which moves the later
+    posts across shards, so the later shards are cleared as well.
+    """
+    cache = blogging_engine.cache
+    storage = blogging_engine.storage
+    shard_size = _get_shard_size(blogging_engine.config)
+    position = storage.get_post_position(post, include_draft=False)
+    first = position // shard_size + 1
+    last = storage.count_posts(include_draft=False) // shard_size + 1 \
+        if shift else first
+    cache.delete_memoized(sitemap)
+    for shard in range(first, last + 1):
+        cache.delete(_get_sitemap_shard_key(shard))
+
+
+def _get_sitemap_shard_key(shard):
+    return "sitemap-shard:%d" % shard
+
+
+def _cache_sitemap_shard(blogging_engine, shard, chunks):
+    """
+    Yield the ``chunks`` of a sitemap shard, and cache the shard as
+    ``compressed_func`` does once all of them were sent, so that the shard
+    is not held in memory before the first chunk goes out.
+    """
+    config = blogging_engine.config
+    encodings = config.get("BLOGGING_CACHE_COMPRESSION") or []
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    bodies = _compress_bodies("".join(parts).encode("utf-8"),
+                              _get_compressors(encodings))
+    value = dict(status=200, headers=[("Content-Type", "application/xml")],
+                 bodies=bodies)
+    blogging_engine.cache.set(_get_sitemap_shard_key(shard), value,
+                              timeout=config.get("BLOGGING_CACHE_TIMEOUT", 60))
+
+
+def sitemap():
+    """
+    Serves the sitemap index, which links to the shards of the sitemap.
+    The shards list the posts from the oldest, ``BLOGGING_SITEMAP_SHARD_SIZE``
+    posts at a time, so new posts only change the last shard.
+    """
+    blogging_engine = _get_blogging_engine(current_app)
+    config = blogging_engine.config
+    count = blogging_engine.storage.count_posts(include_draft=False)
+    num_shards = max(int(math.ceil(count / _get_shard_size(config))), 1)
+    response = make_response(render_template(
+        "blogging/sitemap_index.xml", shards=range(1, num_shards + 1),
+        config=config))
     response.headers["Content-Type"] = "application/xml"
     return response
 
 
-def feed():
+def sitemap_shard(shard):
+    """
+    Serves a shard of the sitemap. The posts are fetched in batches of
+    ``BLOGGING_SITEMAP_BATCH_SIZE`` while the response is streamed, so the
+    memory used does not grow with the number of posts. The signals are
+    sent for each batch, with posts that only have the ``_SITEMAP_FIELDS``
+    and the keys added by the processing. If the blog has a cache, the
+    shard is cached once it was streamed in full.
+    """
+    blogging_engine = _get_blogging_engine(current_app)
+    storage = blogging_engine.storage
+    config = blogging_engine.config
+    cache = blogging_engine.cache
+    use_cache = cache is not None and not unless(blogging_engine)()
+    if use_cache:
+        value = cache.get(_get_sitemap_shard_key(shard))
+        if value is not None:
+            return _negotiated_response(
+                value, config.get("BLOGGING_CACHE_COMPRESSION") or [])
+    shard_size = _get_shard_size(config)
+    batches = storage.iter_post_batches(
+        batch_size=config.get("BLOGGING_SITEMAP_BATCH_SIZE", 1000),
+        include_draft=False, fields=_SITEMAP_FIELDS, recent=False,
+        offset=(shard - 1) * shard_size, count=shard_size)
+    # the first batch is processed before the response is sent
+    first_batch = _process_sitemap_posts(blogging_engine,
+                                         next(batches, []))
+    if shard > 1 and not first_batch:
+        abort(404)
+    posts = _iter_sitemap_posts(blogging_engine, first_batch, batches)
+    context = dict(posts=posts, config=config)
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_or_select_template(
+        "blogging/sitemap.xml")
+    chunks = template.generate(context)
+    if use_cache:
+        chunks = _cache_sitemap_shard(blogging_engine, shard, chunks)
+    response = Response(stream_with_context(chunks),
+                        content_type="application/xml")
+    if use_cache:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+class _FeedEntryFragment(FeedEntry):
+    """
+    An entry of an ``AtomFeed`` given by the XML generated for it before.
+    It is a ``FeedEntry`` so that ``AtomFeed.add`` takes it, but only has
+    what ``AtomFeed.generate`` of feedwerk reads from its entries: the lines
+    of ``generate``, the ``updated`` date and the ``author``. A new version
+    of feedwerk that reads more from the entries needs more here.
+    """
+
+    def __init__(self, lines, updated, author):
+        # FeedEntry.__init__ is not called, as the XML is already generated
+        self.lines = lines
+        self.updated = updated
+        self.author = author
+
+    def generate(self):
+        return iter(self.lines)
+
+
+def _get_feed_entry_key(blogging_engine, post, user_name):
+    # the name of the author is not stored with the post, so it is part of
+    # the key for the entry to change when the author is renamed
+    config = blogging_engine.config
+    value = "%s|%s|%s|%s|%s" % (
+        post["post_id"], post["last_modified_date"].isoformat(), user_name,
+        config.get("BLOGGING_SITEURL", ""),
+        blogging_engine.post_processor.renderer_version())
+    return "feed:" + hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+
+def _add_feed_entries(blogging_engine, feed, posts):
+    """
+    Add the entries of the posts to the feed. The XML of each entry is kept
+    in the render cache by ``post_id``, ``last_modified_date`` and name of
+    the author, so only the posts that are new or changed since are
+    processed and rendered. The authors are loaded in one go for the keys.
+    """
+    post_processor = blogging_engine.post_processor
+    config = blogging_engine.config
+    users = blogging_engine.load_users(
+        frozenset(post["user_id"] for post in posts))
+    keys = []
+    for post in posts:
+        author = users[post["user_id"]]
+        user_name = blogging_engine.get_user_name(author) \
+            if author is not None else None
+        keys.append(_get_feed_entry_key(blogging_engine, post, user_name))
+    cached = [post_processor.get_fragment(key) for key in keys]
+    missing = [post for post, fragment in zip(posts, cached)
+               if fragment is None]
+    if missing:
+        blogging_engine.process_posts(missing, render=True)
+    for post, key, fragment in zip(posts, keys, cached):
+        if fragment is None:
+            entry = FeedEntry(
+                post["title"], ensureUtf(post["rendered_text"]),
+                content_type='html', author=post["user_name"],
+                url=config.get("BLOGGING_SITEURL", "")+post["url"],
+                updated=post["last_modified_date"],
+                published=post["post_date"])
+            fragment = (tuple(entry.generate()), entry.updated, entry.author)
+            if not post["meta"].get("render_timeout"):
+                post_processor.set_fragment(key, fragment)
+        feed.add(_FeedEntryFragment(*fragment))
+
+
+def _get_feed(title, tag=None, user_id=None):
     blogging_engine = _get_blogging_engine(current_app)
     storage = blogging_engine.storage
     config = blogging_engine.config
     count = config.get("BLOGGING_FEED_LIMIT")
     posts = storage.get_posts(count=count, offset=None, recent=True,
-                              user_id=None, tag=None, include_draft=False)
+                              user_id=user_id, tag=tag, include_draft=False)
 
     feed = AtomFeed(
-        '%s - All Articles' % config.get("BLOGGING_SITENAME",
-                                         "Flask-Blogging"),
+        '%s - %s' % (config.get("BLOGGING_SITENAME", "Flask-Blogging"),
+                     title),
         feed_url=request.url, url=request.url_root, generator=None)
 
     feed_posts_fetched.send(blogging_engine.app, engine=blogging_engine,
                             posts=posts)
     if len(posts):
-        for post in posts:
-            blogging_engine.process_post(post, render=True)
-            feed.add(post["title"], ensureUtf(post["rendered_text"]),
-                     content_type='html',
-                     author=post["user_name"],
-                     url=config.get("BLOGGING_SITEURL", "")+post["url"],
-                     updated=post["last_modified_date"],
-                     published=post["post_date"])
+        _add_feed_entries(blogging_engine, feed, posts)
         feed_posts_processed.send(blogging_engine.app, engine=blogging_engine,
                                   feed=feed)
     response = feed.get_response()
@@ -366,6 +592,148 @@ def feed():
     return response
 
 
+def feed():
+    return _get_feed("All Articles")
+
+
+def feed_by_tag(tag):
+    return _get_feed("Posts tagged %s" % tag, tag=tag)
+
+
+def feed_by_author(user_id):
+    return _get_feed("Posts by %s" % user_id, user_id=user_id)
+
+
+# the fields of the posts given by the JSON API, with the fields of the
+# stored posts they are made from
+_API_FIELDS = OrderedDict([
+    ("post_id", ("post_id",)),
+    ("title", ("title",)),
+    ("slug", ("title", "slug")),
+    ("url", ("post_id", "title", "slug")),
+    ("post_date", ("post_date",)),
+    ("last_modified_date", ("last_modified_date",)),
+    ("user_id", ("user_id",)),
+    ("user_name", ("user_id",)),
+    ("tags", ("tags",)),
+    ("text", ("text",)),
+    ("rendered_text", ("text", "rendered_text", "renderer", "meta_data")),
+    ("word_count", ("text", "meta_data")),
+    ("reading_time", ("text", "meta_data")),
+    ("headings", ("text", "meta_data")),
+    ("first_image", ("text", "meta_data")),
+])
+
+_API_DEFAULT_FIELDS = ("post_id", "title", "slug", "url", "post_date",
+                       "last_modified_date", "user_id", "user_name", "tags")
+
+
+def _api_error(message, status):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def _get_api_fields(default_fields):
+    names = request.args.get("fields")
+    if not names:
+        return default_fields
+    fields = tuple(name.strip() for name in names.split(",") if name.strip())
+    unknown = [name for name in fields if name not in _API_FIELDS]
+    if unknown:
+        raise ValueError("Unknown fields: %s" % ", ".join(unknown))
+    return fields
+
+
+def _get_storage_fields(fields):
+    storage_fields = set()
+    for name in fields:
+        storage_fields.update(_API_FIELDS[name])
+    return tuple(sorted(storage_fields))
+
+
+def _serialise_api_post(post, fields):
+    values = OrderedDict()
+    for name in fields:
+        value = post.get(name)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        values[name] = value
+    return values
+
+
+def _api_listing_url(tag, user_id, **values):
+    values["fields"] = request.args.get("fields")
+    if tag:
+        return url_for("blogging.api_posts_by_tag", tag=tag, **values)
+    if user_id:
+        return url_for("blogging.api_posts_by_author", user_id=user_id,
+                       **values)
+    return url_for("blogging.api_index", **values)
+
+
+def _get_api_listing(tag=None, user_id=None):
+    blogging_engine = _get_blogging_engine(current_app)
+    config = blogging_engine.config
+    try:
+        fields = _get_api_fields(_API_DEFAULT_FIELDS)
+        count = min(int(request.args.get(
+            "count", config.get("BLOGGING_POSTS_PER_PAGE", 10))), 100)
+        if count < 1:
+            raise ValueError("The count must be positive")
+        posts, meta = _get_cursor_page(
+            blogging_engine.storage, count, after=request.args.get("after"),
+            before=request.args.get("before"), tag=tag, user_id=user_id,
+            fields=_get_storage_fields(fields), listing_url=_api_listing_url)
+    except ValueError as e:
+        return _api_error(str(e), 400)
+    # only the requested fields are rendered
+    blogging_engine.process_posts(posts, render="rendered_text" in fields)
+    return jsonify(posts=[_serialise_api_post(post, fields)
+                          for post in posts],
+                   next=meta["pagination"]["next_page"],
+                   prev=meta["pagination"]["prev_page"])
+
+
+def api_index():
+    """
+    Serves the most recent posts as JSON. The ``fields`` query argument is
+    a comma separated list of the fields of the posts to return, and the
+    ``count``, ``after`` and ``before`` arguments select the page.
+    """
+    return _get_api_listing()
+
+
+def api_posts_by_tag(tag):
+    return _get_api_listing(tag=tag)
+
+
+def api_posts_by_author(user_id):
+    return _get_api_listing(user_id=user_id)
+
+
+def api_page_by_id(post_id):
+    blogging_engine = _get_blogging_engine(current_app)
+    try:
+        fields = _get_api_fields(_API_DEFAULT_FIELDS + ("rendered_text",))
+    except ValueError as e:
+        return _api_error(str(e), 400)
+    post = blogging_engine.storage.get_post_by_id(post_id)
+    if post is None or \
+            (post["draft"] and not get_auth_context().is_author(post)):
+        return _api_error("The post was not found", 404)
+
+    def _get_response():
+        render = "rendered_text" in fields
+        blogging_engine.process_post(post, render=render)
+        return jsonify(post=_serialise_api_post(post, fields))
+    # the validator is only built once the post is known to be shown
+    if not _is_conditional(blogging_engine):
+        return _get_response()
+    return _conditional_response(blogging_engine, post["last_modified_date"],
+                                 1, _get_response)
+
+
 def unless(blogging_engine):
     # disable caching for bloggers. They can change state!
     def _unless():
@@ -373,6 +741,131 @@ def unless(blogging_engine):
     return _unless
 
 
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if_modified_since = request.if_modified_since
+    if if_modified_since is None:
+        return False
+    if if_modified_since.tzinfo is None:
+        if_modified_since = if_modified_since.replace(
+            tzinfo=datetime.timezone.utc)
+    # the header has a precision of one second
+    return last_modified.replace(microsecond=0) <= if_modified_since
+
+
+def conditional_func(blogging_engine, func, get_filter):
+    """
+    Answer the conditional ``GET`` requests for ``func`` with a ``304 Not
+    Modified`` response, before the posts are fetched, if the posts given by
+    ``get_filter(view_args)`` have not changed, as told by
+    ``Storage.get_validator``. This is enabled by
+    ``BLOGGING_CONDITIONAL_GET``.
+    """
+
+    @functools.wraps(func)
+    def _conditional_func(**kwargs):
+        if not _is_conditional(blogging_engine):
+            return func(**kwargs)
+        last_modified, count = blogging_engine.storage.get_validator(
+            include_draft=False, **get_filter(kwargs))
+        if last_modified is None:
+            return func(**kwargs)
+        return _conditional_response(blogging_engine, last_modified, count,
+                                     functools.partial(func, **kwargs))
+    return _conditional_func
+
+
+def _is_conditional(blogging_engine):
+    # bloggers see the editing links, and flashed messages are shown
+    # once, so these responses are not cached by the client
+    config = blogging_engine.config
+    return config.get("BLOGGING_CONDITIONAL_GET", False) and \
+        request.method == "GET" and not session.get("_flashes") and \
+        not _is_blogger(blogging_engine.blogger_permission)
+
+
+def _conditional_response(blogging_engine, last_modified, count, func):
+    """
+    Answer with a ``304 Not Modified`` response if the validator built from
+    ``last_modified`` and ``count`` matches the request, and with the
+    response of ``func()`` otherwise.
+    """
+    last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    validator = "%s|%d|%s" % (
+        last_modified.isoformat(), count,
+        blogging_engine.post_processor.renderer_version())
+    etag = hashlib.sha1(validator.encode("utf-8")).hexdigest()
+    if _not_modified(etag, last_modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(func())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+
+def _get_compressors(encodings):
+    compressors = dict(gzip=gzip.compress)
+    if brotli is not None:
+        compressors["br"] = brotli.compress
+    elif "br" in encodings:
+        raise ImportError("The br cache compression needs brotli. "
+                          "Install it with 'pip install brotli'.")
+    unknown = set(encodings) - set(compressors)
+    if unknown:
+        raise ValueError("Unknown cache compression %s" %
+                         ", ".join(sorted(unknown)))
+    return [(encoding, compressors[encoding]) for encoding in encodings]
+
+
+def _compress_bodies(data, compressors):
+    bodies = dict(identity=data)
+    for encoding, compress in compressors:
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            bodies[encoding] = compressed
+    return bodies
+
+
+def compressed_func(func, encodings):
+    """
+    Turn the response of ``func`` into a ``dict`` that holds the status,
+    the headers and the body of the response, along with the body
+    compressed with each of the ``encodings``, so that the compressed bodies
+    can be cached with the response. Only the bodies of ``200`` responses
+    that get smaller are kept.
+    """
+    compressors = _get_compressors(encodings)
+
+    @functools.wraps(func)
+    def _compressed_func(**kwargs):
+        response = make_response(func(**kwargs))
+        data = response.get_data()
+        bodies = _compress_bodies(data, compressors) \
+            if response.status_code == 200 else dict(identity=data)
+        headers = [(key, value) for key, value in response.headers
+                   if key.lower() != "content-length"]
+        return dict(status=response.status_code, headers=headers,
+                    bodies=bodies)
+    return _compressed_func
+
+
+def _negotiated_response(value, encodings):
+    bodies = value["bodies"]
+    offered = [encoding for encoding in encodings if encoding in bodies]
+    encoding = request.accept_encodings.best_match(
+        offered + ["identity"], default="identity")
+    response = Response(bodies[encoding], status=value["status"],
+                        headers=value["headers"])
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 def cached_func(blogging_engine, func):
     cache = blogging_engine.cache
     if cache is None:
@@ -381,41 +874,76 @@ def cached_func(blogging_engine, func):
         unless_func = unless(blogging_engine)
         config = blogging_engine.config
         cache_timeout = config.get("BLOGGING_CACHE_TIMEOUT", 60)  # 60 seconds
-        memoized_func = cache.memoize(
-            timeout=cache_timeout, unless=unless_func)(func)
-        return memoized_func
+        encodings = config.get("BLOGGING_CACHE_COMPRESSION")
+        if not encodings:
+            memoized_func = cache.memoize(
+                timeout=cache_timeout, unless=unless_func)(func)
+            return memoized_func
+        # the compressed bodies are cached, so hits are not compressed again
+        memoized_func = cache.memoize(timeout=cache_timeout)(
+            compressed_func(func, encodings))
+
+        @functools.wraps(memoized_func)
+        def _cached_func(**kwargs):
+            if unless_func():
+                return func(**kwargs)
+            return _negotiated_response(memoized_func(**kwargs), encodings)
+        return _cached_func
 
 
 def create_blueprint(import_name, blogging_engine):
 
     blog_app = Blueprint("blogging", import_name, template_folder='templates')
 
+    @blog_app.context_processor
+    def auth_context_processor():
+        return dict(blogging_auth=get_auth_context(
+            blogging_engine.blogger_permission))
+
     # register index
-    index_func = cached_func(blogging_engine, index)
+    index_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, index),
+        lambda view_args: {})
     blog_app.add_url_rule("/", defaults={"count": None, "page": 1},
                           view_func=index_func)
     blog_app.add_url_rule("/<int:count>/", defaults={"page": 1},
                           view_func=index_func)
     blog_app.add_url_rule("/<int:count>/<int:page>/", view_func=index_func)
+    blog_app.add_url_rule("/<int:count>/after/<after>/",
+                          defaults={"page": None}, view_func=index_func)
+    blog_app.add_url_rule("/<int:count>/before/<before>/",
+                          defaults={"page": None}, view_func=index_func)
 
     # register page_by_id
-    page_by_id_func = cached_func(blogging_engine, page_by_id)
+    page_by_id_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, page_by_id),
+        lambda view_args: dict(post_id=view_args["post_id"]))
     blog_app.add_url_rule("/page/<post_id>/", defaults={"slug": ""},
                           view_func=page_by_id_func)
     blog_app.add_url_rule("/page/<post_id>/<slug>/",
                           view_func=page_by_id_func)
 
     # register posts_by_tag
-    posts_by_tag_func = cached_func(blogging_engine, posts_by_tag)
+    posts_by_tag_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, posts_by_tag),
+        lambda view_args: dict(tag=view_args["tag"]))
     blog_app.add_url_rule("/tag/<tag>/", defaults=dict(count=None, page=1),
                           view_func=posts_by_tag_func)
     blog_app.add_url_rule("/tag/<tag>/<int:count>/", defaults=dict(page=1),
                           view_func=posts_by_tag_func)
     blog_app.add_url_rule("/tag/<tag>/<int:count>/<int:page>/",
                           view_func=posts_by_tag_func)
+    blog_app.add_url_rule("/tag/<tag>/<int:count>/after/<after>/",
+                          defaults=dict(page=None),
+                          view_func=posts_by_tag_func)
+    blog_app.add_url_rule("/tag/<tag>/<int:count>/before/<before>/",
+                          defaults=dict(page=None),
+                          view_func=posts_by_tag_func)
 
     # register posts_by_author
-    posts_by_author_func = cached_func(blogging_engine, posts_by_author)
+    posts_by_author_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, posts_by_author),
+        lambda view_args: dict(user_id=view_args["user_id"]))
     blog_app.add_url_rule("/author/<user_id>/",
                           defaults=dict(count=None, page=1),
                           view_func=posts_by_author_func)
@@ -424,6 +952,12 @@ def create_blueprint(import_name, blogging_engine):
                           view_func=posts_by_author_func)
     blog_app.add_url_rule("/author/<user_id>/<int:count>/<int:page>/",
                           view_func=posts_by_author_func)
+    blog_app.add_url_rule("/author/<user_id>/<int:count>/after/<after>/",
+                          defaults=dict(page=None),
+                          view_func=posts_by_author_func)
+    blog_app.add_url_rule("/author/<user_id>/<int:count>/before/<before>/",
+                          defaults=dict(page=None),
+                          view_func=posts_by_author_func)
 
     # register editor
     editor_func = editor  # For now lets not cache this
@@ -438,12 +972,47 @@ def create_blueprint(import_name, blogging_engine):
     blog_app.add_url_rule("/delete/<post_id>/", methods=["POST"],
                           view_func=delete_func)
 
-    # register sitemap
-    sitemap_func = cached_func(blogging_engine, sitemap)
+    # register sitemap index and shards
+    sitemap_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, sitemap),
+        lambda view_args: {})
     blog_app.add_url_rule("/sitemap.xml", view_func=sitemap_func)
+    # the shards are cached by the view, as they are streamed
+    sitemap_shard_func = conditional_func(
+        blogging_engine, sitemap_shard, lambda view_args: {})
+    blog_app.add_url_rule("/sitemap-<int:shard>.xml",
+                          view_func=sitemap_shard_func)
+
+    # register JSON API, which is not cached, as it depends on the query
+    api_index_func = conditional_func(blogging_engine, api_index,
+                                      lambda view_args: {})
+    blog_app.add_url_rule("/api/posts/", view_func=api_index_func)
+    api_posts_by_tag_func = conditional_func(
+        blogging_engine, api_posts_by_tag,
+        lambda view_args: dict(tag=view_args["tag"]))
+    blog_app.add_url_rule("/api/tag/<tag>/", view_func=api_posts_by_tag_func)
+    api_posts_by_author_func = conditional_func(
+        blogging_engine, api_posts_by_author,
+        lambda view_args: dict(user_id=view_args["user_id"]))
+    blog_app.add_url_rule("/api/author/<user_id>/",
+                          view_func=api_posts_by_author_func)
+    # the page checks drafts before it answers conditional requests
+    blog_app.add_url_rule("/api/page/<post_id>/", view_func=api_page_by_id)
 
     # register feed
-    feed_func = cached_func(blogging_engine, feed)
+    feed_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, feed),
+        lambda view_args: {})
     blog_app.add_url_rule('/feeds/all.atom.xml', view_func=feed_func)
+    feed_by_tag_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, feed_by_tag),
+        lambda view_args: dict(tag=view_args["tag"]))
+    blog_app.add_url_rule('/feeds/tag/<tag>.atom.xml',
+                          view_func=feed_by_tag_func)
+    feed_by_author_func = conditional_func(
+        blogging_engine, cached_func(blogging_engine, feed_by_author),
+        lambda view_args: dict(user_id=view_args["user_id"]))
+    blog_app.add_url_rule('/feeds/author/<user_id>.atom.xml',
+                          view_func=feed_by_author_func)
 
     return blog_app
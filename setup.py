@@ -60,6 +60,8 @@ setup(
     include_package_data=True,
     platforms='any',
     install_requires=get_requirements(),
+    extras_require={"commonmark": ["markdown-it-py"],
+                    "brotli": ["brotli"]},
     tests_require=["nose", "mysqlclient", "psycopg2"],
     test_suite='nose.collector',
     classifiers=[
@@ -22,3 +22,6 @@ class FlaskBloggingTestCase(unittest.TestCase):
 class TestUser(UserMixin):
     def __init__(self, user_id):
         self.id = user_id
+
+    def get_name(self):
+        return self.id
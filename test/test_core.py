@@ -3,9 +3,35 @@ try:
 except ImportError:
     pass
 
+import re
+import sys
+import time
+import subprocess
+import threading
+import pickle
+import multiprocessing
+import jinja2
+import unittest.mock
 from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from flask_blogging import BloggingEngine, PostProcessor
-from markdown.extensions.codehilite import CodeHiliteExtension
+from flask_blogging.processor import MathJaxExtension, init_render_worker, \
+    split_blocks
+from flask_blogging.post import Post
+from flask_blogging.rendercache import LRURenderCache
+from flask_blogging.renderers import CommonMarkRenderer, \
+    PythonMarkdownRenderer, Renderer, SandboxedRenderer, get_renderer, \
+    plain_text_fallback
+from flask_blogging.signals import render_timed_out
+from flask_blogging.utils import text_metadata
+from markdown.extensions.codehilite import CodeHilite, CodeHiliteExtension
+from markdown.extensions.fenced_code import FencedCodeExtension
+from markdown.extensions.meta import MetaExtension
+from markdown.extensions.toc import TocExtension
+try:
+    import markdown_it
+except ImportError:
+    markdown_it = None
 
 
 sample_markdown = """
@@ -26,6 +52,56 @@ expected_markup = u'<h2>This is a test</h2>\n' \
                   u'</pre></div>'
 
 
+_TAG_RE = re.compile(
+    r'<(\w+)((?:\s+[\w-]+=(?:"[^"]*"|\'[^\']*\'))*)(\s*/?)>')
+_ATTRIBUTE_RE = re.compile(r'([\w-]+)=("[^"]*"|\'[^\']*\')')
+
+
+def normalise_html(html):
+    # the renderers write the attributes of a tag in different orders
+    def sort_attributes(match):
+        attributes = sorted(_ATTRIBUTE_RE.findall(match.group(2)))
+        return "<%s%s%s>" % (match.group(1), "".join(
+            " %s=%s" % attribute for attribute in attributes),
+            match.group(3))
+    return _TAG_RE.sub(sort_attributes, html.strip())
+
+
+class SlowRenderer(Renderer):
+
+    def convert(self, post_processor, text):
+        if "slow" in text:
+            time.sleep(5)
+        if "fail" in text:
+            raise ValueError(text)
+        return "<p>%s</p>" % text, {}
+
+    def fingerprint(self, post_processor):
+        return "slow"
+
+
+class FlakyRenderer(Renderer):
+
+    def __init__(self):
+        self.calls = 0
+
+    def convert(self, post_processor, text):
+        self.calls += 1
+        if self.calls == 1:
+            return plain_text_fallback(text)
+        return "<p>%s</p>" % text, {}
+
+    def fingerprint(self, post_processor):
+        return "flaky"
+
+    def block_safe(self, post_processor):
+        return True
+
+
+class WorkerProcessor(PostProcessor):
+    _markdown_extensions = [MathJaxExtension(), MetaExtension()]
+
+
 class TestCore(TestCase):
 
     def setUp(self):
@@ -40,3 +116,409 @@ class TestCore(TestCase):
         extns = engine.post_processor.all_extensions()
         self.assertEqual(len(extns), 3)
         self.assertTrue(isinstance(extns[-1], CodeHiliteExtension))
+
+    def test_slug(self):
+        self.assertEqual(PostProcessor.get_slug({"title": "Título Uno"}),
+                         "titulo-uno")
+        # a stored slug is used as is
+        self.assertEqual(PostProcessor.get_slug(
+            {"title": "Título Uno", "slug": "stored"}), "stored")
+        hits = PostProcessor.create_slug.cache_info().hits
+        PostProcessor.create_slug("Título Uno")
+        self.assertEqual(PostProcessor.create_slug.cache_info().hits,
+                         hits + 1)
+
+    def test_lazy_post(self):
+        calls = []
+
+        def set_values(post):
+            calls.append(post.get("a"))
+            post["a"], post["b"] = 1, 2
+
+        post = Post(a=0, c=3)
+        post.defer(("a", "b"), set_values)
+        self.assertIn("b", post)
+        self.assertEqual(calls, [])
+        self.assertEqual(post["b"], 2)
+        self.assertEqual(post["a"], 1)
+        # the stored value is visible to the deferred function, once
+        self.assertEqual(calls, [0])
+
+        # values set explicitly win over deferred ones
+        post.defer(("a", "b"), set_values)
+        post["b"] = 4
+        self.assertEqual(dict(post), {"a": 1, "b": 4, "c": 3})
+
+    def test_post_record(self):
+        post = Post(title="Title", tags=["a"], custom="value")
+        self.assertFalse(hasattr(post, "__dict__"))
+        self.assertEqual(post["title"], "Title")
+        self.assertEqual(post.get("text", "missing"), "missing")
+        self.assertNotIn("text", post)
+        self.assertEqual(dict(post),
+                         {"title": "Title", "tags": ["a"], "custom": "value"})
+        del post["custom"]
+        self.assertEqual(len(post), 2)
+        self.assertEqual(pickle.loads(pickle.dumps(post)), post)
+        template = jinja2.Template("{{ post.title }} {{ post.tags[0] }}"
+                                   "{{ post.missing }}")
+        self.assertEqual(template.render(post=post), "Title a")
+
+    def test_process_lazy_post(self):
+        post = Post(title="Título", text="# Hello", post_id=1, user_id=1)
+        # no request context is needed until the url is accessed
+        PostProcessor.process(post, render=True)
+        self.assertTrue(post.is_deferred("rendered_text"))
+        self.assertEqual(post["slug"], "titulo")
+        self.assertEqual(post["rendered_text"], "<h1>Hello</h1>")
+        self.assertFalse(post.is_deferred("meta"))
+        self.assertTrue(post.is_deferred("url"))
+
+    def test_template_resolves_deferred_post(self):
+        post = Post(title="Title", text="# Fresh", post_id=1, user_id=1,
+                    rendered_text="<h1>OLD STALE</h1>")
+        PostProcessor.process(post, render=True)
+        self.assertTrue(post.is_deferred("rendered_text"))
+        template = jinja2.Template("{{ post.rendered_text }}|{{ post.slug }}")
+        self.assertEqual(template.render(post=post), "<h1>Fresh</h1>|title")
+        self.assertFalse(post.is_deferred("rendered_text"))
+
+    def test_text_metadata(self):
+        text = "title: A post\n\n# Hello *World*\n\n" \
+               "Some [linked](/x) text\n\nSub\n---\n\n" \
+               "```\n# not a heading\n```\n\n# Hello World\n\n" \
+               "![alt](/a.png) and ![b](/b.png)"
+        derived = text_metadata(text)
+        self.assertEqual(derived["word_count"], 14)
+        self.assertEqual(derived["reading_time"], 1)
+        self.assertEqual(derived["headings"], [
+            dict(level=1, text="Hello World", id="hello-world"),
+            dict(level=2, text="Sub", id="sub"),
+            dict(level=1, text="Hello World", id="hello-world_1")])
+        self.assertEqual(derived["first_image"], "/a.png")
+        self.assertEqual(text_metadata(""), dict(
+            word_count=0, reading_time=0, headings=[], first_image=None))
+
+        # stored derived metadata is used, and computed for older posts
+        post = Post(post_id=1, title="A post", text="One two three",
+                    meta_data=dict(derived=dict(word_count=400,
+                                                reading_time=2)))
+        PostProcessor.process(post, render=False)
+        self.assertEqual(post["reading_time"], 2)
+        post = Post(post_id=1, title="A post", text="One two three")
+        PostProcessor.process(post, render=False)
+        self.assertEqual(post["word_count"], 3)
+        self.assertEqual(post["headings"], [])
+
+    def test_render_cache(self):
+        cache = LRURenderCache(maxsize=2)
+        PostProcessor.set_render_cache(cache)
+        try:
+            post = dict(text="Summary: cached\n\n# Hello")
+            PostProcessor.render_text(post)
+            self.assertEqual(post["rendered_text"], "<h1>Hello</h1>")
+            self.assertEqual(post["meta"]["summary"], ["cached"])
+            self.assertEqual(len(cache), 1)
+
+            # mutating the rendered metadata must not leak into the cache
+            post["meta"]["summary"] = []
+            cached_post = dict(text=post["text"])
+            PostProcessor.render_text(cached_post)
+            self.assertEqual(cached_post["meta"]["summary"], ["cached"])
+            self.assertEqual(len(cache), 1)
+
+            # least recently used entries are evicted
+            PostProcessor.render_text(dict(text="one"))
+            PostProcessor.render_text(dict(text="two"))
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get(PostProcessor.cache_key(post["text"])))
+        finally:
+            PostProcessor.set_render_cache(None)
+
+    def test_code_cache(self):
+        class CodeProcessor(PostProcessor):
+            _markdown_extensions = [MetaExtension(), FencedCodeExtension(),
+                                    CodeHiliteExtension()]
+
+        text = "```python\nprint(1)\n```\n\n    :::python\n    x = 2"
+        expected = CodeProcessor.convert_markdown(text)[0]
+        cache = LRURenderCache()
+        CodeProcessor.set_render_cache(cache)
+        hilite = CodeHilite.hilite
+        calls = []
+
+        def counting_hilite(self, *args, **kwargs):
+            calls.append(self.src)
+            return hilite(self, *args, **kwargs)
+
+        with unittest.mock.patch.object(CodeHilite, "hilite",
+                                        counting_hilite):
+            self.assertEqual(CodeProcessor.convert_markdown(text)[0],
+                             expected)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(len(cache), 2)
+            # the same snippets in another post are not highlighted again
+            other = "# Other\n\n" + text
+            self.assertIn(expected, CodeProcessor.convert_markdown(other)[0])
+            self.assertEqual(len(calls), 2)
+            # a different language is
+            CodeProcessor.convert_markdown(text.replace("python", "js", 1))
+            self.assertEqual(len(calls), 3)
+
+    def test_sandboxed_renderer(self):
+        renderer = SandboxedRenderer(SlowRenderer(), timeout=0.5)
+        timed_out = []
+
+        def receiver(sender, text, timeout):
+            timed_out.append((sender, text, timeout))
+
+        render_timed_out.connect(receiver)
+        try:
+            self.assertEqual(renderer.convert(PostProcessor, "fast"),
+                             ("<p>fast</p>", {}))
+            rendered_text, meta = renderer.convert(
+                PostProcessor, "title: x\n\n<b>slow</b>")
+            self.assertEqual(rendered_text,
+                             "<pre>&lt;b&gt;slow&lt;/b&gt;</pre>")
+            self.assertEqual(meta["title"], ["x"])
+            self.assertTrue(meta["render_timeout"])
+            self.assertEqual(renderer.timeouts, 1)
+            self.assertEqual(timed_out, [(PostProcessor,
+                                          "title: x\n\n<b>slow</b>", 0.5)])
+            # the killed worker is replaced
+            self.assertEqual(renderer.convert(PostProcessor, "again"),
+                             ("<p>again</p>", {}))
+            self.assertRaises(ValueError, renderer.convert, PostProcessor,
+                              "fail")
+            self.assertEqual(renderer.fingerprint(PostProcessor), "slow")
+        finally:
+            render_timed_out.disconnect(receiver)
+            renderer.close()
+
+        PostProcessor.set_renderer(
+            SandboxedRenderer(SlowRenderer(), timeout=0.5))
+        try:
+            self.assertEqual(PostProcessor.prerender("slow"), {})
+        finally:
+            PostProcessor._renderer.close()
+            PostProcessor.set_renderer(None)
+
+    def test_render_timeout_not_cached(self):
+        PostProcessor.set_render_cache(LRURenderCache())
+        try:
+            for text, block_cache in (("text", False), ("blocks", True)):
+                PostProcessor.set_block_cache(block_cache)
+                PostProcessor.set_renderer(FlakyRenderer())
+                _, meta = PostProcessor.convert(text)
+                self.assertTrue(meta["render_timeout"])
+                # a later successful render replaces the fallback
+                for _ in range(2):
+                    rendered_text, meta = PostProcessor.convert(text)
+                    self.assertEqual(rendered_text, "<p>%s</p>" % text)
+                    self.assertNotIn("render_timeout", meta)
+                self.assertEqual(PostProcessor._renderer.calls, 2)
+
+            PostProcessor.set_block_cache(False)
+            PostProcessor.set_renderer(FlakyRenderer())
+            posts = [{"text": "many"}]
+            PostProcessor.render_many(posts)
+            self.assertTrue(posts[0]["meta"]["render_timeout"])
+            PostProcessor.render_many(posts)
+            self.assertEqual(posts[0]["rendered_text"], "<p>many</p>")
+        finally:
+            PostProcessor.set_block_cache(False)
+            PostProcessor.set_render_cache(None)
+            PostProcessor.set_renderer(None)
+
+    def test_render_cache_key(self):
+        key = PostProcessor.cache_key("# Hello")
+        self.assertEqual(key, PostProcessor.cache_key("# Hello"))
+        self.assertNotEqual(key, PostProcessor.cache_key("# Hello!"))
+
+    def test_markdown_instance_reuse(self):
+        md = PostProcessor.get_markdown()
+        self.assertIs(md, PostProcessor.get_markdown())
+
+        # metadata of a previous conversion does not leak into the next one
+        _, meta = PostProcessor.convert("Summary: first\n\n![a](/a.png)")
+        self.assertEqual(meta["summary"], ["first"])
+        self.assertEqual(meta["images"], ["/a.png"])
+        _, meta = PostProcessor.convert("Text")
+        self.assertEqual(meta, {"images": [], "image_details": []})
+
+        # every thread has its own instance
+        instances = []
+        thread = threading.Thread(
+            target=lambda: instances.append(PostProcessor.get_markdown()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(instances[0], md)
+
+    def test_render_many(self):
+        texts = ["# Post %d\n\n![image](/img/%d.png)" % (i, i)
+                 for i in range(6)]
+        expected = []
+        for text in texts:
+            post = dict(text=text)
+            PostProcessor.render_post(post)
+            expected.append(post)
+
+        for executor_class in (ThreadPoolExecutor, ProcessPoolExecutor):
+            posts = [dict(text=text) for text in texts]
+            with executor_class(max_workers=2) as executor:
+                PostProcessor.render_many(posts, executor=executor)
+            for post, expected_post in zip(posts, expected):
+                self.assertEqual(post["rendered_text"],
+                                 expected_post["rendered_text"])
+                self.assertEqual(post["meta"], expected_post["meta"])
+
+    def test_render_many_spawned_workers(self):
+        # spawned workers only get the extensions set up at run time from
+        # the initializer
+        WorkerProcessor.set_custom_extensions([TocExtension()])
+        posts = [dict(text="# Heading %d" % i) for i in range(4)]
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+                max_workers=2, mp_context=context,
+                initializer=init_render_worker,
+                initargs=WorkerProcessor.worker_initargs()) as executor:
+            WorkerProcessor.render_many(posts, executor=executor)
+        for i, post in enumerate(posts):
+            self.assertEqual(post["rendered_text"],
+                             '<h1 id="heading-%d">Heading %d</h1>' % (i, i))
+
+    def test_extract_images(self):
+        text = 'Inline <img src="/inline.png" width="20"> image\n\n' \
+               '<div><img alt="raw" src=\'/raw.png\'></div>\n\n' \
+               '![markdown](/img.png?a=1&b=2 "Title")\n\n' \
+               '* ![](/list.png)'
+        post = dict(text=text)
+        PostProcessor.render_post(post)
+        self.assertEqual(post["meta"]["images"],
+                         ["/inline.png", "/raw.png", "/img.png?a=1&b=2",
+                          "/list.png"])
+        self.assertEqual(post["meta"]["image_details"], [
+            {"src": "/inline.png", "width": "20"},
+            {"src": "/raw.png", "alt": "raw"},
+            {"src": "/img.png?a=1&b=2", "alt": "markdown"},
+            {"src": "/list.png"}])
+        # the regex over the HTML misses single quoted attributes
+        self.assertEqual(PostProcessor.extract_images(post),
+                         ["/inline.png", "/img.png?a=1&amp;b=2", "/list.png"])
+
+    def test_render_many_serial_fallback(self):
+        executor = unittest.mock.Mock()
+        posts = [dict(text="# Post %d" % i) for i in range(3)]
+        PostProcessor.render_many(posts, executor=executor, min_batch_size=4)
+        executor.map.assert_not_called()
+        self.assertEqual(posts[2]["rendered_text"], "<h1>Post 2</h1>")
+
+    def test_convert_blocks(self):
+        text = "Title: Blocks\n\n# Heading\n\nSee [the docs][docs].\n\n" \
+               "> quoted\n\n> twice\n\nKeywords: not metadata\n\n" \
+               "![first](/1.png)\n\n```\ncode\n\nmore\n```\n\n" \
+               "[docs]: https://example.com \"Docs\""
+        PostProcessor.set_render_cache(LRURenderCache(maxsize=64))
+        PostProcessor.set_block_cache(True)
+        try:
+            expected = PostProcessor.convert_markdown(text)
+            self.assertEqual(PostProcessor.convert_blocks(text), expected)
+
+            # only the edited block is converted again
+            edited = text.replace("# Heading", "# Edited")
+            with unittest.mock.patch.object(
+                    PostProcessor, "convert_markdown",
+                    wraps=PostProcessor.convert_markdown) as convert:
+                rendered_text, meta = PostProcessor.convert(edited)
+                self.assertEqual(convert.call_count, 1)
+            self.assertIn("<h1>Edited</h1>", rendered_text)
+            self.assertEqual(meta["title"], ["Blocks"])
+            self.assertEqual(meta["images"], ["/1.png"])
+
+            # raw html blocks are converted with the whole text
+            html = "<div>\n\nraw\n\n</div>\n\ntext"
+            self.assertEqual(PostProcessor.convert_blocks(html),
+                             PostProcessor.convert_markdown(html))
+        finally:
+            PostProcessor.set_block_cache(False)
+            PostProcessor.set_render_cache(None)
+
+    @unittest.skipIf(markdown_it is None, "markdown-it-py is not installed")
+    def test_commonmark_renderer(self):
+        texts = [
+            "Title: A post\nTags: one, two\n    three\n\n# Heading\n\n"
+            "Inline $x^2 < 1$ and $$\\sum_{i=0}^n i$$ but `$code$`.\n\n"
+            "![alt](/a.png) <img src='/b.png' width=\"3\">",
+            "---\ntitle: Yaml\n---\n\nText",
+            "No: metadata\nhere, as this line is text\n\nText",
+            "Summary: Math\n\n$$\na = b\nc = d\n$$\n\n"
+            "Inline $x <\ny$ over two lines, and $$a\n\\\\ b$$ too."]
+        renderer = get_renderer("commonmark")
+        self.assertIsInstance(renderer, CommonMarkRenderer)
+        fingerprint = PostProcessor.fingerprint()
+        PostProcessor.set_renderer(renderer)
+        try:
+            self.assertNotEqual(PostProcessor.fingerprint(), fingerprint)
+            for text in texts:
+                rendered_text, meta = PostProcessor.convert_markdown(text)
+                expected_text, expected_meta = \
+                    PythonMarkdownRenderer().convert(PostProcessor, text)
+                self.assertEqual(meta, expected_meta)
+                self.assertEqual(normalise_html(rendered_text),
+                                 normalise_html(expected_text))
+        finally:
+            PostProcessor.set_renderer(None)
+        self.assertEqual(PostProcessor.fingerprint(), fingerprint)
+
+    def test_fingerprint_is_stable(self):
+        # extension configs hold functions, whose repr changes with each
+        # interpreter, as TocExtension's slugify does
+        script = "from flask_blogging import PostProcessor\n" \
+                 "from markdown.extensions.toc import TocExtension\n" \
+                 "PostProcessor.set_custom_extensions([TocExtension()])\n" \
+                 "print(PostProcessor.fingerprint())\n" \
+                 "print(PostProcessor.renderer_version())\n"
+        outputs = [subprocess.check_output([sys.executable, "-c", script])
+                   for _ in range(2)]
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn(b"markdown.extensions.toc.slugify", outputs[0])
+        self.assertNotIn(b" at 0x", outputs[0])
+
+    def test_split_blocks(self):
+        text = "Title: Blocks\nTags: a\n\n# Heading\n\nFirst paragraph\n" \
+               "continued\n\n- one\n\n- two\n\n```\ncode\n\nmore code\n```" \
+               "\n\n    indented\n\n    code\n\nLast"
+        blocks = split_blocks(text)
+        self.assertEqual(blocks, [
+            "Title: Blocks\nTags: a", "# Heading",
+            "First paragraph\ncontinued", "- one\n\n- two",
+            "```\ncode\n\nmore code\n```", "    indented\n\n    code",
+            "Last"])
+        self.assertEqual(split_blocks("> one\n\n> two\n\nthree"),
+                         ["> one\n\n> two", "three"])
+
+    def test_excerpt(self):
+        text = "Summary: excerpt\n\n# Heading\n\nFirst\n\nSecond\n\nThird"
+        PostProcessor.set_excerpt_blocks(2)
+        try:
+            excerpt, more = PostProcessor.excerpt_text(text)
+            self.assertEqual(excerpt, "Summary: excerpt\n\n# Heading\n\nFirst")
+            self.assertTrue(more)
+
+            post = dict(text=text)
+            PostProcessor.render_excerpt(post)
+            self.assertEqual(post["excerpt"],
+                             "<h1>Heading</h1>\n<p>First</p>")
+            self.assertEqual(post["meta"]["summary"], ["excerpt"])
+
+            excerpt, more = PostProcessor.excerpt_text("First\n\nSecond")
+            self.assertEqual(excerpt, "First\n\nSecond")
+            self.assertFalse(more)
+
+            # the marker takes precedence over the number of blocks
+            excerpt, more = PostProcessor.excerpt_text(
+                "First\n\nSecond\n\nThird\n\n<!--more-->\n\nFourth")
+            self.assertEqual(excerpt, "First\n\nSecond\n\nThird\n\n")
+            self.assertTrue(more)
+        finally:
+            PostProcessor.set_excerpt_blocks(3)
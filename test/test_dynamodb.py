@@ -226,6 +226,28 @@ class TestDynamoDBStorage(FlaskBloggingTestCase):
         count = self.storage.count_posts(tag="world")
         self.assertEqual(count, 10)
 
+    def test_get_validator(self):
+        self.assertEqual(self.storage.get_validator(), (None, 0))
+        self._create_dummy_data()
+        posts = self.storage.get_posts(count=None)
+        latest = max(post["last_modified_date"] for post in posts)
+        self.assertEqual(self.storage.get_validator(), (latest, 20))
+        last_modified, count = self.storage.get_validator(user_id="newuser")
+        self.assertEqual((last_modified, count), (latest, 10))
+        last_modified, count = self.storage.get_validator(tag="hello")
+        self.assertLess(last_modified, latest)
+        self.assertEqual(count, 10)
+        post = posts[-1]
+        self.assertEqual(
+            self.storage.get_validator(post_id=post["post_id"]),
+            (post["last_modified_date"], 1))
+        pid = self.storage.save_post(title="Draft", text="Draft text",
+                                     user_id="testuser", tags=[], draft=True)
+        self.assertEqual(self.storage.get_validator(post_id=pid), (None, 0))
+        self.assertEqual(
+            self.storage.get_validator(post_id=pid, include_draft=True)[1],
+            1)
+
     def _create_dummy_data(self):
         for i in range(20):
             tags = ["hello"] if i < 10 else ["world"]
@@ -82,7 +82,7 @@ class TestSignals(FlaskBloggingTestCase):
 
     def test_sitemap_signals(self):
         with self.client:
-            response = self.client.get("/blog/sitemap.xml")
+            response = self.client.get("/blog/sitemap-1.xml")
             self.assertEqual(response.status_code, 200)
             self.assertEqual(self.engine.ctr_sitemap_posts, 2)
 
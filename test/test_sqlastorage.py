@@ -5,6 +5,7 @@ except ImportError:
 import unittest
 import unittest.mock
 import tempfile
+import datetime
 import os
 from flask_blogging.sqlastorage import SQLAStorage
 from sqlalchemy import create_engine
@@ -49,8 +50,9 @@ class TestSQLiteStorage(FlaskBloggingTestCase):
             metadata = self._meta
             table = metadata.tables[table_name]
             columns = [t.name for t in table.columns]
-            expected_columns = ['id', 'title', 'text', 'post_date',
-                                'last_modified_date', 'draft']
+            expected_columns = ['id', 'title', 'slug', 'text', 'post_date',
+                                'last_modified_date', 'draft',
+                                'rendered_text', 'renderer', 'meta_data']
             self.assertListEqual(columns, expected_columns)
 
     def test_tag_table_exists(self):
@@ -230,6 +232,65 @@ class TestSQLiteStorage(FlaskBloggingTestCase):
         self._assert_post(post, "Title2", "Sample Text2", "testuser",
                           ["HELLO", "MY", "WORLD"])
 
+    def test_save_rendered_post(self):
+        meta_data = {"meta": {"summary": ["A summary"], "images": []}}
+        pid = self.storage.save_post(title="Title1", text="# Sample Text",
+                                     user_id="testuser", tags=["hello"],
+                                     meta_data=meta_data,
+                                     rendered_text="<h1>Sample Text</h1>",
+                                     renderer="v1")
+        post = self.storage.get_post_by_id(pid)
+        self.assertEqual(post["rendered_text"], "<h1>Sample Text</h1>")
+        self.assertEqual(post["renderer"], "v1")
+        self.assertEqual(post["meta_data"]["meta"], meta_data["meta"])
+
+        # saving without rendered text clears the stale rendering
+        self.storage.save_post(title="Title1", text="# Edited",
+                               user_id="testuser", tags=["hello"],
+                               post_id=pid)
+        post = self.storage.get_post_by_id(pid)
+        self.assertNotIn("rendered_text", post)
+        self.assertNotIn("meta", post["meta_data"])
+
+    def test_save_post_derived_meta_data(self):
+        pid = self.storage.save_post(title="Title1",
+                                     text="# Heading\n\nSample text",
+                                     user_id="testuser", tags=["hello"])
+        post = self.storage.get_post_by_id(pid)
+        derived = post["meta_data"]["derived"]
+        self.assertEqual(derived["word_count"], 3)
+        self.assertEqual(derived["reading_time"], 1)
+        self.assertEqual(derived["headings"],
+                         [dict(level=1, text="Heading", id="heading")])
+        self.assertIsNone(derived["first_image"])
+
+    def test_update_rendered(self):
+        pid = self.storage.save_post(title="Title1", text="# Sample Text",
+                                     user_id="testuser", tags=["hello"])
+        meta_data = {"meta": {"images": []}}
+        self.assertTrue(self.storage.update_rendered(
+            pid, "<h1>Sample Text</h1>", "v2", meta_data))
+        post = self.storage.get_post_by_id(pid)
+        self.assertEqual(post["rendered_text"], "<h1>Sample Text</h1>")
+        self.assertEqual(post["renderer"], "v2")
+        self.assertEqual(post["meta_data"], meta_data)
+        self._assert_post(post, "Title1", "# Sample Text", "testuser",
+                          ["hello"])
+        self.assertFalse(self.storage.update_rendered(
+            pid + 100, "<p></p>", "v2"))
+
+    def test_save_post_slug(self):
+        pid = self.storage.save_post(title="Título Uno", text="Sample Text",
+                                     user_id="testuser", tags=["hello"],
+                                     slug="titulo-uno")
+        post = self.storage.get_post_by_id(pid)
+        self.assertEqual(post["slug"], "titulo-uno")
+
+        pid = self.storage.save_post(title="Title2", text="Sample Text",
+                                     user_id="testuser", tags=["hello"])
+        post = self.storage.get_post_by_id(pid)
+        self.assertNotIn("slug", post)
+
     def _assert_post(self, post, title, text, user_id, tags):
         tags = set([t.upper() for t in tags])
         self.assertSetEqual(set(post["tags"]), tags)
@@ -327,6 +388,113 @@ class TestSQLiteStorage(FlaskBloggingTestCase):
         count = self.storage.count_posts(user_id="testuser", tag="world")
         self.assertEqual(count, 0)
 
+    def test_get_page(self):
+        start = datetime.datetime(2020, 1, 1)
+        for i in range(5):
+            self.storage.save_post(title="Title%d" % i, text="Sample Text",
+                                   user_id="testuser",
+                                   tags=["hello", "world"] if i < 3
+                                   else ["world"],
+                                   post_date=start + datetime.timedelta(i))
+        posts, total = self.storage.get_page(count=2, offset=0)
+        self.assertEqual([p["title"] for p in posts], ["Title4", "Title3"])
+        self.assertEqual(total, 5)
+        self.assertEqual(set(posts[0]["tags"]), set(["WORLD"]))
+
+        posts, total = self.storage.get_page(count=2, offset=2, tag="hello")
+        self.assertEqual([p["title"] for p in posts], ["Title0"])
+        self.assertEqual(set(posts[0]["tags"]), set(["HELLO", "WORLD"]))
+        self.assertEqual(total, 3)
+
+        # past the last page, and for unknown tags
+        self.assertEqual(self.storage.get_page(count=2, offset=6), ([], 5))
+        self.assertEqual(self.storage.get_page(tag="unknown"), ([], 0))
+
+    def test_get_posts_by_cursor(self):
+        post_date = datetime.datetime(2020, 1, 1)
+        for i in range(5):
+            # posts of the same date are ordered by id
+            self.storage.save_post(title="Title%d" % i, text="Sample Text",
+                                   user_id="testuser", tags=["hello"],
+                                   post_date=post_date +
+                                   datetime.timedelta(i // 2))
+        posts = self.storage.get_posts_by_cursor(count=2)
+        self.assertEqual([p["title"] for p in posts], ["Title4", "Title3"])
+        cursor = self.storage.encode_cursor(posts[-1])
+        self.assertEqual(self.storage.decode_cursor(cursor),
+                         (posts[-1]["post_date"], posts[-1]["post_id"]))
+
+        posts = self.storage.get_posts_by_cursor(count=2, cursor=cursor,
+                                                 tag="hello")
+        self.assertEqual([p["title"] for p in posts], ["Title2", "Title1"])
+        cursor = self.storage.encode_cursor(posts[-1])
+        posts = self.storage.get_posts_by_cursor(count=2, cursor=cursor)
+        self.assertEqual([p["title"] for p in posts], ["Title0"])
+        posts = self.storage.get_posts_by_cursor(count=2, cursor=cursor,
+                                                 before=True)
+        self.assertEqual([p["title"] for p in posts], ["Title3", "Title2"])
+        self.assertRaises(ValueError, self.storage.get_posts_by_cursor,
+                          cursor="invalid")
+
+    def test_iter_post_batches(self):
+        post_date = datetime.datetime(2020, 1, 1)
+        for i in range(5):
+            self.storage.save_post(title="Title%d" % i, text="Sample Text",
+                                   user_id="testuser", tags=["hello"],
+                                   draft=(i == 2),
+                                   post_date=post_date +
+                                   datetime.timedelta(i // 2))
+        batches = list(self.storage.iter_post_batches(batch_size=2))
+        self.assertEqual([[p["title"] for p in posts] for posts in batches],
+                         [["Title4", "Title3"], ["Title1", "Title0"]])
+        self.assertEqual(batches[0][0]["tags"], ["HELLO"])
+
+        fields = ("post_id", "title", "last_modified_date")
+        batches = list(self.storage.iter_post_batches(batch_size=3,
+                                                      tag="hello",
+                                                      fields=fields))
+        self.assertEqual([[p["title"] for p in posts] for posts in batches],
+                         [["Title4", "Title3", "Title1"], ["Title0"]])
+        for post in batches[0]:
+            self.assertIn("last_modified_date", post)
+            self.assertNotIn("text", post)
+
+        for fields in [None, fields]:
+            batches = list(self.storage.iter_post_batches(
+                batch_size=2, fields=fields, recent=False, offset=1,
+                count=3))
+            self.assertEqual(
+                [[p["title"] for p in posts] for posts in batches],
+                [["Title1", "Title3"], ["Title4"]])
+
+    def test_get_posts_by_cursor_fields(self):
+        for i in range(3):
+            self.storage.save_post(title="Title%d" % i, text="Sample Text",
+                                   user_id="user%d" % i, tags=["a", "b%d" % i])
+        posts = self.storage.get_posts_by_cursor(
+            count=2, fields=("post_id", "title", "tags", "user_id"))
+        self.assertEqual([p["title"] for p in posts], ["Title2", "Title1"])
+        self.assertEqual([sorted(p["tags"]) for p in posts],
+                         [["A", "B2"], ["A", "B1"]])
+        self.assertEqual([p["user_id"] for p in posts], ["user2", "user1"])
+        self.assertNotIn("text", posts[0])
+        cursor = self.storage.encode_cursor(posts[-1])
+        posts = self.storage.get_posts_by_cursor(
+            count=2, cursor=cursor, tag="b0", fields=("title", "meta_data"))
+        self.assertEqual([p["title"] for p in posts], ["Title0"])
+        self.assertEqual(posts[0]["meta_data"]["derived"]["word_count"], 2)
+
+    def test_get_post_position(self):
+        post_date = datetime.datetime(2020, 1, 1)
+        pids = [self.storage.save_post(title="Title%d" % i,
+                                       text="Sample Text",
+                                       user_id="testuser", tags=["hello"],
+                                       draft=(i == 1), post_date=post_date)
+                for i in range(4)]
+        positions = [self.storage.get_post_position(
+            self.storage.get_post_by_id(pid)) for pid in pids]
+        self.assertEqual(positions, [0, 1, 1, 2])
+
     def _create_dummy_data(self):
         for i in range(20):
             tags = ["hello"] if i < 10 else ["world"]
@@ -403,8 +571,9 @@ class TestSQLiteBinds(FlaskBloggingTestCase):
             metadata = self._meta
             table = metadata.tables[table_name]
             columns = [t.name for t in table.columns]
-            expected_columns = ['id', 'title', 'text', 'post_date',
-                                'last_modified_date', 'draft']
+            expected_columns = ['id', 'title', 'slug', 'text', 'post_date',
+                                'last_modified_date', 'draft',
+                                'rendered_text', 'renderer', 'meta_data']
             self.assertListEqual(columns, expected_columns)
 
             # test models
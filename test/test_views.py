@@ -3,6 +3,9 @@ try:
 except ImportError:
     pass
 import os
+import sys
+import subprocess
+import gzip
 import unittest
 import unittest.mock
 import tempfile
@@ -10,12 +13,13 @@ from flask import redirect, url_for, current_app
 from flask_login import LoginManager, login_user, logout_user, current_user
 from sqlalchemy import create_engine, MetaData
 from flask_blogging.sqlastorage import SQLAStorage
-from flask_blogging import BloggingEngine
+from flask_blogging import BloggingEngine, signals
 from test import FlaskBloggingTestCase, TestUser
 import re
 from flask_principal import identity_changed, Identity, Permission,\
     AnonymousIdentity, identity_loaded, RoleNeed, UserNeed
 from flask_caching import Cache
+from markdown.extensions.toc import TocExtension
 from .utils import get_random_unicode
 from moto import mock_dynamodb2
 
@@ -190,6 +194,99 @@ class TestViews(FlaskBloggingTestCase):
             response = self.client.get("/blog/page/%s/" % self.pids[19])
             self.assertEqual(response.status_code, 200)
 
+    def test_editor_render_on_save(self):
+        self.app.config["BLOGGING_RENDER_ON_SAVE"] = True
+        user_id = "testuser"
+        with self.client:
+            self.login(user_id)
+            response = self.client.post(
+                "/blog/editor/%s/" % self.pids[0],
+                data=dict(title="Sample Title0-Edited",
+                          text="Summary: Rendered\n\n# Rendered on save",
+                          tags="tag1, tag2"))
+            self.assertEqual(response.status_code, 302)
+            post = self.storage.get_post_by_id(self.pids[0])
+            self.assertEqual(post["rendered_text"],
+                             "<h1>Rendered on save</h1>")
+            self.assertEqual(post["meta_data"]["meta"]["summary"],
+                             ["Rendered"])
+
+            # the stored html is served without rendering the markdown
+            with unittest.mock.patch.object(
+                    self.engine.post_processor, "render_text") as render:
+                response = self.client.get("/blog/page/%s/" % self.pids[0])
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b"<h1>Rendered on save</h1>", response.data)
+                render.assert_not_called()
+
+    def test_rerender_posts(self):
+        pid = self.storage.save_post(title="Stale", text="# Stale",
+                                     user_id="testuser", tags=["stale"],
+                                     meta_data={"meta": {}},
+                                     rendered_text="<h1>Old</h1>",
+                                     renderer="old")
+        draft_id = self.storage.save_post(title="Draft", text="# Draft",
+                                          user_id="testuser",
+                                          tags=["stale"], draft=True,
+                                          meta_data={"meta": {}},
+                                          rendered_text="<h1>Old</h1>",
+                                          renderer="old")
+        progress = []
+        with self.app.app_context():
+            rendered = self.engine.rerender_posts(
+                batch_size=7,
+                progress=lambda done, total, cursor: progress.append(
+                    (done, total, cursor)))
+        post = self.storage.get_post_by_id(pid)
+        self.assertEqual(post["rendered_text"], "<h1>Stale</h1>")
+        self.assertEqual(post["renderer"],
+                         self.engine.post_processor.renderer_version())
+        self.assertEqual(post["meta_data"]["meta"]["images"], [])
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        # the drafts are rendered once, in the same pass
+        self.assertEqual(rendered, progress[-1][1])
+        draft = self.storage.get_post_by_id(draft_id)
+        self.assertEqual(draft["rendered_text"], "<h1>Draft</h1>")
+
+        # resuming skips the posts done, and up to date posts are skipped
+        with self.app.app_context():
+            self.assertEqual(
+                self.engine.rerender_posts(cursor=progress[-1][2]), 0)
+            self.assertEqual(
+                self.engine.rerender_posts(cursor=progress[0][2]),
+                rendered - progress[0][0])
+            self.assertEqual(self.engine.rerender_posts(), rendered - 2)
+
+    def test_rerender_posts_after_restart(self):
+        # posts rendered by another process with the same extensions are
+        # up to date here, even when the extensions are configured with
+        # functions, as TocExtension is
+        post_processor = type(self.engine.post_processor)
+        extensions = post_processor.all_extensions() + [TocExtension()]
+        script = "from flask_blogging import PostProcessor\n" \
+                 "PostProcessor.set_custom_extensions([%s])\n" \
+                 "print(PostProcessor.renderer_version())" % ", ".join(
+                     "__import__(%r, fromlist=['_']).%s()" % (
+                         e.__class__.__module__, e.__class__.__name__)
+                     for e in extensions[2:])
+        renderer = subprocess.check_output(
+            [sys.executable, "-c", script]).decode("utf-8").strip()
+        pid = self.storage.save_post(title="Restart", text="# Restart",
+                                     user_id="testuser", tags=["restart"],
+                                     meta_data={"meta": {}},
+                                     rendered_text="<h1>Kept</h1>",
+                                     renderer=renderer)
+        post_processor._derived_config.clear()
+        try:
+            with unittest.mock.patch.object(
+                    post_processor, "_markdown_extensions", extensions), \
+                    self.app.app_context():
+                self.engine.rerender_posts()
+        finally:
+            post_processor._derived_config.clear()
+        post = self.storage.get_post_by_id(pid)
+        self.assertEqual(post["rendered_text"], "<h1>Kept</h1>")
+
     def test_editor_edit_page(self):
         user_id = "testuser"
         with self.client:
@@ -247,12 +344,218 @@ class TestViews(FlaskBloggingTestCase):
             response = self.client.get("/blog/sitemap.xml")
             self.assertEqual(response.status_code, 200)
 
+    def test_sitemap_shards(self):
+        self.app.config["BLOGGING_SITEMAP_SHARD_SIZE"] = 8
+        count = self.storage.count_posts()
+        num_shards = (count + 7) // 8
+        with self.client:
+            response = self.client.get("/blog/sitemap.xml")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data.count(b"<sitemap>"), num_shards)
+            self.assertIn(b"/blog/sitemap-%d.xml" % num_shards,
+                          response.data)
+            shards = []
+            for shard in range(1, num_shards + 1):
+                response = self.client.get("/blog/sitemap-%d.xml" % shard)
+                self.assertEqual(response.status_code, 200)
+                shards.append(response.data)
+            self.assertEqual([data.count(b"<url>") for data in shards],
+                             [8] * (num_shards - 1) +
+                             [count - 8 * (num_shards - 1)])
+            # the oldest post is in the first shard
+            self.assertIn(b"/blog/page/%d/" % self.pids[0], shards[0])
+            response = self.client.get("/blog/sitemap-%d.xml" %
+                                       (num_shards + 1))
+            self.assertEqual(response.status_code, 404)
+
+            # an edit changes the shard of the post
+            self.login("testuser")
+            self.client.post("/blog/editor/%s/" % self.pids[0],
+                             data=dict(title="Sample Title0-Edited",
+                                       text="Sample Text0-Edited",
+                                       tags="hello"))
+            self.logout()
+            response = self.client.get("/blog/sitemap-1.xml")
+            self.assertNotEqual(response.data, shards[0])
+            response = self.client.get("/blog/sitemap-%d.xml" % num_shards)
+            self.assertEqual(response.data, shards[-1])
+
+    def test_sitemap_posts_processed(self):
+        users = []
+
+        def record_users(sender, engine, posts):
+            users.extend((post["user_name"], post["editable"])
+                         for post in posts)
+        signals.sitemap_posts_processed.connect(record_users)
+        try:
+            with self.client:
+                response = self.client.get("/blog/sitemap-1.xml")
+                self.assertEqual(response.status_code, 200)
+        finally:
+            signals.sitemap_posts_processed.disconnect(record_users)
+        self.assertEqual(len(users), self.storage.count_posts())
+        self.assertTrue(all(user_name for user_name, _ in users))
+
     def test_atom(self):
         with self.client:
             # access to editor should be forbidden before login
             response = self.client.get("/blog/feeds/all.atom.xml")
             self.assertEqual(response.status_code, 200)
 
+    def test_feeds_by_tag_and_author(self):
+        processed = []
+        process_posts = self.engine.process_posts
+
+        def record_process_posts(posts, render=True):
+            processed.extend(post["post_id"] for post in posts)
+            return process_posts(posts, render)
+        self.engine.process_posts = record_process_posts
+        with self.client:
+            response = self.client.get("/blog/feeds/tag/hello.atom.xml")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data.count(b"<entry>"), 10)
+            self.assertIn(b"Sample Title0", response.data)
+            self.assertNotIn(b"Sample Title10", response.data)
+            response = self.client.get("/blog/feeds/author/newuser.atom.xml")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data.count(b"<entry>"),
+                             self.storage.count_posts(user_id="newuser"))
+            self.assertIn(b"Sample Title10", response.data)
+            self.assertNotIn(b"Sample Title0<", response.data)
+
+            # the entries are rendered once
+            del processed[:]
+            response = self.client.get("/blog/feeds/all.atom.xml")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(set(processed).isdisjoint(self.pids))
+            self.login("testuser")
+            self.client.post("/blog/editor/%s/" % self.pids[0],
+                             data=dict(title="Sample Title0-Edited",
+                                       text="Sample Text0-Edited",
+                                       tags="hello"))
+            self.logout()
+            del processed[:]
+            response = self.client.get("/blog/feeds/tag/hello.atom.xml")
+            self.assertIn(b"Sample Title0-Edited", response.data)
+            self.assertEqual(processed, [self.pids[0]])
+
+            # renaming the author changes the entries
+            if self.engine.cache is not None:
+                self.engine.cache.clear()
+            del processed[:]
+            with unittest.mock.patch.object(
+                    TestUser, "get_name",
+                    new=lambda user: "Renamed %s" % user.id):
+                response = self.client.get("/blog/feeds/tag/hello.atom.xml")
+            self.assertEqual(
+                response.data.count(b"<name>Renamed testuser</name>"), 10)
+            self.assertEqual(len(processed), 10)
+
+    def test_users_loader(self):
+        loaded = []
+
+        @self.engine.users_loader
+        def load_users(user_ids):
+            loaded.append(user_ids)
+            return dict((user_id, TestUser(user_id)) for user_id in user_ids)
+        with self.client:
+            response = self.client.get("/blog/100/")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b"newuser", response.data)
+            # the users of the page are loaded with one call
+            self.assertEqual(loaded, [set(["testuser", "newuser"])])
+
+            del loaded[:]
+            response = self.client.get("/blog/page/%s/" % self.pids[0])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(loaded, [set(["testuser"])])
+
+    def test_json_api(self):
+        with self.client:
+            response = self.client.get(
+                "/blog/api/tag/hello/?count=4&fields=post_id,title,tags")
+            self.assertEqual(response.status_code, 200)
+            data = response.get_json()
+            self.assertEqual([post["post_id"] for post in data["posts"]],
+                             self.pids[9:5:-1])
+            self.assertEqual(set(data["posts"][0]), set(["post_id", "title",
+                                                         "tags"]))
+            self.assertEqual(data["posts"][0]["tags"], ["HELLO"])
+            self.assertIsNone(data["prev"])
+            self.assertIn("fields=post_id,title,tags", data["next"])
+            response = self.client.get(data["next"])
+            data = response.get_json()
+            self.assertEqual([post["post_id"] for post in data["posts"]],
+                             self.pids[5:1:-1])
+            self.assertIsNotNone(data["prev"])
+
+            response = self.client.get(
+                "/blog/api/author/newuser/?fields=user_id,post_date")
+            data = response.get_json()
+            self.assertEqual(set(post["user_id"] for post in data["posts"]),
+                             set(["newuser"]))
+
+            response = self.client.get("/blog/api/posts/")
+            data = response.get_json()
+            self.assertIn("url", data["posts"][0])
+            self.assertNotIn("text", data["posts"][0])
+
+            response = self.client.get("/blog/api/page/%s/" % self.pids[0])
+            self.assertEqual(response.status_code, 200)
+            post = response.get_json()["post"]
+            self.assertEqual(post["title"], "Sample Title0")
+            self.assertEqual(post["rendered_text"], "<p>Sample Text0</p>")
+
+            response = self.client.get("/blog/api/posts/?fields=password")
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get("/blog/api/posts/?after=invalid")
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get("/blog/api/page/1000/")
+            self.assertEqual(response.status_code, 404)
+
+        # drafts are only given to their authors, also for conditional
+        # requests
+        self.app.config["BLOGGING_CONDITIONAL_GET"] = True
+        pid = self.storage.save_post(title="Draft", text="Draft text",
+                                     user_id="testuser", tags=["draft"],
+                                     draft=True)
+        url = "/blog/api/page/%s/" % pid
+        headers = {"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}
+        with self.client:
+            for request_headers in [{}, headers]:
+                response = self.client.get(url, headers=request_headers)
+                self.assertEqual(response.status_code, 404)
+                self.assertNotIn("ETag", response.headers)
+            self.login("testuser")
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()["post"]["title"], "Draft")
+
+    def test_render_excerpt(self):
+        self.app.config["BLOGGING_RENDER_TEXT"] = "excerpt"
+        text = "First paragraph\n\n<!--more-->\n\nSecond paragraph"
+        pid = self.storage.save_post(title="Excerpt", text=text,
+                                     user_id="testuser", tags=["excerpt"])
+        with self.client:
+            response = self.client.get("/blog/tag/excerpt/")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b"<p>First paragraph</p>", response.data)
+            self.assertNotIn(b"Second paragraph", response.data)
+            self.assertIn(b"Read more", response.data)
+
+            response = self.client.get("/blog/page/%s/" % pid)
+            self.assertIn(b"<p>Second paragraph</p>", response.data)
+
+    def test_render_workers(self):
+        self.app.config["BLOGGING_RENDER_WORKERS"] = 2
+        self.app.config["BLOGGING_RENDER_EXECUTOR"] = "thread"
+        self.app.config["BLOGGING_RENDER_MIN_BATCH"] = 2
+        with self.client:
+            response = self.client.get("/blog/feeds/all.atom.xml")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b"Sample Text19", response.data)
+            self.assertIsNotNone(self.engine.render_executor)
+
     def test_posts_per_page(self):
         posts_per_page = 5
         self.app.config["BLOGGING_POSTS_PER_PAGE"] = posts_per_page
@@ -273,6 +576,99 @@ class TestViews(FlaskBloggingTestCase):
             headings = pattern.findall(response.data)
             self.assertEqual(len(headings), posts_per_page)
 
+    def test_cursor_pagination(self):
+        self.app.config["BLOGGING_POSTS_PER_PAGE"] = 3
+        title = re.compile(b"<h1>Sample Title(\\d+)</h1>")
+        heading = re.compile(b"<h1>.*</h1>")
+        next_link = re.compile(b'<a href="([^"]+)">Next')
+        prev_link = re.compile(b'<a href="([^"]+)">&laquo; Prev')
+        with self.client:
+            for url, expected in [
+                    ("/blog/", list(range(19, -1, -1))),
+                    ("/blog/tag/hello/", list(range(9, -1, -1)))]:
+                numbers = []
+                urls = []
+                while url:
+                    response = self.client.get(url)
+                    numbers.extend(
+                        int(n) for n in title.findall(response.data))
+                    urls.append(url)
+                    links = next_link.findall(response.data)
+                    url = links[0].decode("utf-8") if links else None
+                self.assertEqual(numbers, expected)
+                self.assertIn("/after/", urls[-1])
+
+                # the previous page of the second page is the first page
+                headings = heading.findall(self.client.get(urls[0]).data)
+                response = self.client.get(urls[1])
+                url = prev_link.findall(response.data)[0].decode("utf-8")
+                self.assertIn("/before/", url)
+                response = self.client.get(url)
+                self.assertEqual(heading.findall(response.data), headings)
+                self.assertEqual(prev_link.findall(response.data), [])
+
+            # page numbers keep working, and link to cursors
+            response = self.client.get("/blog/3/2/")
+            self.assertEqual(len(heading.findall(response.data)), 3)
+            url = prev_link.findall(response.data)[0].decode("utf-8")
+            self.assertIn("/before/", url)
+            headings = heading.findall(self.client.get("/blog/3/").data)
+            response = self.client.get(url)
+            self.assertEqual(heading.findall(response.data), headings)
+            self.assertEqual(prev_link.findall(response.data), [])
+            response = self.client.get("/blog/3/after/invalid/")
+            self.assertEqual(response.status_code, 302)
+
+    def test_conditional_get(self):
+        self.app.config["BLOGGING_CONDITIONAL_GET"] = True
+        with self.client:
+            for url in ["/blog/", "/blog/page/%s/" % self.pids[0],
+                        "/blog/tag/hello/", "/blog/feeds/all.atom.xml",
+                        "/blog/sitemap.xml", "/blog/sitemap-1.xml"]:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.data)
+                etag = response.headers["ETag"]
+                last_modified = response.headers["Last-Modified"]
+
+                response = self.client.get(
+                    url, headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.data, b"")
+                response = self.client.get(
+                    url, headers={"If-Modified-Since": last_modified})
+                self.assertEqual(response.status_code, 304)
+
+            # saving a post changes the validators
+            etag = self.client.get("/blog/").headers["ETag"]
+            self.storage.save_post(title="Sample Title20", text="Sample Text",
+                                   user_id="testuser", tags=["hello"])
+            response = self.client.get("/blog/",
+                                       headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["ETag"], etag)
+
+            # bloggers always get the full response
+            self.login("testuser", blogger=True)
+            etag = self.client.get("/blog/").headers.get("ETag")
+            self.assertIsNone(etag)
+
+    def test_conditional_get_draft(self):
+        self.app.config["BLOGGING_CONDITIONAL_GET"] = True
+        pid = self.storage.save_post(title="Draft", text="Draft text",
+                                     user_id="testuser", tags=["draft"],
+                                     draft=True)
+        self.assertEqual(self.storage.get_validator(post_id=pid),
+                         (None, 0))
+        with self.client:
+            url = "/blog/api/page/%s/" % pid
+            for headers in [{}, {"If-None-Match": "*"},
+                            {"If-Modified-Since":
+                             "Fri, 01 Jan 2100 00:00:00 GMT"}]:
+                response = self.client.get(url, headers=headers)
+                self.assertEqual(response.status_code, 404)
+                self.assertNotIn("ETag", response.headers)
+
     def test_url_construction(self):
         ctx = self.app.test_request_context()
         ctx.push()
@@ -353,6 +749,23 @@ class TestViews(FlaskBloggingTestCase):
             self.assertFalse(blogger_permission.issubset(
                 self.engine.blogger_permission))
 
+    def test_auth_context(self):
+        permission = self.engine.blogger_permission
+        with self.client:
+            self.login("testuser")
+            with unittest.mock.patch.object(
+                    permission, "require",
+                    wraps=permission.require) as require:
+                response = self.client.get("/blog/")
+                self.assertEqual(response.status_code, 200)
+                # the permission is checked once for the request
+                self.assertEqual(require.call_count, 1)
+                response = self.client.get("/blog/page/%s/" % self.pids[0])
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(require.call_count, 2)
+            editor_url = "/blog/editor/%s/" % self.pids[0]
+            self.assertIn(editor_url.encode("utf-8"), response.data)
+
     def test_permissions_delete(self):
         self.app.config["BLOGGING_PERMISSIONS"] = True
         # Assuming "BLOGGING_PERMISSIONNAME" read failure
@@ -398,6 +811,52 @@ class TestViewsWithCache(TestViews):
         cache = Cache(self.app, config={"CACHE_TYPE": "simple"})
         return BloggingEngine(self.app, self.storage, cache=cache)
 
+    def test_sitemap_shard_cache(self):
+        with self.client:
+            # the shard is streamed, and cached once it was sent in full
+            response = self.client.get("/blog/sitemap-1.xml",
+                                       buffered=False)
+            self.assertIsNone(self.engine.cache.get("sitemap-shard:1"))
+            data = response.get_data()
+            response.close()
+            self.assertIsNotNone(self.engine.cache.get("sitemap-shard:1"))
+            with unittest.mock.patch.object(
+                    self.storage, "iter_post_batches") as iter_post_batches:
+                response = self.client.get("/blog/sitemap-1.xml")
+                iter_post_batches.assert_not_called()
+            self.assertEqual(response.data, data)
+            self.assertEqual(response.content_type, "application/xml")
+
+
+class TestViewsWithCompressedCache(TestViews):
+
+    def _create_blogging_engine(self):
+        self.app.config["BLOGGING_CACHE_COMPRESSION"] = ["gzip"]
+        cache = Cache(self.app, config={"CACHE_TYPE": "simple"})
+        return BloggingEngine(self.app, self.storage, cache=cache)
+
+    def test_compressed_responses(self):
+        with self.client:
+            for url in ["/blog/", "/blog/feeds/all.atom.xml",
+                        "/blog/sitemap-1.xml"]:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertIsNone(response.content_encoding)
+                self.assertIn("Accept-Encoding", response.vary)
+                data = response.data
+
+                response = self.client.get(
+                    url, headers={"Accept-Encoding": "br;q=1.0, gzip;q=0.5"})
+                self.assertEqual(response.content_encoding, "gzip")
+                self.assertEqual(gzip.decompress(response.data), data)
+                self.assertEqual(response.content_type,
+                                 self.client.get(url).content_type)
+
+                response = self.client.get(
+                    url, headers={"Accept-Encoding": "gzip;q=0"})
+                self.assertIsNone(response.content_encoding)
+                self.assertEqual(response.data, data)
+
 
 class TestViewsWithUnicode(TestViews):
 